@@ -0,0 +1,74 @@
+"""
+Throughput of the download loop of HttpFetcher (_chunk_read_).
+
+Serves a large (sparse) file from a local HTTP server and downloads it to
+/dev/null, with progress reports on, twice: with fixed 8 kB reads and a
+report per chunk (the former loop), and with _chunk_read_ (adaptive
+readinto chunks, throttled reports).
+
+Usage: python benchmarks/bench_chunk_read.py [size_in_MB]
+"""
+from __future__ import print_function
+
+import os
+import os.path as op
+import shutil
+import sys
+import tempfile
+import time
+
+from nidata.core.fetchers.base import chunk_report
+from nidata.core.fetchers.http_fetcher import _chunk_read_
+from nidata.core._utils.compat import _urllib
+from nidata.core._utils.testing import serve_directory
+
+
+def fixed_chunk_read(response, local_file, chunk_size=8192):
+    total_size = int(response.info().get('Content-Length'))
+    bytes_so_far = 0
+    t0 = time.time()
+    while True:
+        chunk = response.read(chunk_size)
+        bytes_so_far += len(chunk)
+        if not chunk:
+            break
+        local_file.write(chunk)
+        chunk_report(bytes_so_far, total_size, 0, t0)
+
+
+def bench(url, read):
+    response = _urllib.request.urlopen(url)
+    stderr = sys.stderr
+    try:
+        with open(os.devnull, 'wb') as local_file:
+            sys.stderr = open(os.devnull, 'w')  # progress reports
+            t0 = time.time()
+            read(response, local_file)
+            return time.time() - t0
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+        response.close()
+
+
+def main(size_mb=2048):
+    src_dir = tempfile.mkdtemp()
+    try:
+        n_bytes = size_mb * 1024 * 1024
+        with open(op.join(src_dir, 'large.bin'), 'wb') as fp:
+            fp.truncate(n_bytes)
+        with serve_directory(src_dir) as server:
+            url = server.url + 'large.bin'
+            for label, read in (
+                    ('8 kB reads', fixed_chunk_read),
+                    ('_chunk_read_', lambda response, local_file: _chunk_read_(
+                        response, local_file, report_hook=True, verbose=0))):
+                dt = bench(url, read)
+                print('%-15s %7.2fs  %8.1f MB/s' % (
+                    label, dt, n_bytes / dt / 1024 ** 2))
+    finally:
+        shutil.rmtree(src_dir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
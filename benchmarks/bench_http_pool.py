@@ -0,0 +1,62 @@
+"""
+Per-file overhead of HttpFetcher, with and without keep-alive connections.
+
+Serves many small files from a local HTTP server and fetches them twice:
+once opening a connection per file, once through the fetcher's connection
+pool.
+
+Usage: python benchmarks/bench_http_pool.py [n_files] [file_size]
+"""
+from __future__ import print_function
+
+import os
+import os.path as op
+import shutil
+import sys
+import tempfile
+import time
+
+from nidata.core.fetchers.http_fetcher import fetch_files
+from nidata.core.fetchers.http_pool import HttpConnectionPool
+from nidata.core._utils.testing import serve_directory
+
+
+def make_files(src_dir, n_files, file_size):
+    names = []
+    for fi in range(n_files):
+        name = 'file%05d.txt' % fi
+        with open(op.join(src_dir, name), 'wb') as fp:
+            fp.write(os.urandom(file_size))
+        names.append(name)
+    return names
+
+
+def bench(server, names, connection_pool):
+    data_dir = tempfile.mkdtemp()
+    try:
+        files = [(name, server.url + name, dict()) for name in names]
+        n_connections = server.n_connections
+        t0 = time.time()
+        fetch_files(data_dir, files, verbose=0,
+                    connection_pool=connection_pool)
+        return time.time() - t0, server.n_connections - n_connections
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def main(n_files=500, file_size=1024):
+    src_dir = tempfile.mkdtemp()
+    try:
+        names = make_files(src_dir, n_files, file_size)
+        with serve_directory(src_dir) as server:
+            for label, pool in (('new connection per file', None),
+                                ('pooled keep-alive', HttpConnectionPool())):
+                dt, n_connections = bench(server, names, pool)
+                print('%-25s %7.3fs  %6.2fms/file  %d connections' % (
+                    label, dt, 1000. * dt / n_files, n_connections))
+    finally:
+        shutil.rmtree(src_dir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
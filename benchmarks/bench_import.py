@@ -0,0 +1,40 @@
+"""
+Time taken by `import nidata`, and by reaching a single dataset class.
+
+Each measure runs in a fresh interpreter, so that nothing is cached in
+sys.modules.
+
+Usage: python benchmarks/bench_import.py [n_runs]
+"""
+from __future__ import print_function
+
+import subprocess
+import sys
+
+STATEMENTS = (
+    ('import nidata', 'import nidata'),
+    ('one dataset', 'import nidata; nidata.atlas.MSDLDataset'),
+    ('all datasets', 'import nidata; '
+                     '[getattr(getattr(nidata, c), n) '
+                     ' for c in nidata.__all__ if c != "core" '
+                     ' for n in getattr(getattr(nidata, c), "__all__", [])]'),
+)
+
+TIMER = ('import time; t0 = time.time(); %s; '
+         'import sys; print(time.time() - t0, len(sys.modules))')
+
+
+def main(n_runs=5):
+    for label, statement in STATEMENTS:
+        runs = []
+        for _ in range(n_runs):
+            out = subprocess.check_output([sys.executable, '-c',
+                                           TIMER % statement])
+            dt, n_modules = out.decode().split()
+            runs.append(float(dt))
+        print('%-15s %8.1fms (median of %d)  %s modules loaded' % (
+            label, 1000 * sorted(runs)[n_runs // 2], n_runs, n_modules))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,130 @@
+"""
+Time and peak memory of loading and iterating a 4D image.
+
+Writes a 4D NIfTI file (64 x 64 x 40 x n_volumes, float32), uncompressed
+and gzipped, then runs each case in a fresh process, to measure its peak
+RSS (VmHWM on Linux):
+
+- load: get the data of the image, and average one volume; formerly
+  (deep copy of the image, gc.collect, full read) and with _safe_get_data
+  (memmap of uncompressed files).
+- iterate: average each volume; formerly (whole data read, a
+  header-copying image per volume) and with check_niimg(...,
+  return_iterator=True) (one volume read at a time).
+- concat: concatenate 3 runs (the same file); by np.concatenate of their
+  data, and with concat_niimgs (preallocated, filled volume by volume).
+
+Usage: python benchmarks/bench_niimg.py [n_volumes]
+"""
+from __future__ import print_function
+
+import copy
+import gc
+import os
+import os.path as op
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import nibabel
+import numpy as np
+
+from nidata.core._utils.niimg import (_safe_get_data, check_niimg,
+                                      concat_niimgs, new_img_like)
+
+
+def former_load(path):
+    img = copy.deepcopy(nibabel.load(path))
+    gc.collect()
+    data = np.asanyarray(img.dataobj).copy()  # as the former get_data
+    return data[..., 0].mean()
+
+
+def load(path):
+    return _safe_get_data(check_niimg(path))[..., 0].mean()
+
+
+def former_iterate(path):
+    img = nibabel.load(path)
+    data = np.asanyarray(img.dataobj).copy()  # cached by get_data
+    return [np.asanyarray(new_img_like(img, data[..., i], img.affine,
+                                       copy_header=True).dataobj).mean()
+            for i in range(img.shape[3])]
+
+
+def iterate(path):
+    return [np.asanyarray(vol.dataobj).mean()
+            for vol in check_niimg(path, return_iterator=True)]
+
+
+def former_concat(path):
+    data = np.concatenate([np.asanyarray(nibabel.load(path).dataobj)
+                           for _ in range(3)], axis=3)
+    return nibabel.Nifti1Image(data, np.eye(4)).shape
+
+
+def concat(path):
+    return concat_niimgs([path] * 3).shape
+
+
+CASES = (('load', former_load, load), ('iterate', former_iterate, iterate),
+         ('concat', former_concat, concat))
+
+
+def peak_rss():
+    """Peak RSS of this process, in MB.
+
+    ru_maxrss is kept across exec on Linux, so it would include the peak
+    of the parent process; VmHWM is not.
+    """
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def run_case(name, path):
+    """Run a case in this process; print its time and peak RSS."""
+    fn = dict((case[0] + suffix, case[index]) for case in CASES
+              for suffix, index in (('_former', 1), ('', 2)))[name]
+    t0 = time.time()
+    fn(path)
+    dt = time.time() - t0
+    print('%-16s %-12s %7.3fs  %7.1f MB peak RSS' % (
+        name, op.basename(path), dt, peak_rss()))
+
+
+def main(n_volumes=300):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        data = np.random.rand(64, 64, 40, n_volumes).astype(np.float32)
+        paths = [op.join(temp_dir, 'bold' + ext)
+                 for ext in ('.nii', '.nii.gz')]
+        for path in paths:
+            nibabel.save(nibabel.Nifti1Image(data, np.eye(4)), path)
+            print('%s: %d volumes, %.1f MB' % (
+                op.basename(path), n_volumes, op.getsize(path) / 1e6))
+        del data
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        for path in paths:
+            for name, former, new in CASES:
+                for suffix in ('_former', ''):
+                    subprocess.check_call([sys.executable, __file__,
+                                           '--case', name + suffix, path],
+                                          env=env)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--case']:
+        run_case(*sys.argv[2:4])
+    else:
+        main(*[int(arg) for arg in sys.argv[1:]])
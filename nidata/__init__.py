@@ -5,11 +5,12 @@ import glob
 import gzip
 import os.path as _osp
 import sys
-from .core._utils import import_all_submodules as _impall
+from .core._utils import lazy_import_submodules as _lazy_import
 
 
+# Categories (and their datasets) are imported when first accessed.
 _script_dir = _osp.dirname(_osp.abspath(__file__))
-_impall(_script_dir, locals(), globals(), recursive=False)
+_lazy_import(_script_dir, globals(), recursive=False)
 
 # Monkey-patch gzip to have faster reads on large gzip files
 if hasattr(gzip.GzipFile, 'max_read_chunk'):
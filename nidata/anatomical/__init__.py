@@ -1,4 +1,10 @@
-from .oasis_vbm import OasisVbmDataset, fetch_oasis_vbm
-from .PING import PINGDataset
+import os.path as _osp
+from ..core._utils import lazy_import_submodules as _lazy_import
 
 __all__ = ['OasisVbmDataset', 'PINGDataset', 'fetch_oasis_vbm']
+
+# Dataset modules are imported when their class is first accessed.
+_lazy_import(_osp.dirname(_osp.abspath(__file__)), globals(), names=dict(
+    OasisVbmDataset='oasis_vbm',
+    fetch_oasis_vbm='oasis_vbm',
+    PINGDataset='PING'))
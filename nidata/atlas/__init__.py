@@ -3,5 +3,5 @@ Datasets defining cortical parcellations.
 """
 
 import os.path as _osp
-from ..core._utils import import_all_submodules as _impall
-_impall(_osp.dirname(_osp.abspath(__file__)), locals(), globals())
+from ..core._utils import lazy_import_submodules as _lazy_import
+_lazy_import(_osp.dirname(_osp.abspath(__file__)), globals())
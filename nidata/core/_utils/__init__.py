@@ -1,3 +1,3 @@
-from .importing import import_all_submodules
+from .importing import import_all_submodules, lazy_import_submodules
 
-__all__ = ['import_all_submodules']
+__all__ = ['import_all_submodules', 'lazy_import_submodules']
@@ -4,6 +4,11 @@ Compatibility layer for Python 3/Python 2 single codebase
 import sys
 import hashlib
 
+try:
+    from collections.abc import Iterable
+except ImportError:  # Python 2
+    from collections import Iterable  # noqa
+
 
 if sys.version_info[0] == 3:
     import pickle
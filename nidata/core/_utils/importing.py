@@ -1,8 +1,14 @@
 """
 """
 
+import importlib
 import os
 import os.path as op
+import re
+import sys
+
+# Public classes and functions defined at the top level of a module.
+_DEFINITION_RE = re.compile(r'^(?:class|def)\s+([A-Za-z]\w*)', re.MULTILINE)
 
 
 def _is_module_dir(dir_path):
@@ -23,3 +29,71 @@ def import_all_submodules(dir_path, locals, globals, recursive=True):
             exec('from .%s import *' % subdir, locals, globals)
         else:
             exec('from . import %s' % subdir, locals, globals)
+
+
+def _scan_definitions(module_dir):
+    """Return the public classes and functions defined by the __init__.py
+    of module_dir, found without importing it."""
+    with open(op.join(module_dir, '__init__.py')) as fp:
+        return _DEFINITION_RE.findall(fp.read())
+
+
+def lazy_import_submodules(dir_path, globals, recursive=True, names=None):
+    """Make the submodules of a package attributes of the package, imported
+    when they are first accessed (PEP 562).
+
+    Parameters
+    ----------
+    dir_path: string
+        Directory of the package.
+
+    globals: dict
+        Namespace of the package (its globals()).
+
+    recursive: bool, optional
+        If True, the classes and functions defined by each submodule are
+        also made attributes of the package, as
+        `from .submodule import *` would. They are found by scanning the
+        submodule sources, so that none is imported in advance.
+
+    names: dict, optional
+        Attributes of the package, mapped to the submodule defining them;
+        when given, submodules are not scanned.
+
+    Notes
+    -----
+    Python versions without module __getattr__ (< 3.7) import all
+    submodules eagerly.
+    """
+    subdirs = sorted(_get_all_subdirs(dir_path))
+    if names is None:
+        names = dict()
+        for subdir in subdirs:
+            if recursive:
+                for name in _scan_definitions(op.join(dir_path, subdir)):
+                    names.setdefault(name, subdir)
+    names = dict(names)
+    for subdir in subdirs:
+        names.setdefault(subdir, subdir)
+    package = globals['__name__']
+
+    def __getattr__(name):
+        if name not in names:
+            raise AttributeError("module %r has no attribute %r" % (
+                package, name))
+        module = importlib.import_module('.' + names[name], package)
+        value = module if name == names[name] else getattr(module, name)
+        globals[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(globals) | set(names))
+
+    globals.setdefault('__all__', sorted(
+        [name for name in names if name not in subdirs] or subdirs))
+    if sys.version_info >= (3, 7):
+        globals['__getattr__'] = __getattr__
+        globals['__dir__'] = __dir__
+    else:
+        for name in sorted(names, key=lambda name: name not in subdirs):
+            __getattr__(name)
@@ -5,31 +5,132 @@ Conversion utilities.
 # License: simplified BSD
 import collections
 import copy
-import gc
+import os
+import tempfile
 from distutils.version import LooseVersion
 
 import numpy as np
 import nibabel
+from nibabel.arrayproxy import ArrayProxy
+from nibabel.openers import ImageOpener
+from nibabel.volumeutils import apply_read_scaling
 from six import string_types
 
+from .compat import Iterable
 from .numpy_conversions import as_ndarray
 
 
 def _safe_get_data(img):
     """ Get the data in the image without having a side effect on the
         Nifti1Image object
+
+    The data is read from the data object of the image, and is not cached
+    in it. For uncompressed, unscaled images loaded with mmap (see
+    load_niimg), nothing is read: the data is a memmap of the file.
+    """
+    return np.asanyarray(img.dataobj)
+
+
+def _get_volume(img, index):
+    """ Return the data of a volume of a 4D image, reading no other volume.
+
+    In-memory (and memmapped) data is indexed without copy; the volume of
+    an image on disk is read by slicing its array proxy.
     """
-    if hasattr(img, '_data_cache') and img._data_cache is None:
-        # By loading directly dataobj, we prevent caching if the data is
-        # memmaped. Preventing this side-effect can save memory in some cases.
-        img = copy.deepcopy(img)
-    # typically the line below can double memory usage
-    # that's why we invoke a forced call to the garbage collector
-    gc.collect()
-    return img.get_data()
+    return img.dataobj[..., index]
+
 
+def _is_sequential(proxy):
+    """ Tell whether the volumes of an array proxy can be read one after the
+    other from its file (see _read_volumes)."""
+    return (isinstance(proxy, ArrayProxy) and
+            isinstance(proxy.file_like, string_types) and
+            getattr(proxy, 'order', 'F') == 'F')
 
-def load_niimg(niimg, dtype=None):
+
+def _read_volumes(proxy, out=None):
+    """ Read the volumes of a 4D array proxy, in a single pass over its file.
+
+    Volumes of a Fortran-ordered array are contiguous in the file: they are
+    read one after the other from a single file object, so that compressed
+    files are decompressed once (slicing the proxy decompresses the file
+    from its start, for each volume).
+
+    If out, a Fortran-ordered array of the shape and dtype of the proxy, is
+    given, volumes are read into it (and scaled copies are yielded, if the
+    proxy has a scaling).
+    """
+    shape = proxy.shape
+    dtype = np.dtype(proxy.dtype)
+    n_bytes = int(np.prod(shape[:3])) * dtype.itemsize
+    with ImageOpener(proxy.file_like) as fileobj:
+        fileobj.seek(proxy.offset)
+        for index in range(shape[3]):
+            if out is None:
+                data = np.empty(shape[:3], dtype=dtype, order='F')
+            else:
+                data = out[..., index]
+            buf = data.reshape(-1, order='F').view(np.uint8)
+            if hasattr(fileobj, 'readinto'):
+                n_read = fileobj.readinto(buf)
+            else:
+                chunk = fileobj.read(n_bytes)
+                n_read = len(chunk)
+                buf[:n_read] = np.frombuffer(chunk, dtype=np.uint8)
+            if n_read != n_bytes:
+                raise IOError('Unexpected end of file: %s' % proxy.file_like)
+            yield apply_read_scaling(data, proxy.slope, proxy.inter)
+
+
+def _copy_volumes(img, out):
+    """ Copy the data of a 4D image into out, a Fortran-ordered array of the
+    same shape, one volume at a time.
+
+    Volumes of images on disk are read directly into out if it has their
+    dtype.
+    """
+    proxy = img.dataobj
+    if _is_sequential(proxy):
+        same_dtype = np.dtype(proxy.dtype) == out.dtype
+        volumes = _read_volumes(proxy, out=out if same_dtype else None)
+    else:
+        volumes = (_get_volume(img, index) for index in range(img.shape[3]))
+    for index, volume in enumerate(volumes):
+        if not np.may_share_memory(volume, out):
+            out[..., index] = volume
+
+
+def iter_volumes(img):
+    """ Iterate over the volumes of a 4D image, as 3D images.
+
+    Volumes are views of in-memory (or memmapped) data, or are read one by
+    one from images on disk, so the 4D data is never loaded as a whole.
+    """
+    affine = img.affine
+    header = img.header.copy()
+    header.set_data_shape(img.shape[:3])
+    if hasattr(header, 'set_slope_inter'):
+        header.set_slope_inter(None, None)  # volumes are already scaled
+    if _is_sequential(img.dataobj):
+        volumes = _read_volumes(img.dataobj)
+    else:
+        volumes = (_get_volume(img, index) for index in range(img.shape[3]))
+    for volume in volumes:
+        yield img.__class__(volume, affine, header=header)
+
+
+def _get_image_cache(cache):
+    """Return the ImageCache to use: cache, or the one configured in the
+    environment if cache is None, or None if cache is False."""
+    if cache is False:
+        return None
+    if cache is None:
+        from ..fetchers.cache import ImageCache  # avoid circular import
+        cache = ImageCache.from_environ()
+    return cache
+
+
+def load_niimg(niimg, dtype=None, mmap=True, cache=None):
     """Load a niimg, check if it is a nibabel SpatialImage and cast if needed
 
     Parameters:
@@ -40,14 +141,27 @@ def load_niimg(niimg, dtype=None):
         http://nilearn.github.io/building_blocks/manipulating_mr_images.html#niimg.
         Image to load.
 
+    mmap: {True, False, 'c', 'r'}, optional
+        How the data of image files is memory mapped, if it can be; see
+        nibabel.load. Default: True
+
+    cache: ImageCache or False, optional
+        Cache of decompressed images: .nii.gz files are loaded from their
+        decompressed copy, which can be memory mapped. None means the cache
+        set by the NIDATA_IMAGE_CACHE_DIR environment variable, if any;
+        False disables it. Default: None
+
     Returns:
     --------
     img: image
         A loaded image object.
     """
     if isinstance(niimg, string_types):
-        # data is a filename, we load it
-        niimg = nibabel.load(niimg)
+        # data is a filename, we load it; its data is only read when used.
+        cache = _get_image_cache(cache)
+        if cache is not None and cache.is_cacheable(niimg):
+            niimg = cache.decompressed(niimg)
+        niimg = nibabel.load(niimg, mmap=mmap)
     elif not isinstance(niimg, nibabel.spatialimages.SpatialImage):
         raise TypeError("Data given cannot be loaded because it is"
                         " not compatible with nibabel format:\n" +
@@ -87,12 +201,12 @@ def new_img_like(ref_img, data, affine, copy_header=False):
         data = as_ndarray(data, dtype=default_dtype)
     header = None
     if copy_header:
-        header = copy.copy(ref_img.get_header())
+        header = copy.copy(ref_img.header)
         header['scl_slope'] = 0.
         header['scl_inter'] = 0.
         header['glmax'] = 0.
         header['cal_max'] = np.max(data) if data.size > 0 else 0.
-        header['cal_max'] = np.min(data) if data.size > 0 else 0.
+        header['cal_min'] = np.min(data) if data.size > 0 else 0.
     return ref_img.__class__(data, affine, header=header)
 
 
@@ -111,7 +225,7 @@ def copy_img(img):
     """
     if not isinstance(img, nibabel.spatialimages.SpatialImage):
         raise ValueError("Input value is not an image")
-    return new_img_like(img, img.get_data().copy(), img.get_affine().copy(),
+    return new_img_like(img, _safe_get_data(img).copy(), img.affine.copy(),
                         copy_header=True)
 
 
@@ -120,7 +234,7 @@ def _repr_niimgs(niimgs):
     """
     if isinstance(niimgs, string_types):
         return niimgs
-    if isinstance(niimgs, collections.Iterable):
+    if isinstance(niimgs, Iterable):
         return '[%s]' % ', '.join(_repr_niimgs(niimg) for niimg in niimgs)
     # Nibabel objects have a 'get_filename'
     try:
@@ -132,7 +246,7 @@ def _repr_niimgs(niimgs):
             return "%s(\nshape=%s,\naffine=%s\n)" % \
                    (niimgs.__class__.__name__,
                     repr(niimgs.shape),
-                    repr(niimgs.get_affine()))
+                    repr(niimgs.affine))
     except:
         pass
     return repr(niimgs)
@@ -154,7 +268,7 @@ def _check_fov(img, affine, shape):
     """
     img = check_niimg(img)
     return (img.shape[:3] == shape and
-            np.allclose(img.get_affine(), affine))
+            np.allclose(img.affine, affine))
 
 
 def _check_same_fov(img1, img2):
@@ -164,14 +278,48 @@ def _check_same_fov(img1, img2):
     img1 = check_niimg(img1)
     img2 = check_niimg(img2)
     return (img1.shape[:3] == img2.shape[:3] and
-            np.allclose(img1.get_affine(), img2.get_affine()))
+            np.allclose(img1.affine, img2.affine))
 
 
 def _index_img(img, index):
     """Helper function for check_niimg_4d."""
-    return new_img_like(
-        img, img.get_data()[:, :, :, index], img.get_affine(),
-        copy_header=True)
+    return new_img_like(img, _get_volume(img, index), img.affine,
+                        copy_header=True)
+
+
+def _take_volumes(img, indices):
+    """ Return a 4D image of the given volumes of a 4D image.
+
+    No other volume is read from in-memory or memmapped data; compressed
+    files are read up to the last requested volume, holding no other
+    volume in memory.
+    """
+    positions = collections.defaultdict(list)
+    for position, index in enumerate(indices):
+        positions[int(index)].append(position)
+    if not positions:
+        raise ValueError('No volume to take')
+    if _is_sequential(img.dataobj):
+        volumes = enumerate(_read_volumes(img.dataobj))
+    else:
+        volumes = ((index, _get_volume(img, index))
+                   for index in sorted(positions))
+    data = None
+    last = max(positions)
+    for index, volume in volumes:
+        if index in positions:
+            if data is None:
+                data = np.empty(img.shape[:3] + (len(indices),),
+                                dtype=volume.dtype, order='F')
+            for position in positions[index]:
+                data[..., position] = volume
+        if index == last:
+            break
+    header = img.header.copy()
+    header.set_data_shape(data.shape)
+    if hasattr(header, 'set_slope_inter'):
+        header.set_slope_inter(None, None)  # volumes are already scaled
+    return img.__class__(data, img.affine, header=header)
 
 
 def _iter_check_niimg(niimgs, ensure_ndim=None, atleast_4d=False,
@@ -205,7 +353,7 @@ def _iter_check_niimg(niimgs, ensure_ndim=None, atleast_4d=False,
             if i == 0:
                 ndim_minus_one = len(niimg.shape)
                 if ref_fov is None:
-                    ref_fov = (niimg.get_affine(), niimg.shape[:3])
+                    ref_fov = (niimg.affine, niimg.shape[:3])
 
             if not _check_fov(niimg, ref_fov[0], ref_fov[1]):
                 raise ValueError(
@@ -213,7 +361,7 @@ def _iter_check_niimg(niimgs, ensure_ndim=None, atleast_4d=False,
                     "reference FOV.\n"
                     "Reference affine:\n%r\nImage affine:\n%r\n"
                     "Reference shape:\n%r\nImage shape:\n%r\n"
-                    % (i, ref_fov[0], niimg.get_affine(), ref_fov[1],
+                    % (i, ref_fov[0], niimg.affine, ref_fov[1],
                        niimg.shape))
             yield niimg
         except TypeError as exc:
@@ -226,6 +374,106 @@ def _iter_check_niimg(niimgs, ensure_ndim=None, atleast_4d=False,
             raise
 
 
+def _alloc_data(shape, dtype, max_memory=None, temp_dir=None):
+    """ Allocate an array in Fortran order, so that volumes are contiguous.
+
+    Arrays of more than max_memory bytes are memmaps of a temporary file,
+    removed as soon as it is mapped where the system allows it (its space
+    is freed with the memmap).
+    """
+    dtype = np.dtype(dtype)
+    n_bytes = int(np.prod(shape)) * dtype.itemsize
+    if max_memory is None or n_bytes <= max_memory or n_bytes == 0:
+        return np.empty(shape, dtype=dtype, order='F')
+    fd, filename = tempfile.mkstemp(suffix='.dat', dir=temp_dir)
+    os.close(fd)
+    data = np.memmap(filename, dtype=dtype, mode='w+', shape=shape,
+                     order='F')
+    try:
+        os.remove(filename)
+    except OSError:
+        pass  # mapped files cannot be removed on Windows
+    return data
+
+
+def concat_niimgs(niimgs, dtype=np.float32, ensure_ndim=None,
+                  max_memory=None, temp_dir=None):
+    """Concatenate a list of 3D/4D niimgs of varying lengths.
+
+    The niimgs are read in a single pass: the field of view of the first
+    one sets the shape of the result, and each following niimg is checked
+    against it just before its data is copied into the result, one volume
+    at a time. At most one input image is loaded at a time, and only one
+    volume of it is held in memory if it is on disk.
+
+    The result is allocated for len(niimgs) times the length of the first
+    niimg, which is exact for a list of 3D images or of runs of the same
+    length; otherwise (iterators, runs of different lengths) it is
+    reallocated as it fills up.
+
+    Parameters
+    ----------
+    niimgs: iterable of Niimg-like objects
+        See
+        http://nilearn.github.io/building_blocks/manipulating_mr_images.html#niimg.
+        Niimgs to concatenate; iterators are supported. All niimgs must
+        have the same field of view (shape and affine) as the first one.
+
+    dtype: numpy dtype, optional
+        The dtype of the returned image. Default: np.float32
+
+    ensure_ndim: integer, optional
+        Indicate the dimensionality of the expected niimg. An
+        error is raised if the niimg is of another dimensionality.
+
+    max_memory: int, optional
+        Results larger than this (in bytes) are memmaps of a temporary
+        file, instead of being held in memory. Default: None (no limit)
+
+    temp_dir: string, optional
+        Directory of the temporary file of memmapped results. Default: the
+        system temporary directory.
+
+    Returns
+    -------
+    concatenated: nibabel.Nifti1Image
+        A single image.
+    """
+    def resize(data, n_volumes):
+        resized = _alloc_data(data.shape[:3] + (n_volumes,), data.dtype,
+                              max_memory=max_memory, temp_dir=temp_dir)
+        n_volumes = min(n_volumes, data.shape[3])
+        resized[..., :n_volumes] = data[..., :n_volumes]
+        return resized
+
+    ref_img = data = None
+    index = 0
+    for niimg in _iter_check_niimg(niimgs, ensure_ndim=ensure_ndim):
+        length = niimg.shape[3] if len(niimg.shape) == 4 else 1
+        if ref_img is None:
+            ref_img = niimg
+            if len(niimg.shape) not in (3, 4):
+                raise TypeError('Concatenated images must be 3D or 4D. You '
+                                'gave a list of %dD images'
+                                % len(niimg.shape))
+            n_images = len(niimgs) if hasattr(niimgs, '__len__') else 1
+            data = _alloc_data(niimg.shape[:3] + (n_images * length,),
+                               dtype, max_memory=max_memory,
+                               temp_dir=temp_dir)
+        elif index + length > data.shape[3]:
+            data = resize(data, max(index + length, 2 * data.shape[3]))
+        if len(niimg.shape) == 3:
+            data[..., index] = _safe_get_data(niimg)
+        else:
+            _copy_volumes(niimg, data[..., index:index + length])
+        index += length
+    if ref_img is None:
+        raise TypeError('Cannot concatenate an empty list of images')
+    if index < data.shape[3]:
+        data = resize(data, index)
+    return new_img_like(ref_img, data, ref_img.affine)
+
+
 def check_niimg(niimg, ensure_ndim=None, atleast_4d=False,
                 return_iterator=False):
     """Check that niimg is a proper 3D/4D niimg. Turn filenames into objects.
@@ -270,21 +518,17 @@ def check_niimg(niimg, ensure_ndim=None, atleast_4d=False,
                 "manipulating_mr_images.html#niimg." % type(niimg))
         if return_iterator:
             return _iter_check_niimg(niimg, ensure_ndim=ensure_ndim)
-        raise NotImplementedError('Must put back concat_niimgs :-/')
-        # return concat_niimgs(niimg, ensure_ndim=ensure_ndim)
+        return concat_niimgs(niimg, ensure_ndim=ensure_ndim)
 
     # Otherwise, it should be a filename or a SpatialImage, we load it
     niimg = load_niimg(niimg)
 
     if ensure_ndim == 3 and len(niimg.shape) == 4 and niimg.shape[3] == 1:
         # "squeeze" the image.
-        data = _safe_get_data(niimg)
-        affine = niimg.get_affine()
-        niimg = new_img_like(niimg, data[:, :, :, 0], affine)
+        niimg = new_img_like(niimg, _get_volume(niimg, 0), niimg.affine)
     if atleast_4d and len(niimg.shape) == 3:
-        data = niimg.get_data().view()
-        data.shape = data.shape + (1, )
-        niimg = new_img_like(niimg, data, niimg.get_affine())
+        data = _safe_get_data(niimg)[..., np.newaxis]
+        niimg = new_img_like(niimg, data, niimg.affine)
 
     if ensure_ndim is not None and len(niimg.shape) != ensure_ndim:
         raise TypeError(
@@ -294,7 +538,7 @@ def check_niimg(niimg, ensure_ndim=None, atleast_4d=False,
             "manipulating_mr_images.html#niimg." % (ensure_ndim, niimg.shape))
 
     if return_iterator:
-        return (_index_img(niimg, i) for i in range(niimg.shape[3]))
+        return iter_volumes(niimg)
 
     return niimg
 
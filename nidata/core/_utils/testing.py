@@ -4,6 +4,7 @@
 # License: simplified BSD
 import contextlib
 import copy
+import hashlib
 import importlib
 import os
 import os.path as op
@@ -12,9 +13,12 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import warnings
 
 from nose import SkipTest
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import unquote
 from nose.tools import assert_equal, assert_true
 
 from ..datasets import Dataset
@@ -306,3 +310,216 @@ except ImportError:
     def assert_less_equal(a, b):
         if a > b:
             raise AssertionError("%f is not less than %f" % (a, b))
+
+
+class _RangeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve files under ``server.root``, honouring single byte ranges."""
+    disable_nagle_algorithm = True  # headers and body are sent separately
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.n_connections += 1
+
+    def log_message(self, *args):
+        pass  # keep test output quiet
+
+    def _local_path(self):
+        path = unquote(self.path.split('?', 1)[0].split('#', 1)[0])
+        parts = [p for p in path.split('/') if p and p not in ('.', '..')]
+        return op.join(self.server.root, *parts)
+
+    def _serve(self, send_body):
+        name = self._local_path()[len(self.server.root):].lstrip(os.sep)
+        with self.server.lock:
+            self.server.n_requests += 1
+            failures = self.server.failures.get(name)
+            failure = failures.pop(0) if failures else None
+        if failure is not None:
+            status, retry_after = failure
+            self.send_response(status)
+            if retry_after is not None:
+                self.send_header('Retry-After', str(retry_after))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        path = self._local_path()
+        if not op.isfile(path):
+            self.send_error(404)
+            return
+        size = op.getsize(path)
+        start, end = 0, size - 1
+        status = 200
+        match = re.match(r'bytes=(\d*)-(\d*)$',
+                         self.headers.get('Range') or '')
+        if match and self.server.accept_ranges and size > 0:
+            if match.group(1):
+                start = int(match.group(1))
+                end = int(match.group(2) or end)
+            else:
+                start = max(0, size - int(match.group(2)))
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            end = min(end, size - 1)
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Length', str(end - start + 1))
+        if self.server.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, size))
+        self.end_headers()
+        if not send_body:
+            return
+        with open(path, 'rb') as fp:
+            fp.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = fp.read(min(remaining, 65536))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+@contextlib.contextmanager
+def serve_directory(root, accept_ranges=True, protocol_version='HTTP/1.1',
+                    failures=None):
+    """Context manager serving a directory over HTTP on localhost.
+
+    Parameters
+    ==========
+    root: string
+        Directory whose files are served.
+
+    accept_ranges: bool
+        If False, Range headers are ignored and full bodies are returned.
+
+    protocol_version: string
+        HTTP version spoken by the server; 'HTTP/1.1' allows keep-alive.
+
+    failures: dict, optional
+        Maps file names (relative to root) to a list of (status,
+        Retry-After) errors, answered to the first requests of that file;
+        Retry-After may be None.
+
+    Returns
+    =======
+    server: HTTPServer
+        The running server. `server.url` is the base url (with a trailing
+        slash); `server.n_connections` and `server.n_requests` count
+        accepted connections and served requests.
+    """
+    handler = type('_Handler', (_RangeRequestHandler,),
+                   dict(protocol_version=protocol_version))
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.root = root
+    server.accept_ranges = accept_ranges
+    server.failures = dict((name, list(errors))
+                           for name, errors in (failures or dict()).items())
+    server.lock = threading.Lock()
+    server.n_connections = server.n_requests = 0
+    server.url = 'http://127.0.0.1:%d/' % server.server_address[1]
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class FakeS3Key(object):
+    """In-memory stand-in for a boto S3 key."""
+
+    def __init__(self, bucket, name, data):
+        self.bucket = bucket
+        self.name = name
+        self.data = data
+        self.size = len(data)
+        self.etag = '"%s"' % hashlib.md5(data).hexdigest()
+
+    def get_contents_to_file(self, fp, headers=None, cb=None, num_cb=10):
+        conn = self.bucket.connection
+        with conn.lock:
+            conn.n_gets += 1
+            failing = conn.n_failures > 0
+            if failing:
+                conn.n_failures -= 1
+            failing = failing or self.name in conn.failing_keys
+        if failing:
+            raise IOError('Simulated S3 failure')
+        data = self.data
+        byte_range = (headers or dict()).get('Range')
+        if byte_range is not None:
+            conn.ranges.append(byte_range)
+            start, end = byte_range[len('bytes='):].split('-')
+            data = data[int(start):int(end) + 1]
+        for offset in range(0, len(data), 4096):
+            fp.write(data[offset:offset + 4096])
+
+
+class FakeS3Bucket(object):
+    """In-memory stand-in for a boto S3 bucket."""
+
+    def __init__(self, connection, name, contents):
+        self.connection = connection
+        self.name = name
+        self.contents = contents
+
+    def get_key(self, key_name, validate=True):
+        if key_name not in self.contents:
+            return None if validate else FakeS3Key(self, key_name, b'')
+        return FakeS3Key(self, key_name, self.contents[key_name])
+
+
+class FakeS3Connection(object):
+    """In-memory stand-in for a boto S3 connection.
+
+    Parameters
+    ----------
+    buckets: dict
+        Contents (dict of key name to bytes) of each bucket, by name.
+
+    n_failures: int, optional
+        Number of GET requests that fail before requests succeed.
+
+    failing_keys: list of string, optional
+        Names of keys whose GET requests always fail.
+    """
+    def __init__(self, buckets, n_failures=0, failing_keys=()):
+        self.buckets = buckets
+        self.n_failures = n_failures
+        self.failing_keys = failing_keys
+        self.n_gets = 0
+        self.ranges = []
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        """Connections are shared: the fake is its own connect()."""
+        return self
+
+    def get_bucket(self, bucket_name):
+        return FakeS3Bucket(self, bucket_name, self.buckets[bucket_name])
+
+    def get_all_buckets(self):
+        return [self.get_bucket(name) for name in sorted(self.buckets)]
@@ -0,0 +1,155 @@
+import os.path as op
+import shutil
+import subprocess
+import sys
+import tempfile
+import weakref
+from unittest import TestCase
+
+import nibabel
+import numpy as np
+from nose.tools import assert_equal, assert_raises, assert_true
+
+from .niimg import _safe_get_data, check_niimg, concat_niimgs
+
+
+def _run_python(code):
+    return subprocess.check_output([sys.executable, '-c', code]).decode()
+
+
+class LazyImportTest(TestCase):
+    def test_import_loads_no_dataset(self):
+        out = _run_python(
+            "import sys, nidata\n"
+            "print(sorted(m for m in sys.modules\n"
+            "             if m.startswith('nidata.') and\n"
+            "             m.split('.')[1] not in ('core', 'version')))\n"
+            "print('numpy' in sys.modules)")
+        assert_equal(out.split(), ['[]', 'False'])
+
+    def test_attributes_are_imported_on_access(self):
+        out = _run_python(
+            "import sys, nidata\n"
+            "print(nidata.atlas.MSDLDataset.__name__)\n"
+            "print(nidata.task.Haxby2001Dataset.__name__)\n"
+            "print('nidata.atlas.yeo_2011' in sys.modules)\n"
+            "print('nidata.task.neurovault' in sys.modules)\n"
+            "print('MSDLDataset' in dir(nidata.atlas))")
+        assert_equal(out.split(), ['MSDLDataset', 'Haxby2001Dataset',
+                                   'False', 'False', 'True'])
+
+    def test_star_import(self):
+        out = _run_python("from nidata.resting_state import *\n"
+                          "print(NyuRestDataset.__name__)")
+        assert_equal(out.split(), ['NyuRestDataset'])
+
+    def test_missing_attribute(self):
+        import nidata
+        assert_true(not hasattr(nidata.atlas, 'NoSuchDataset'))
+
+
+class NiimgTest(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.data = np.arange(4 * 5 * 6 * 3, dtype=np.float32).reshape(
+            (4, 5, 6, 3))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def save(self, name, data=None):
+        path = op.join(self.temp_dir, name)
+        data = self.data if data is None else data
+        nibabel.save(nibabel.Nifti1Image(data, np.eye(4)), path)
+        return path
+
+    def test_memmap(self):
+        data = _safe_get_data(check_niimg(self.save('img.nii')))
+        assert_true(isinstance(data, np.memmap))
+        np.testing.assert_array_equal(data, self.data)
+
+    def test_iter_volumes(self):
+        for name in ('img.nii', 'img.nii.gz'):
+            volumes = list(check_niimg(self.save(name), ensure_ndim=4,
+                                       return_iterator=True))
+            assert_equal(len(volumes), 3)
+            for index, volume in enumerate(volumes):
+                assert_equal(volume.shape, (4, 5, 6))
+                np.testing.assert_array_equal(_safe_get_data(volume),
+                                              self.data[..., index])
+
+        # Volumes of in-memory images are views of their data.
+        img = nibabel.Nifti1Image(self.data, np.eye(4))
+        for volume in check_niimg(img, return_iterator=True):
+            assert_true(np.may_share_memory(_safe_get_data(volume),
+                                            self.data))
+
+    def test_scaled_volumes(self):
+        path = op.join(self.temp_dir, 'scaled.nii.gz')
+        img = nibabel.Nifti1Image(self.data.astype(np.int16), np.eye(4))
+        img.header.set_slope_inter(2., 1.)
+        nibabel.save(img, path)
+        for index, volume in enumerate(check_niimg(path,
+                                                   return_iterator=True)):
+            np.testing.assert_array_equal(_safe_get_data(volume),
+                                          2 * self.data[..., index] + 1)
+        for dtype in (np.int16, np.float32):
+            img = concat_niimgs([path, path], dtype=dtype)
+            np.testing.assert_array_equal(_safe_get_data(img)[..., 3:],
+                                          2 * self.data + 1)
+
+    def test_ndim(self):
+        img = check_niimg(self.save('img.nii', self.data[..., :1]),
+                          ensure_ndim=3)
+        assert_equal(img.shape, (4, 5, 6))
+        img = check_niimg(self.save('img3d.nii', self.data[..., 0]),
+                          atleast_4d=True)
+        assert_equal(img.shape, (4, 5, 6, 1))
+        np.testing.assert_array_equal(_safe_get_data(img)[..., 0],
+                                      self.data[..., 0])
+
+    def test_concat(self):
+        paths = [self.save('run1.nii.gz'), self.save('run2.nii')]
+        img = concat_niimgs(path for path in paths)  # iterators too
+        assert_equal(img.shape, (4, 5, 6, 6))
+        data = _safe_get_data(img)
+        assert_equal(data.dtype, np.float32)
+        np.testing.assert_array_equal(data[..., :3], self.data)
+        np.testing.assert_array_equal(data[..., 3:], self.data)
+
+        # 3D images, concatenated by check_niimg, in a memmap.
+        volumes = [self.save('vol%d.nii' % i, self.data[..., i])
+                   for i in range(3)]
+        img = check_niimg(volumes, ensure_ndim=4)
+        np.testing.assert_array_equal(_safe_get_data(img), self.data)
+        img = concat_niimgs(volumes, dtype=np.float64, max_memory=1000,
+                            temp_dir=self.temp_dir)
+        data = _safe_get_data(img)
+        assert_true(isinstance(data, np.memmap))
+        np.testing.assert_array_equal(data, self.data)
+
+    def test_concat_iterator(self):
+        # Runs of different lengths, from a generator, are not buffered.
+        data = np.random.rand(4, 5, 6, 8)
+        refs = []
+
+        def runs():
+            for start, stop in ((0, 1), (1, 4), (4, 6), (6, 8)):
+                if len(refs) > 2:
+                    # The first run is kept, as reference; the one before
+                    # the last is released.
+                    assert_true(refs[-2]() is None)
+                img = nibabel.Nifti1Image(data[..., start:stop], np.eye(4))
+                refs.append(weakref.ref(img))
+                yield img
+        img = concat_niimgs(runs(), dtype=np.float64)
+        assert_equal(img.shape, (4, 5, 6, 8))
+        np.testing.assert_array_equal(_safe_get_data(img), data)
+
+    def test_concat_errors(self):
+        other_fov = nibabel.Nifti1Image(self.data, 2 * np.eye(4))
+        assert_raises(ValueError, concat_niimgs,
+                      [self.save('img.nii'), other_fov])
+        assert_raises(TypeError, concat_niimgs,
+                      [self.save('img.nii'), self.data[..., 0]])
+        assert_raises(TypeError, concat_niimgs, [])
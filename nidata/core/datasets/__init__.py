@@ -1,6 +1,7 @@
 """
 """
 
+import functools
 import importlib
 import inspect
 import os
@@ -23,6 +24,10 @@ def readlinkabs(link):
     return op.join(op.dirname(link), path)
 
 
+# Dataset directories already resolved by get_dataset_dir, by search paths.
+_dataset_dirs = dict()
+
+
 def get_dataset_dir(dataset_name, data_dir=None, env_vars=[],
                     verbose=1):
     """ Create if necessary and returns data directory of given dataset.
@@ -55,6 +60,24 @@ def get_dataset_dir(dataset_name, data_dir=None, env_vars=[],
     2. the global environment variable NILEARN_SHARED_DATA
     3. the user environment variable NIDATA_PATH
     4. NIDATA_PATH in the user home folder
+
+    Directories are only searched once per process; later calls with the
+    same arguments and environment reuse the directory found.
+    """
+    cache_key = (dataset_name, data_dir, tuple(env_vars),
+                 tuple(os.getenv(env_var) for env_var in env_vars),
+                 os.getenv('NIDATA_SHARED_DATA'), os.getenv('NIDATA_PATH'),
+                 op.expanduser('~'))
+    path = _dataset_dirs.get(cache_key)
+    if path is not None and op.isdir(path):
+        return path
+    path = _dataset_dirs[cache_key] = _find_dataset_dir(
+        dataset_name, data_dir=data_dir, env_vars=env_vars, verbose=verbose)
+    return path
+
+
+def _find_dataset_dir(dataset_name, data_dir=None, env_vars=[], verbose=1):
+    """Search (or create) the directory of a dataset; see get_dataset_dir.
     """
     # We build an array of successive paths by priority
     paths = []
@@ -154,15 +177,49 @@ class Dataset(ClassWithDependencies):
             self.clean_data_directory()
         return self.fetcher.fetch(verbose=verbose, *args, **kwargs)
 
+    def plan(self, *args, **kwargs):
+        """ Plan a fetch, without downloading anything; takes the arguments
+        of fetch, and returns a FetchPlan (see Fetcher.plan)."""
+        return self.fetcher.plan(*args, **kwargs)
+
+    def fetch_async(self, *args, **kwargs):
+        """ Asynchronous fetch, for asyncio applications (Python 3).
+
+        Takes the arguments of fetch, and returns an awaitable resolving to
+        its result. If the dataset uses the generic fetch and its fetcher
+        has a fetch_async coroutine (e.g. AsyncHttpFetcher), the downloads
+        run on the event loop; otherwise fetch runs in the default
+        executor of the loop.
+        """
+        import asyncio
+        if (hasattr(self.fetcher, 'fetch_async') and
+                type(self).fetch == Dataset.fetch):
+            return self._fetch_on_loop(*args, **kwargs)
+        return asyncio.get_event_loop().run_in_executor(
+            None, functools.partial(self.fetch, *args, **kwargs))
+
+    def _fetch_on_loop(self, force=False, verbose=1, *args, **kwargs):
+        # fetch, with the coroutine of the fetcher.
+        if force:
+            self.clean_data_directory()
+        return self.fetcher.fetch_async(verbose=verbose, *args, **kwargs)
+
 
 class FetcherFunctionMeta(DependenciesMeta):
-    """ Define fetcher_function; it will reset class docstring."""
+    """ Define fetcher_function; it will reset class docstring.
+
+    The fetcher function is imported when the class is first instantiated
+    (after its dependencies are installed), never when it is defined: this
+    keeps `import nidata` from importing nilearn and friends.
+    """
 
     def __new__(cls, name, parents, props):
         def _init__wrapper(init_fn):
             # TODO: Docstring
             def wrapper_fn(self, *args, **kwargs):
                 rv = init_fn(self, *args, **kwargs)  # install
+                if '_func' in self.__class__.__dict__:
+                    return rv  # already imported
                 mod_path = '.'.join(self.fetcher_function.split('.')[:-1])
                 func_name = self.fetcher_function.split('.')[-1]
                 mod = importlib.import_module(mod_path)
@@ -173,7 +230,8 @@ class FetcherFunctionMeta(DependenciesMeta):
                                              self.fetcher_function, dir(mod),
                                              self.dependencies, mod.__file__))
                 func = getattr(mod, func_name)
-                self.__class__._func = func
+                # Not a method: the dataset is not passed to the function.
+                self.__class__._func = staticmethod(func)
                 return rv
             return wrapper_fn
 
@@ -181,19 +239,7 @@ class FetcherFunctionMeta(DependenciesMeta):
             .__new__(cls=cls, name=name, parents=parents, props=props)
 
         if hasattr(new_cls, 'fetcher_function'):
-            # Need to find the fetcher function
-            mod_path = '.'.join(new_cls.fetcher_function.split('.')[:-1])
-            func_name = new_cls.fetcher_function.split('.')[-1]
-
-            try:
-                mod = importlib.import_module(mod_path)
-                func = getattr(mod, func_name)
-            except:
-                # Module not installed; paste it on lazily
-                new_cls.__init__ = _init__wrapper(new_cls.__init__)
-            else:
-                # Module installed; we can paste it on now.
-                new_cls._func = func
+            new_cls.__init__ = _init__wrapper(new_cls.__init__)
 
         return new_cls
 
@@ -202,6 +248,13 @@ class FetcherFunctionDataset(with_metaclass(FetcherFunctionMeta, Dataset)):
     def fetch(self, *args, **kwargs):
         return self._func(*args, **kwargs)
 
+    def plan(self, *args, **kwargs):
+        """ Downloads are handled by fetcher_function, so they are not
+        known in advance: returns an OpaqueFetchPlan, which calls fetch
+        with the given arguments when executed."""
+        from ..fetchers.plan import OpaqueFetchPlan  # avoid circular import
+        return OpaqueFetchPlan(functools.partial(self.fetch, *args, **kwargs))
+
 
 class NilearnDataset(FetcherFunctionDataset):
     dependencies = (['numpy', 'scipy', 'sklearn', 'nilearn'] +
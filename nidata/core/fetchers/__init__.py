@@ -1,5 +1,8 @@
 from .aws_fetcher import AmazonS3Fetcher
 from .http_fetcher import HttpFetcher
 from .base import Fetcher
+from .events import EventLog, JsonLinesExporter, PrometheusExporter
+from .plan import FetchPlan
 
-__all__ = ['AmazonS3Fetcher', 'HttpFetcher', 'Fetcher']
+__all__ = ['AmazonS3Fetcher', 'HttpFetcher', 'Fetcher', 'FetchPlan',
+           'EventLog', 'JsonLinesExporter', 'PrometheusExporter']
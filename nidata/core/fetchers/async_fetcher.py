@@ -0,0 +1,309 @@
+"""
+Asynchronous (asyncio) HTTP downloads.
+
+AsyncHttpFetcher has the fetch(files, ...) contract of HttpFetcher, plus a
+fetch_async coroutine that drives all transfers from a single thread. A
+fixed number of worker coroutines take urls from a queue, so at most
+max_in_flight transfers (and max_per_host against any host) are open at
+once, however many files are requested.
+
+This module requires Python 3.5+ and aiohttp; nidata.core.fetchers does not
+import it.
+"""
+
+import asyncio
+import collections
+import functools
+import os
+import os.path as op
+import shutil
+import time
+
+from .._utils.compat import _urllib
+from .base import Fetcher, hash_file, new_hasher
+from .events import FetchStats
+from .http_fetcher import (_expected_digest, _file_digests, _get_file_name,
+                           _get_temp_dir, _install_url_files)
+from .manifest import DownloadManifest
+from .staging import recover_staged
+
+# Bytes read from a response at a time.
+CHUNK_SIZE = 64 * 1024
+
+
+class AsyncHttpFetcher(Fetcher):
+    """Downloads files over HTTP, concurrently, on an asyncio event loop.
+
+    Parameters
+    ----------
+    data_dir, username, passwd: optional
+        As in HttpFetcher.
+
+    max_in_flight: int, optional
+        Maximum number of concurrent transfers. Default: 64
+
+    max_per_host: int, optional
+        Maximum number of concurrent transfers against a single host.
+        Default: None (only bounded by max_in_flight)
+
+    chunk_size: int, optional
+        Bytes read from responses at a time. Default: CHUNK_SIZE
+
+    Notes
+    -----
+    Archives are extracted, and downloads written and hashed, in the
+    default executor of the event loop, so that disk and hashing work do
+    not block other transfers. Unlike HttpFetcher,
+    downloads are neither segmented nor streamed into archives.
+    """
+    dependencies = ['aiohttp'] + Fetcher.dependencies
+
+    def __init__(self, data_dir=None, username=None, passwd=None,
+                 max_in_flight=64, max_per_host=None, chunk_size=CHUNK_SIZE):
+        super(AsyncHttpFetcher, self).__init__(data_dir=data_dir)
+        self.username = username
+        self.passwd = passwd
+        self.max_in_flight = max_in_flight
+        self.max_per_host = max_per_host
+        self.chunk_size = chunk_size
+
+    def fetch(self, files, force=False, resume=True, check=False, verbose=1,
+              delete_archive=True):
+        """Download files, blocking until they are all fetched; runs its own
+        event loop. From a coroutine, await fetch_async instead."""
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.fetch_async(
+                files, force=force, resume=resume, check=check,
+                verbose=verbose, delete_archive=delete_archive))
+        finally:
+            loop.close()
+
+    async def fetch_async(self, files, force=False, resume=True, check=False,
+                          verbose=1, delete_archive=True):
+        """Coroutine downloading files; see HttpFetcher.fetch and
+        fetch_files for the arguments.
+
+        Returns
+        -------
+        files: list of string
+            Absolute paths of downloaded files on disk
+        """
+        import aiohttp
+
+        files = self.reformat_files(files)  # allows flexibility
+        out_files = [op.join(self.data_dir, file_)
+                     for file_, url, opts in files]
+
+        # Files already fetched are found in the manifest, in a single read.
+        manifest = DownloadManifest(self.data_dir)
+        if not force:
+            files = [(file_, url, opts) for file_, url, opts in files
+                     if not manifest.is_fetched(file_, url=url, check=check)]
+            if not files:
+                return out_files
+
+        if not op.exists(self.data_dir):
+            os.makedirs(self.data_dir)
+        if not os.access(self.data_dir, os.W_OK):
+            raise ValueError('Dataset files are missing but dataset'
+                             ' repository is read-only. Contact your data'
+                             ' administrator to solve the problem')
+        # Commits interrupted by a crash are finished first.
+        recover_staged(self.data_dir, verbose=verbose)
+
+        # Group targets by url, keeping the order in which urls were
+        # requested.
+        url_entries = collections.OrderedDict()
+        for file_, url, opts in files:
+            url_entries.setdefault(url, []).append((file_, opts))
+        queue = asyncio.Queue()
+        for url in url_entries:
+            queue.put_nowait(url)
+        errors = []
+
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight,
+                                         limit_per_host=self.max_per_host or 0)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            async def worker():
+                # Workers stop taking urls after the first error.
+                while not errors and not queue.empty():
+                    url = queue.get_nowait()
+                    targets = [file_ for file_, opts in url_entries[url]]
+                    stats = FetchStats()
+                    t0 = time.time()
+                    self.events.emit('started', url=url, targets=targets)
+                    try:
+                        await self._fetch_url(
+                            session, url, url_entries[url], force=force,
+                            resume=resume, verbose=verbose,
+                            delete_archive=delete_archive, stats=stats)
+                    except Exception as exc:
+                        self.events.emit('failed', url=url, targets=targets,
+                                         seconds=time.time() - t0,
+                                         attempts=1, error=exc)
+                        errors.append(exc)
+                        return
+                    seconds = time.time() - t0
+                    self.events.emit(
+                        'fetched', url=url, targets=targets,
+                        seconds=seconds, attempts=1,
+                        rate=stats.bytes / max(seconds, 1e-6),
+                        **stats.as_dict())
+                    for file_, opts in url_entries[url]:
+                        manifest.add(file_, url=url,
+                                     digests=_file_digests(opts))
+
+            try:
+                await asyncio.gather(*[
+                    worker()
+                    for _ in range(min(self.max_in_flight, len(url_entries)))])
+            finally:
+                # Keep track of what was fetched, even if some url failed.
+                manifest.save()
+        if errors:
+            raise errors[0]
+        return out_files
+
+    async def _fetch_url(self, session, url, entries, force=False,
+                         resume=True, verbose=1, delete_archive=True,
+                         stats=None):
+        """Fetch every target that comes from a single url; see
+        http_fetcher._fetch_url_files."""
+        temp_dir = _get_temp_dir(self.data_dir, url)
+        missing = [file_ for file_, opts in entries
+                   if force or not op.exists(op.join(self.data_dir, file_))]
+        if not missing:
+            return
+        # Targets coming from the same url share their download options.
+        opts = entries[0][1]
+        members = None if opts.get('extract_all') else missing
+
+        fetched_file = await self._fetch_file(session, url, temp_dir, opts,
+                                              resume=resume, overwrite=force,
+                                              verbose=verbose, stats=stats)
+        install = functools.partial(
+            _install_url_files, self.data_dir, temp_dir, fetched_file,
+            missing, opts, delete_archive=delete_archive, members=members,
+            verbose=verbose, stats=stats, url=url)
+        if opts.get('uncompress'):
+            await asyncio.get_event_loop().run_in_executor(None, install)
+        else:
+            install()  # only renames
+
+    async def _fetch_file(self, session, url, temp_dir, opts, resume=True,
+                          overwrite=False, verbose=1, stats=None):
+        """Download url into temp_dir; see http_fetcher._fetch_file.
+
+        Returns
+        -------
+        file: string
+            Absolute path of the downloaded file.
+        """
+        import aiohttp
+
+        if stats is None:
+            stats = FetchStats()
+        if not op.exists(temp_dir):
+            os.makedirs(temp_dir)
+        file_name = _get_file_name(url)
+        full_name = op.join(temp_dir, file_name)
+        temp_full_name = full_name + '.part'
+        if op.exists(full_name):
+            if overwrite:
+                os.remove(full_name)
+            else:
+                return full_name
+        if overwrite and op.exists(temp_full_name):
+            os.remove(temp_full_name)
+
+        headers = dict(opts.get('headers', dict()))
+        auth = None
+        username = opts.get('username', self.username)
+        if username:
+            # Make sure we're secure, basic auth is unencrypted
+            scheme = _urllib.parse.urlparse(url).scheme
+            if scheme and scheme != 'https':
+                raise ValueError("Specifying username currently requires "
+                                 "using a secure (https) URL (%s)." % url)
+            auth = aiohttp.BasicAuth(username,
+                                     opts.get('passwd', self.passwd) or '')
+        initial_size = 0
+        if resume and op.exists(temp_full_name):
+            initial_size = op.getsize(temp_full_name)
+            headers['Range'] = 'bytes=%d-' % initial_size
+        expected = _expected_digest(opts.get('md5sum'), opts.get('checksum'))
+
+        if verbose > 0:
+            displayed_url = url.split('?')[0] if verbose == 1 else url
+            print('Downloading data from %s ...' % displayed_url)
+        loop = asyncio.get_event_loop()
+        t0 = time.time()
+        try:
+            async with session.get(url, headers=headers, auth=auth,
+                                   cookies=opts.get('cookies')) as response:
+                stats.add('connect', time.time() - t0)
+                content_range = response.headers.get('Content-Range') or ''
+                restart = False
+                if initial_size and not content_range.startswith(
+                        'bytes %d-' % initial_size):
+                    # e.g. 416 for a complete .part, or a server ignoring
+                    # ranges: download the whole file, as _fetch_file does.
+                    if verbose > 0:
+                        print('Resuming failed, try to download the whole '
+                              'file.')
+                    restart = response.status != 200
+                    initial_size = 0
+                if not restart:
+                    response.raise_for_status()
+                    # Disk and hashing work runs in the default executor,
+                    # so that it does not stall the other transfers.
+                    hasher = None
+                    if expected is not None:
+                        hasher = new_hasher(expected[0])
+                        if initial_size:
+                            # Resuming: hash what was downloaded before.
+                            hash_part = functools.partial(
+                                hash_file, temp_full_name, hasher=hasher)
+                            with stats.timing('hash'):
+                                await loop.run_in_executor(None, hash_part)
+                    t_transfer = time.time()
+                    hash_time = [0.]
+
+                    def write(chunk):
+                        local_file.write(chunk)
+                        if hasher is not None:
+                            t_hash = time.time()
+                            hasher.update(chunk)
+                            hash_time[0] += time.time() - t_hash
+
+                    with open(temp_full_name,
+                              'ab' if initial_size else 'wb') as local_file:
+                        async for chunk in response.content.iter_chunked(
+                                self.chunk_size):
+                            await loop.run_in_executor(None, write, chunk)
+                            stats.bytes += len(chunk)
+                    stats.add('hash', hash_time[0])
+                    stats.add('transfer',
+                              time.time() - t_transfer - hash_time[0])
+        except aiohttp.ClientError as e:
+            if verbose > 0:
+                print("Error while fetching file %s. "
+                      "Dataset fetching aborted." % file_name)
+            if verbose > 1:
+                print("HTTP Error: %s, %s" % (e, url))
+            raise
+        if restart:
+            return await self._fetch_file(session, url, temp_dir, opts,
+                                          resume=False, overwrite=overwrite,
+                                          verbose=verbose, stats=stats)
+        shutil.move(temp_full_name, full_name)
+        if verbose > 0:
+            dt = time.time() - t0
+            print('...done. (%i seconds, %i min)' % (dt, dt // 60))
+
+        if expected is not None and hasher.hexdigest() != expected[1]:
+            os.remove(full_name)  # do not leave it for the next fetch
+            raise ValueError("File %s checksum verification has failed."
+                             " Dataset fetching aborted." % full_name)
+        return full_name
@@ -1,28 +1,39 @@
 """
 """
 
-import os
 import os.path as op
-import time
-import warnings
-from functools import partial
 
 import nibabel as nib
 import numpy as np
 
-from .base import chunk_report, Fetcher
+from .base import Fetcher, hash_file
+from .manifest import DownloadManifest
+from .retry import RetryPolicy
+from .s3_transfer import MULTIPART_THRESHOLD, PART_SIZE, S3Downloader
 
+try:
+    from nibabel.filebasedimages import ImageFileError
+except ImportError:  # nibabel < 2.1
+    from nibabel.spatialimages import ImageFileError
 
-def test_cb(cur_bytes, total_bytes, t0=None, **kwargs):
-    return chunk_report(bytes_so_far=cur_bytes, total_size=total_bytes,
-                        initial_size=0, t0=t0)
+# Checks of files already downloaded, from cheapest to most thorough.
+CHECK_MODES = ('size', 'etag', 'header', 'full')
 
 
 class AmazonS3Fetcher(Fetcher):
     dependencies = ['boto'] + Fetcher.dependencies
 
     def __init__(self, data_dir=None, access_key=None, secret_access_key=None,
-                 profile_name=None):
+                 profile_name=None, max_workers=4, part_size=PART_SIZE,
+                 multipart_threshold=MULTIPART_THRESHOLD, max_bandwidth=None,
+                 max_retries=3):
+        """
+        Keys are downloaded by max_workers threads; objects larger than
+        multipart_threshold are downloaded as ranged GETs of part_size
+        bytes. max_bandwidth (bytes/s) caps the total download rate, and
+        failed requests are retried max_retries times, with exponential
+        backoff.
+        """
         if not (profile_name or (access_key and secret_access_key)):
             raise ValueError("profile_name or access_key / secret_access_key "
                              "must be provided.")
@@ -30,64 +41,215 @@ class AmazonS3Fetcher(Fetcher):
         self.access_key = access_key
         self.secret_access_key = secret_access_key
         self.profile_name = profile_name
+        self.max_workers = max_workers
+        self.part_size = part_size
+        self.multipart_threshold = multipart_threshold
+        self.max_bandwidth = max_bandwidth
+        self.max_retries = max_retries
 
     def fetch(self, files, force=False, check=False, verbose=1):
+        """Download files (target, key, options) from S3.
+
+        check sets how files already on disk are validated before being
+        re-downloaded; see CHECK_MODES. True means 'size'. Files recorded in
+        the download manifest, and unchanged since, pass the 'size' check
+        without a request. If their ETag was recorded, the 'etag' check
+        compares it to their md5 sum, which is then recorded too, so
+        unchanged files are only hashed once; otherwise the ETag is
+        requested.
+        """
         assert (self.profile_name or
                 (self.access_key and self.secret_access_key))
+        check = _check_mode(check)
 
         files = Fetcher.reformat_files(files)  # allows flexibility
+
+        # Files already fetched are found in the manifest, in a single read.
+        manifest = DownloadManifest(self.data_dir)
+        files_ = [None] * len(files)
+        pending = []
+        for fi, (file_, remote_key, opts) in enumerate(files):
+            if not force and check not in ('header', 'full') and \
+                    manifest.is_fetched(file_, url=remote_key,
+                                        check=bool(check)) and \
+                    (check != 'etag' or _check_recorded_etag(manifest,
+                                                             file_)):
+                files_[fi] = op.join(self.data_dir, file_)
+            else:
+                pending.append(fi)
+
+        try:
+            if pending:
+                self._fetch_keys([files[fi] for fi in pending], pending,
+                                 files_, manifest, force=force, check=check,
+                                 verbose=verbose)
+        finally:
+            manifest.save()
+        return files_
+
+    def _connect(self):
         import boto
         if self.profile_name is not None:
-            s3 = boto.connect_s3(profile_name=self.profile_name)
-        elif (self.access_key is not None and
-              self.secret_access_key is not None):
-            s3 = boto.connect_s3(self.access_key, self.secret_access_key)
-
-        bucket_names = np.unique([opts.get('bucket') for f, rk, opts in files])
-        files_ = []
-        for bucket_name in bucket_names:  # loop over bucket names: efficient
-            if bucket_name:  # bucket requested
-                buck = s3.get_bucket(bucket_name)
-            else:  # default to first bucket
-                buck = s3.get_all_buckets()[0]
-
-            for file_, remote_key, opts in files:
-                if opts.get('bucket') != bucket_name:
-                    continue  # get all files from the current bucket only.
-                target_file = op.join(self.data_dir, file_)
-                key = buck.get_key(remote_key)
-                if not key:
-                    warnings.warn('Failed to find key: %s' % remote_key)
-                    files_.append(None)
-                else:
-                    do_download = force or not op.exists(target_file)
-                    try:
-                        do_download = (do_download or
-                                       (check and nib.load(
-                                        target_file).get_data() is None))
-                    except IOError as ioe:
-                        if verbose > 0:
-                            print("Warning: %s corrupted, re-downloading "
-                                  "(Error=%s)" % (target_file, ioe))
-                        do_download = True
-
-                    if do_download:
-                        # Ensure destination directory exists
-                        destination_dir = op.dirname(target_file)
-                        if not op.isdir(destination_dir):
-                            if verbose > 0:
-                                print("Creating base directory %s" % (
-                                    destination_dir))
-                            os.makedirs(destination_dir)
-
-                        if verbose > 0:
-                            print("Downloading [%s]/%s to %s." % (
-                                bucket_name or 'default bucket',
-                                remote_key,
-                                target_file))
-                        with open(target_file, 'wb') as fp:
-                            cb = partial(test_cb, t0=time.time())
-                            key.get_contents_to_file(fp, cb=cb, num_cb=None)
-
-                    files_.append(target_file)
-        return files_
+            return boto.connect_s3(profile_name=self.profile_name)
+        return boto.connect_s3(self.access_key, self.secret_access_key)
+
+    def _get_downloader(self, max_workers=None, verbose=1):
+        return S3Downloader(self._connect,
+                            max_workers=max_workers or self.max_workers,
+                            part_size=self.part_size,
+                            multipart_threshold=self.multipart_threshold,
+                            max_bandwidth=self.max_bandwidth,
+                            retry=RetryPolicy(self.max_retries),
+                            events=self.events, verbose=verbose)
+
+    def get_sizes(self, urls, max_workers=8, verbose=1):
+        """Return the sizes of S3 objects, given as (key, options) pairs,
+        from concurrent HEAD requests; None for missing keys."""
+        downloader = self._get_downloader(max_workers=max_workers,
+                                          verbose=verbose)
+
+        def get_size(url_opts):
+            remote_key, opts = url_opts
+            key = downloader.get_key(opts.get('bucket'), remote_key)
+            return key.size if key else None
+        return downloader.map(get_size, urls)
+
+    def _fetch_keys(self, files, indices, files_, manifest, force=False,
+                    check=False, verbose=1):
+        """Download files (target, key, options) from their buckets, and
+        store the path of target files in files_, at their indices."""
+        downloader = self._get_downloader(verbose=verbose)
+        items = [(fi, file_, opts.get('bucket'), remote_key,
+                  op.join(self.data_dir, file_))
+                 for fi, (file_, remote_key, opts) in zip(indices, files)]
+
+        # Files on disk are checked in parallel; the others are downloaded.
+        def is_valid(item):
+            fi, file_, bucket_name, remote_key, target_file = item
+            if force or not op.exists(target_file):
+                return False
+            if not check:
+                return True
+            valid = check_s3_file(
+                target_file,
+                lambda: downloader.get_key(bucket_name, remote_key), check)
+            if not valid and verbose > 0:
+                print("Warning: %s failed the %s check, re-downloading." % (
+                    target_file, check))
+            return valid
+        valid = downloader.map(is_valid, items)
+
+        keys = []
+        for item, item_valid in zip(items, valid):
+            fi, file_, bucket_name, remote_key, target_file = item
+            if item_valid:
+                manifest.add(file_, url=remote_key, bucket=bucket_name)
+                files_[fi] = target_file
+            else:
+                keys.append(item)
+        if not keys:
+            return
+
+        downloaded = downloader.download([
+            (bucket_name, remote_key, target_file)
+            for fi, file_, bucket_name, remote_key, target_file in keys])
+        for (fi, file_, bucket_name, remote_key, target_file), out_file in \
+                zip(keys, downloaded):
+            if out_file is not None:
+                manifest.add(file_, url=remote_key, bucket=bucket_name,
+                             etag=downloader.etags.get(out_file))
+                files_[fi] = out_file
+
+
+def _check_mode(check):
+    """Normalize the check argument of AmazonS3Fetcher.fetch."""
+    if check is True:
+        return 'size'
+    if not check:
+        return False
+    if check not in CHECK_MODES:
+        raise ValueError("Unknown check mode %r; use one of %s" % (
+            check, (False, True) + CHECK_MODES))
+    return check
+
+
+def _check_recorded_etag(manifest, file_):
+    """Tell whether file_, recorded in manifest with an unchanged size and
+    mtime, matches the ETag recorded with it. False if no ETag was
+    recorded: the file must then be checked against its S3 object."""
+    etag = (manifest.get(file_).get('etag') or '').strip('"')
+    if not etag:
+        return False
+    if '-' in etag:
+        return True  # uploaded in parts: not an md5 sum; size only.
+    md5sum = manifest.get_digest(file_, 'md5')
+    if md5sum is None:
+        md5sum = hash_file(op.join(manifest.data_dir, file_), 'md5')
+        manifest.set_digest(file_, 'md5', md5sum)
+    return md5sum == etag
+
+
+def check_s3_file(target_file, get_key, mode='size'):
+    """Tell whether a downloaded file is a valid copy of its S3 object.
+
+    Parameters
+    ----------
+    target_file: string
+        Local copy of the object.
+
+    get_key: callable
+        Returns the S3 key of the object; only called if remote metadata
+        are needed.
+
+    mode: string, optional
+        One of CHECK_MODES:
+        'size': the file has the size of the object.
+        'etag': the md5 sum of the file matches the ETag of the object
+        (objects uploaded in parts have no md5 ETag, only their size is
+        compared).
+        'header': the file is a readable neuroimage, and is not truncated
+        (uncompressed images only); files that are not images get the
+        'size' check.
+        'full': as 'header', and the image data can be entirely read.
+    """
+    if not op.exists(target_file):
+        return False
+
+    if mode in ('header', 'full'):
+        try:
+            img = nib.load(target_file)
+        except ImageFileError:
+            mode = 'size'  # not an image
+        except Exception:
+            return False
+        else:
+            if mode == 'full':
+                try:
+                    np.asanyarray(img.dataobj)
+                except Exception:
+                    return False
+                return True
+            return _has_data_size(img)
+
+    key = get_key()
+    if not key or op.getsize(target_file) != key.size:
+        return False
+    etag = (getattr(key, 'etag', None) or '').strip('"')
+    if mode == 'etag' and etag and '-' not in etag:
+        return hash_file(target_file, 'md5') == etag
+    return True
+
+
+def _has_data_size(img):
+    """Tell whether an uncompressed image file is large enough to hold the
+    data its header describes."""
+    proxy = img.dataobj
+    image_file = img.file_map['image'].filename
+    if (image_file is None or image_file.endswith(('.gz', '.bz2')) or
+            not hasattr(proxy, 'offset')):
+        return True  # cannot tell without decompressing
+    data_size = int(np.prod(proxy.shape)) * np.dtype(proxy.dtype).itemsize
+    try:
+        return op.getsize(image_file) >= proxy.offset + data_size
+    except OSError:
+        return False
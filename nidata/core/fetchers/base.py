@@ -6,16 +6,34 @@ Utilities to download NeuroImaging datasets
 # License: simplified BSD
 
 import collections
+import errno
 import hashlib
 import os
 import os.path as op
+import shutil
 import sys
 import time
 
 import numpy as np
 from six import string_types
 
+from .._utils.compat import Iterable
 from ..objdep import ClassWithDependencies
+from .events import EventBus
+
+
+class FetchError(IOError):
+    """ Raised when some files could not be fetched, after all the others
+    were.
+
+    Attributes
+    ----------
+    failures: list of (string, Exception)
+        Url of each failed download, and its last error.
+    """
+    def __init__(self, message, failures=()):
+        super(FetchError, self).__init__(message)
+        self.failures = list(failures)
 
 
 def format_time(t):
@@ -25,17 +43,163 @@ def format_time(t):
         return " %5.1fs" % (t)
 
 
-def md5_sum_file(path):
-    """ Calculates the MD5 sum of a file.
+# Checksum algorithms supported for downloaded files.
+HASH_ALGORITHMS = ('md5', 'sha256', 'blake2b')
+
+# Files are hashed in reads of this size (in bytes).
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Minimum interval between two progress reports (in seconds).
+REPORT_INTERVAL = 0.2
+
+
+def new_hasher(algorithm='md5'):
+    """ Returns a hashlib object for one of HASH_ALGORITHMS.
+    """
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError("Unsupported hash algorithm %s; use one of %s" % (
+            algorithm, HASH_ALGORITHMS))
+    return hashlib.new(algorithm)
+
+
+def parse_checksum(checksum):
+    """ Splits a checksum given as 'algorithm:hexdigest' (or a plain MD5
+    hexdigest) into an (algorithm, hexdigest) pair.
     """
+    algorithm, _, digest = checksum.rpartition(':')
+    return (algorithm or 'md5').lower(), digest.lower()
+
+
+def hash_file(path, algorithm='md5', hasher=None,
+              chunk_size=HASH_CHUNK_SIZE):
+    """ Calculates the checksum of a file.
+
+    Parameters
+    ----------
+    path: string
+        File to hash.
+
+    algorithm: string, optional
+        One of HASH_ALGORITHMS. Default: 'md5'
+
+    hasher: hashlib object, optional
+        If given, the file contents are added to it (algorithm is then
+        ignored); useful to hash the beginning of a partial download.
+
+    Returns
+    -------
+    digest: string
+        Hexadecimal digest.
+    """
+    if hasher is None:
+        hasher = new_hasher(algorithm)
+    # Large reads into a single buffer; hashlib releases the GIL on them,
+    # so files can be hashed in parallel threads.
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
     with open(path, 'rb') as f:
-        m = hashlib.md5()
         while True:
-            data = f.read(8192)
-            if not data:
+            n_bytes = f.readinto(buf)
+            if not n_bytes:
                 break
-            m.update(data)
-    return m.hexdigest()
+            hasher.update(view[:n_bytes])
+    return hasher.hexdigest()
+
+
+def copy_file(src, dst):
+    """ Copies the contents of src to dst.
+
+    Where available (Linux, Python 3.8+), os.copy_file_range copies the
+    data inside the kernel, and lets filesystems that support it (btrfs,
+    XFS, NFS 4.2...) share extents instead of copying them. Other systems
+    use shutil.copyfile (itself zero-copy on recent Pythons).
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range is None:
+        shutil.copyfile(src, dst)
+        return
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            while copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                  HASH_CHUNK_SIZE * 64):
+                pass
+            return
+        except OSError as exc:
+            # Not supported between these files: copy them in user space.
+            if exc.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                 errno.EOPNOTSUPP, errno.EBADF):
+                raise
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst, HASH_CHUNK_SIZE)
+
+
+def md5_sum_file(path):
+    """ Calculates the MD5 sum of a file.
+    """
+    return hash_file(path, 'md5')
+
+
+def verify_files(data_dir, files, max_workers=4, verbose=1):
+    """ Checks the checksums of files, in parallel.
+
+    Digests are cached in the download manifest of data_dir, along with
+    the size and mtime of each file, so files that did not change since
+    they were last verified are not read again. If data_dir is not
+    writable, files are verified all the same, but nothing is cached.
+
+    Parameters
+    ----------
+    data_dir: string
+        Directory of the dataset.
+
+    files: list of (string, string)
+        Path of each file (relative to data_dir) and expected checksum, as
+        'algorithm:hexdigest' or a plain MD5 hexdigest.
+
+    max_workers: int, optional
+        Number of files hashed concurrently. Default: 4
+
+    Returns
+    -------
+    failed: list of string
+        Files that are missing, or do not match their checksum.
+    """
+    from multiprocessing.pool import ThreadPool
+    from .manifest import DownloadManifest  # avoid circular import
+
+    manifest = DownloadManifest(data_dir)
+
+    def verify(file_checksum):
+        file_, checksum = file_checksum
+        algorithm, expected = parse_checksum(checksum)
+        digest = manifest.get_digest(file_, algorithm)
+        if digest is None:
+            try:
+                digest = hash_file(op.join(data_dir, file_), algorithm)
+            except (IOError, OSError):
+                return False
+            manifest.set_digest(file_, algorithm, digest)
+        if digest != expected and verbose > 0:
+            print("Checksum verification failed for %s." % file_)
+        return digest == expected
+
+    if max_workers > 1 and len(files) > 1:
+        pool = ThreadPool(min(max_workers, len(files)))
+        try:
+            verified = pool.map(verify, files, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        verified = [verify(file_checksum) for file_checksum in files]
+    try:
+        manifest.save()
+    except (IOError, OSError):
+        pass  # e.g. a read-only install; digests are only a cache.
+    return [file_ for (file_, checksum), ok in zip(files, verified)
+            if not ok]
 
 
 def readmd5_sum_file(path):
@@ -79,7 +243,7 @@ def _filter_column(array, col, criteria):
     if (not isinstance(criteria, string_types) and
         not isinstance(criteria, bytes) and
         not isinstance(criteria, tuple) and
-            isinstance(criteria, collections.Iterable)):
+            isinstance(criteria, Iterable)):
 
         filter = np.zeros(array.shape[0], dtype=np.bool)
         for criterion in criteria:
@@ -172,15 +336,48 @@ def chunk_report(bytes_so_far, total_size, initial_size, t0):
                format_time(time_remaining)))
 
 
+class ProgressReport(object):
+    """Shows download progress with chunk_report, at most once every
+    interval seconds, however often it is called."""
+
+    def __init__(self, total_size=None, initial_size=0, t0=None,
+                 interval=REPORT_INTERVAL):
+        self.total_size = total_size
+        self.initial_size = initial_size
+        self.t0 = time.time() if t0 is None else t0
+        self.interval = interval
+        self.last_report = 0.
+
+    def __call__(self, bytes_so_far, force=False):
+        now = time.time()
+        if force or now - self.last_report >= self.interval:
+            self.last_report = now
+            chunk_report(bytes_so_far, self.total_size, self.initial_size,
+                         self.t0)
+
+
 class Fetcher(ClassWithDependencies):
     dependencies = []
 
     def __init__(self, data_dir=None, verbose=1):
         self.data_dir = data_dir or os.environ.get('NIDATA_PATH',
                                                    'nidata_data')
+        # Progress of fetches, as structured events; see add_listener.
+        self.events = EventBus()
         if verbose > 0 and not op.exists(self.data_dir):
             print("Files will be downloaded to %s" % self.data_dir)
 
+    def add_listener(self, listener):
+        """ Call listener(event) on each event of the fetches of this
+        fetcher, e.g. an EventLog, a JsonLinesExporter or a
+        PrometheusExporter; see nidata.core.fetchers.events. Returns
+        listener.
+        """
+        return self.events.add_listener(listener)
+
+    def remove_listener(self, listener):
+        self.events.remove_listener(listener)
+
     @classmethod
     def reformat_files(cls, files):
         """ Takes an iterable, and puts into the expected format of
@@ -199,7 +396,7 @@ class Fetcher(ClassWithDependencies):
                 else:
                     common_path = common_prefix
                 out_files.append((fil[len(common_path):], fil, dict()))
-            elif not isinstance(fil, collections.Iterable):
+            elif not isinstance(fil, Iterable):
                 raise ValueError("Unexpected format: %s" % str(fil))
             elif len(fil) == 2:  # assume src, dest
                 out_files.append((fil[0], fil[1], dict()))
@@ -211,3 +408,60 @@ class Fetcher(ClassWithDependencies):
 
     def fetch(self, files, force=False, check=False, verbose=1):
         raise NotImplementedError()
+
+    def plan(self, files, force=False, check=False, sizes=True,
+             max_workers=8, verbose=1):
+        """ Plan the fetch of files, without downloading anything.
+
+        Parameters
+        ----------
+        files, force, check:
+            As in fetch.
+
+        sizes: bool, optional
+            If True, the size of each file to download is requested from
+            the server (max_workers requests at a time). Otherwise, or if
+            the server does not tell, sizes are taken from the
+            'estimated_size' option of files, if any. Default: True
+
+        Returns
+        -------
+        plan: FetchPlan
+            The plan; its execute method fetches the files.
+        """
+        from .manifest import DownloadManifest  # avoid circular import
+        from .plan import FetchPlan, PlanEntry
+
+        files = self.reformat_files(files)
+        manifest = DownloadManifest(self.data_dir)
+        fetched = [not force and (
+            manifest.is_fetched(file_, url=url, check=bool(check)) or
+            op.exists(op.join(self.data_dir, file_)))
+            for file_, url, opts in files]
+
+        remote_sizes = dict()
+        if sizes:
+            pending = collections.OrderedDict()
+            for (file_, url, opts), is_fetched in zip(files, fetched):
+                if not is_fetched:
+                    pending.setdefault(url, opts)
+            remote_sizes = dict(zip(pending, self.get_sizes(
+                list(pending.items()), max_workers=max_workers,
+                verbose=verbose)))
+
+        entries = []
+        for (file_, url, opts), is_fetched in zip(files, fetched):
+            size = remote_sizes.get(url)
+            if size is None:
+                size = opts.get('estimated_size')
+            entries.append(PlanEntry(file_, url, opts, size, is_fetched))
+        plan = FetchPlan(self, entries, force=force, check=check)
+        if verbose > 0:
+            print('Planned %s' % plan)
+        return plan
+
+    def get_sizes(self, urls, max_workers=8, verbose=1):
+        """ Return the sizes (in bytes) of remote files, given as (url,
+        options) pairs; None for files of unknown size.
+        """
+        return [None] * len(urls)
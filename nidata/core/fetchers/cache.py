@@ -0,0 +1,297 @@
+"""
+Content-addressed store of downloaded files, shared by datasets and users.
+
+Downloads are stored once under a root directory, keyed by their md5 sum
+when it is known and by a hash of their url otherwise, and hardlinked (or
+copied, across filesystems) into dataset directories. The least recently
+used files are evicted when the store grows over a byte budget.
+
+The store is enabled by the NIDATA_CACHE_DIR environment variable; its
+budget is set by NIDATA_CACHE_SIZE (bytes, or a number with a K, M, G or T
+suffix).
+
+A hardlinked dataset file shares its inode with the stored file, so it must
+be treated as read-only: writing to it in place changes the stored file
+too, and every dataset linked to it. Replace such a file (write a new file
+and rename it over the old one) instead of modifying it.
+
+An ImageCache keeps decompressed copies of gzipped images in a BlobStore,
+keyed by the md5 sum of the compressed file, so that they can be memory
+mapped instead of being inflated on every load. It is enabled by the
+NIDATA_IMAGE_CACHE_DIR and NIDATA_IMAGE_CACHE_SIZE environment variables.
+"""
+
+import errno
+import gzip
+import hashlib
+import os
+import os.path as op
+import shutil
+import threading
+import time
+
+from .base import HASH_CHUNK_SIZE, copy_file, md5_sum_file
+from .manifest import _JsonIndex
+
+_SIZE_UNITS = dict(K=1024, M=1024 ** 2, G=1024 ** 3, T=1024 ** 4)
+
+# Eviction brings a store down to this fraction of its budget, so that it is
+# not walked again on the next put.
+_EVICT_TO = 0.9
+
+
+def parse_size(size):
+    """Return a number of bytes, from an int or a string like '20G'."""
+    if size is None or isinstance(size, int):
+        return size
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in _SIZE_UNITS:
+        return int(float(size[:-1]) * _SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+def _link_or_copy(src, dst):
+    """Hardlink src to dst, or copy it when a link cannot be made (e.g.
+    different filesystems). dst is replaced atomically."""
+    tmp_dst = '%s.%d.%d.tmp' % (dst, os.getpid(),
+                                threading.current_thread().ident)
+    try:
+        os.link(src, tmp_dst)
+    except (OSError, AttributeError):  # no os.link on Windows with python 2
+        copy_file(src, tmp_dst)
+    try:
+        os.rename(tmp_dst, dst)
+    except OSError:
+        os.remove(tmp_dst)
+        raise
+
+
+class BlobStore(object):
+    """Shared, content-addressed store of downloaded files.
+
+    Parameters
+    ----------
+    root: string
+        Directory of the store. It may be shared by many users, if they can
+        all write to it.
+
+    max_bytes: int or string, optional
+        Size budget of the store; least recently used files are evicted
+        beyond it. Default: None (unbounded)
+
+    Notes
+    -----
+    The size of the store is computed once, then kept up to date with the
+    files put by this instance; the store is only walked again when that
+    total goes over budget. Files put by other processes are accounted for
+    at that point.
+    """
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.max_bytes = parse_size(max_bytes)
+        self._lock = threading.Lock()
+        self._total = None  # bytes stored, when known
+
+    @classmethod
+    def from_environ(cls):
+        """Return the store configured by NIDATA_CACHE_DIR and
+        NIDATA_CACHE_SIZE, or None if there is none."""
+        root = os.environ.get('NIDATA_CACHE_DIR')
+        if not root:
+            return None
+        return cls(op.expanduser(root),
+                   max_bytes=os.environ.get('NIDATA_CACHE_SIZE') or None)
+
+    @staticmethod
+    def key(url=None, md5sum=None):
+        """Return the key of a file, from its md5 sum if it is known (then
+        files from different urls are shared), or else from its url."""
+        if md5sum:
+            return 'md5/' + md5sum.lower()
+        return 'url/' + hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        kind, digest = key.split('/')
+        return op.join(self.root, kind, digest[:2], digest)
+
+    def _touch(self, path):
+        # Keep track of use for eviction, in atime; mtime is left untouched
+        # because it is shared with (and recorded for) linked dataset files.
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except OSError:
+            pass  # evicted meanwhile, or owned by another user.
+
+    def get(self, key, dst):
+        """Link the file stored under key to dst; returns False if there is
+        no such file. dst must not be modified in place (see module
+        docstring)."""
+        path = self.path(key)
+        try:
+            _link_or_copy(path, dst)
+        except (IOError, OSError) as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return False
+        self._touch(path)
+        return True
+
+    def lookup(self, key):
+        """Return the path of the file stored under key, to be used in
+        place, or None if there is no such file."""
+        path = self.path(key)
+        if not op.exists(path):
+            return None
+        self._touch(path)
+        return path
+
+    def put(self, key, src):
+        """Store file src under key (src itself is left in place)."""
+        path = self.path(key)
+        if not op.exists(op.dirname(path)):
+            try:
+                os.makedirs(op.dirname(path))
+            except OSError:
+                if not op.isdir(op.dirname(path)):
+                    raise
+        try:
+            replaced = os.stat(path).st_size
+        except OSError:
+            replaced = 0
+        _link_or_copy(src, path)
+        if self.max_bytes is not None:
+            with self._lock:
+                if self._total is None:
+                    self._total = sum(blob[1] for blob in self.blobs())
+                else:
+                    self._total += os.stat(path).st_size - replaced
+                over_budget = self._total > self.max_bytes
+            if over_budget:
+                self.evict(keep=path)
+        return path
+
+    def blobs(self):
+        """Return (path, size, atime) of all stored files."""
+        blobs = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.tmp') or filename.startswith('.'):
+                    continue  # being written, or an index of the root
+                path = op.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                blobs.append((path, stat.st_size, stat.st_atime))
+        return blobs
+
+    def evict(self, keep=None):
+        """Remove least recently used files until the store fits in its
+        budget, with some room to spare. Files linked in dataset directories
+        stay there."""
+        with self._lock:
+            blobs = sorted(self.blobs(), key=lambda blob: blob[2])
+            total = sum(size for path, size, atime in blobs)
+            target = int(self.max_bytes * _EVICT_TO)
+            for path, size, atime in blobs:
+                if total <= target:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+            self._total = total
+
+
+class _SourceIndex(_JsonIndex):
+    """md5 sums of source files, keyed by absolute path, valid as long as
+    their size and mtime do not change."""
+    filename = '.nidata_sources.json'
+
+    def get_md5(self, path, stat):
+        entry = self.get(path)
+        if (entry is None or entry.get('size') != stat.st_size or
+                entry.get('mtime') != stat.st_mtime):
+            return None
+        return entry['md5']
+
+    def set_md5(self, path, stat, md5sum):
+        self._set(path, dict(size=stat.st_size, mtime=stat.st_mtime,
+                             md5=md5sum))
+
+
+class ImageCache(object):
+    """Cache of decompressed copies of gzipped images.
+
+    Copies are stored in a BlobStore, keyed by the md5 sum of the
+    compressed file: they are shared by all copies of an image, and
+    renewed when it changes. The md5 sums are recorded along with the size
+    and mtime of each source file, so an unchanged file is not read again.
+
+    Parameters
+    ----------
+    root: string
+        Directory of the cache.
+
+    max_bytes: int or string, optional
+        Size budget of the cache; least recently used copies are evicted
+        beyond it. Default: None (unbounded)
+    """
+    _instances = dict()
+
+    def __init__(self, root, max_bytes=None):
+        self.store = BlobStore(root, max_bytes=max_bytes)
+        self.sources = _SourceIndex(root)
+
+    @classmethod
+    def from_environ(cls):
+        """Return the cache configured by NIDATA_IMAGE_CACHE_DIR and
+        NIDATA_IMAGE_CACHE_SIZE, or None if there is none."""
+        root = os.environ.get('NIDATA_IMAGE_CACHE_DIR')
+        if not root:
+            return None
+        config = (op.expanduser(root),
+                  os.environ.get('NIDATA_IMAGE_CACHE_SIZE') or None)
+        if config not in cls._instances:
+            cls._instances[config] = cls(*config)
+        return cls._instances[config]
+
+    @staticmethod
+    def is_cacheable(path):
+        """Tell whether path is a gzipped, single-file image."""
+        return path.lower().endswith('.nii.gz')
+
+    def checksum(self, path):
+        """Return the md5 sum of file path."""
+        path = op.abspath(path)
+        stat = os.stat(path)
+        md5sum = self.sources.get_md5(path, stat)
+        if md5sum is None:
+            md5sum = md5_sum_file(path)
+            self.sources.set_md5(path, stat, md5sum)
+            self.sources.save()
+        return md5sum
+
+    def decompressed(self, path):
+        """Return the path of the decompressed copy of gzipped file path,
+        decompressing it if it is not in the cache."""
+        # The extension lets nibabel recognize the copy.
+        key = 'nii/%s.nii' % self.checksum(path)
+        cached = self.store.lookup(key)
+        if cached is not None:
+            return cached
+        if not op.isdir(self.store.root):
+            os.makedirs(self.store.root)
+        temp_file = op.join(self.store.root, 'nii.%d.%d.tmp' % (
+            os.getpid(), threading.current_thread().ident))
+        try:
+            with gzip.open(path, 'rb') as src:
+                with open(temp_file, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, HASH_CHUNK_SIZE)
+            return self.store.put(key, temp_file)
+        finally:
+            if op.exists(temp_file):
+                os.remove(temp_file)
@@ -0,0 +1,241 @@
+"""
+Structured events of fetches, for progress reports and metrics.
+
+Fetchers emit events on their EventBus (Fetcher.events); listeners are
+callables receiving each event, as a dict with an 'event' kind, a 'time'
+(seconds since the epoch) and kind-specific fields:
+
+'started'
+    url: a download starts.
+'retry'
+    url, attempt (1 for the first retry), error: a failed attempt is
+    retried.
+'fetched'
+    url, targets, seconds, bytes, rate (bytes per second), attempts,
+    cached, extracted_bytes (uncompressed from archives), and the seconds
+    spent in each of PHASES ('connect': until response headers are
+    received, 'transfer': reading the response and writing it to disk,
+    'hash': computing checksums, 'extract': uncompressing archives).
+'failed'
+    url, targets, seconds, attempts, error: a url could not be fetched.
+
+Listeners are called from the threads doing the downloads, one at a time.
+JsonLinesExporter and PrometheusExporter are listeners exporting events
+to dashboards.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import os.path as op
+import tempfile
+import threading
+import time
+import warnings
+
+from .._utils.compat import _urllib
+
+# Phases of the fetch of a url, timed separately.
+PHASES = ('connect', 'transfer', 'hash', 'extract')
+
+
+class FetchStats(object):
+    """Bytes downloaded and extracted, and seconds spent in each of
+    PHASES, while fetching a url."""
+
+    def __init__(self):
+        self.bytes = 0
+        self.extracted_bytes = 0
+        self.cached = False
+        self.seconds = collections.OrderedDict(
+            (phase, 0.) for phase in PHASES)
+
+    def add(self, phase, seconds):
+        self.seconds[phase] += seconds
+
+    @contextlib.contextmanager
+    def timing(self, phase):
+        """Context manager adding the time spent in its block to phase."""
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - t0)
+
+    def as_dict(self):
+        fields = dict(bytes=self.bytes, extracted_bytes=self.extracted_bytes,
+                      cached=self.cached)
+        fields.update(self.seconds)
+        return fields
+
+
+class EventBus(object):
+    """Dispatches events to listeners.
+
+    Errors of listeners are turned into warnings, so that a broken
+    exporter cannot abort a download.
+    """
+
+    def __init__(self):
+        self._listeners = []
+        self._lock = threading.RLock()
+
+    def add_listener(self, listener):
+        """Call listener(event) on each event; returns listener."""
+        with self._lock:
+            self._listeners.append(listener)
+        return listener
+
+    def remove_listener(self, listener):
+        with self._lock:
+            self._listeners.remove(listener)
+
+    def __bool__(self):
+        return bool(self._listeners)
+    __nonzero__ = __bool__
+
+    def emit(self, kind, **fields):
+        """Send an event of the given kind to all listeners."""
+        if not self._listeners:
+            return
+        event = dict(fields, event=kind, time=time.time())
+        if 'error' in event:
+            event['error'] = '%s: %s' % (type(event['error']).__name__,
+                                         event['error'])
+        with self._lock:
+            for listener in list(self._listeners):
+                try:
+                    listener(event)
+                except Exception as exc:
+                    warnings.warn('Fetch event listener %r failed: %s' % (
+                        listener, exc))
+
+
+class EventLog(list):
+    """Listener keeping all events, in order."""
+
+    def __call__(self, event):
+        self.append(event)
+
+    def of_kind(self, kind):
+        """Return the events of a kind."""
+        return [event for event in self if event['event'] == kind]
+
+
+class JsonLinesExporter(object):
+    """Listener writing each event as a line of JSON.
+
+    Parameters
+    ----------
+    fp: string or file
+        File to write to; paths are opened in append mode.
+    """
+
+    def __init__(self, fp):
+        self.owned = not hasattr(fp, 'write')
+        self.fp = open(fp, 'a') if self.owned else fp
+
+    def __call__(self, event):
+        self.fp.write(json.dumps(event, sort_keys=True, default=str) + '\n')
+        self.fp.flush()
+
+    def close(self):
+        if self.owned:
+            self.fp.close()
+
+
+class PrometheusExporter(object):
+    """Listener aggregating events into Prometheus metrics.
+
+    render() returns the metrics in the Prometheus text exposition format;
+    write(path) saves them atomically, e.g. for the textfile collector of
+    the node exporter.
+
+    Metrics
+    -------
+    nidata_fetch_urls_total{status}: urls fetched, or failed.
+    nidata_fetch_retries_total: retried attempts.
+    nidata_fetch_bytes_total{host}: bytes downloaded (cache hits excluded).
+    nidata_fetch_extracted_bytes_total: bytes uncompressed from archives.
+    nidata_fetch_seconds_total{phase}: seconds spent in each of PHASES.
+    nidata_fetch_in_flight: urls being fetched.
+    """
+    prefix = 'nidata_fetch'
+
+    def __init__(self):
+        self.urls = collections.Counter()
+        self.retries = 0
+        self.bytes = collections.Counter()
+        self.extracted_bytes = 0
+        self.seconds = collections.OrderedDict(
+            (phase, 0.) for phase in PHASES)
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        kind = event['event']
+        with self._lock:
+            if kind == 'started':
+                self.in_flight += 1
+            elif kind == 'retry':
+                self.retries += 1
+            elif kind in ('fetched', 'failed'):
+                self.in_flight = max(0, self.in_flight - 1)
+                self.urls[kind] += 1
+            if kind == 'fetched':
+                host = _urllib.parse.urlparse(event['url']).netloc
+                if not event.get('cached'):
+                    self.bytes[host or 'local'] += event.get('bytes', 0)
+                self.extracted_bytes += event.get('extracted_bytes', 0)
+                for phase in PHASES:
+                    self.seconds[phase] += event.get(phase, 0.)
+
+    def render(self):
+        """Return the metrics, in the Prometheus text format."""
+        def metric(name, kind, doc, samples):
+            name = '%s_%s' % (self.prefix, name)
+            lines = ['# HELP %s %s' % (name, doc),
+                     '# TYPE %s %s' % (name, kind)]
+            for labels, value in samples:
+                label_str = ','.join('%s="%s"' % (key, _escape(val))
+                                     for key, val in labels)
+                lines.append('%s%s %s' % (
+                    name, '{%s}' % label_str if label_str else '',
+                    repr(float(value))))
+            return lines
+
+        with self._lock:
+            lines = (
+                metric('urls_total', 'counter', 'Urls fetched, or failed.',
+                       [((('status', status),), self.urls[status])
+                        for status in ('fetched', 'failed')]) +
+                metric('retries_total', 'counter', 'Retried attempts.',
+                       [((), self.retries)]) +
+                metric('bytes_total', 'counter', 'Bytes downloaded.',
+                       [((('host', host),), n_bytes)
+                        for host, n_bytes in sorted(self.bytes.items())]) +
+                metric('extracted_bytes_total', 'counter',
+                       'Bytes uncompressed from archives.',
+                       [((), self.extracted_bytes)]) +
+                metric('seconds_total', 'counter',
+                       'Seconds spent in each phase of fetches.',
+                       [((('phase', phase),), seconds)
+                        for phase, seconds in self.seconds.items()]) +
+                metric('in_flight', 'gauge', 'Urls being fetched.',
+                       [((), self.in_flight)]))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Atomically write the metrics to path."""
+        fd, temp_path = tempfile.mkstemp(dir=op.dirname(op.abspath(path)),
+                                         suffix='.tmp')
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(self.render())
+        os.rename(temp_path, path)
+
+
+def _escape(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
@@ -1,48 +1,57 @@
 """
 """
 
+import collections
 import contextlib
+import json
 import os
 import os.path as op
+import re
 import tarfile
+import threading
 import zipfile
 import sys
 import shutil
+import subprocess
 import time
-import hashlib
 import fnmatch
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
-from .._utils.compat import cPickle, _urllib, md5_hash
-from .base import chunk_report, Fetcher, md5_sum_file
+from .._utils.compat import _urllib, md5_hash
+from .base import (copy_file, Fetcher, FetchError, hash_file, new_hasher,
+                   parse_checksum, ProgressReport)
+from .cache import BlobStore
+from .events import FetchStats
+from .plan import format_size
+from .http_pool import add_keep_alive_handler, HttpConnectionPool
+from .manifest import DownloadManifest, FailureJournal
+from .retry import HostRateLimiter, HTTP_ERRORS, RetryPolicy
+from .staging import commit_staged, get_staging_dir, recover_staged
 
+# Serializes moves into a dataset directory when downloading concurrently.
+_commit_lock = threading.RLock()
 
-def movetree(src, dst):
-    """Move an entire tree to another directory. Any existing file is
-    overwritten"""
-    names = os.listdir(src)
+# Segmented downloads never use segments smaller than this (in bytes).
+SEGMENT_MIN_SIZE = 8 * 1024 * 1024
 
-    # Create destination dir if it does not exist
-    if not op.exists(dst):
-        os.makedirs(dst)
-    errors = []
+# Responses are first read in chunks of CHUNK_SIZE bytes; chunks grow up to
+# MAX_CHUNK_SIZE while a read takes less than CHUNK_READ_TIME seconds.
+CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+CHUNK_READ_TIME = 0.05
 
-    for name in names:
-        srcname = op.join(src, name)
-        dstname = op.join(dst, name)
-        try:
-            if op.isdir(srcname) and op.isdir(dstname):
-                movetree(srcname, dstname)
-                os.rmdir(srcname)
-            else:
-                shutil.move(srcname, dstname)
-        except (IOError, os.error) as why:
-            errors.append((srcname, dstname, str(why)))
-        # catch the Error from the recursive movetree so that we can
-        # continue with other files
-        except Exception as err:
-            errors.extend(err.args[0])
-    if errors:
-        raise Exception(errors)
+# Threads decompressing the members of a zip archive.
+EXTRACT_WORKERS = min(8, multiprocessing.cpu_count())
+
+# Multi-threaded decompressors, by magic number of the files they handle;
+# the first one installed is used.
+PARALLEL_DECOMPRESSORS = ((b'\x1f\x8b', ('pigz', '-dc')),
+                          (b'BZh', ('pbzip2', '-dc')),
+                          (b'BZh', ('lbzip2', '-dc')))
+
+# Archives that can be extracted while they are downloaded.
+TAR_EXTENSIONS = ('.tar', '.tgz', '.tar.gz', '.tbz', '.tbz2', '.tar.bz2')
 
 
 def _tree(path, pattern=None, dictionary=False):
@@ -81,8 +90,9 @@ def _tree(path, pattern=None, dictionary=False):
     return dirs
 
 
-def _chunk_read_(response, local_file, chunk_size=8192, report_hook=None,
-                 initial_size=0, total_size=None, verbose=1):
+def _chunk_read_(response, local_file, chunk_size=CHUNK_SIZE,
+                 report_hook=None, initial_size=0, total_size=None, verbose=1,
+                 hasher=None, stats=None, max_chunk_size=MAX_CHUNK_SIZE):
     """Download a file chunk by chunk and show advancement
 
     Parameters
@@ -94,7 +104,7 @@ def _chunk_read_(response, local_file, chunk_size=8192, report_hook=None,
         Hard disk file where data should be written
 
     chunk_size: int, optional
-        Size of downloaded chunks. Default: 8192
+        Size of the first downloaded chunks. Default: CHUNK_SIZE
 
     report_hook: bool
         Whether or not to show downloading advancement. Default: None
@@ -108,11 +118,24 @@ def _chunk_read_(response, local_file, chunk_size=8192, report_hook=None,
     verbose: int, optional
         verbosity level (0 means no message).
 
-    Returns
-    -------
-    data: string
-        The downloaded file.
+    hasher: hashlib object, optional
+        If given, downloaded chunks are also added to it, so the checksum
+        of the file is computed without reading it again.
+
+    stats: FetchStats, optional
+        If given, the bytes read and the time spent reading and hashing are
+        added to it.
+
+    max_chunk_size: int, optional
+        Chunks double in size (up to max_chunk_size) while they are read
+        in less than CHUNK_READ_TIME / 2 seconds, and halve when they take
+        more than 2 * CHUNK_READ_TIME. Default: MAX_CHUNK_SIZE
 
+    Notes
+    -----
+    Responses are read with readinto into a single, reused buffer, and
+    progress is shown at most every REPORT_INTERVAL seconds; fast
+    transfers then take few Python iterations per second.
     """
     if total_size is None:
         total_size = response.info().get('Content-Length', '110000000').strip()
@@ -127,23 +150,197 @@ def _chunk_read_(response, local_file, chunk_size=8192, report_hook=None,
     bytes_so_far = initial_size
 
     t0 = time.time()
+    report = ProgressReport(total_size, initial_size, t0=t0)
+    readinto = getattr(response, 'readinto', None)
+    max_chunk_size = max(chunk_size, max_chunk_size)
+    view = memoryview(bytearray(max_chunk_size)) if readinto else None
+    hash_time = 0.
     while True:
-        chunk = response.read(chunk_size)
-        bytes_so_far += len(chunk)
+        t_read = time.time()
+        if readinto is not None:
+            n_bytes = readinto(view[:chunk_size])
+            chunk = view[:n_bytes]
+        else:
+            chunk = response.read(chunk_size)
+            n_bytes = len(chunk)
+        read_time = time.time() - t_read
+        bytes_so_far += n_bytes
 
-        if not chunk:
+        if not n_bytes:
             if report_hook:
+                report(bytes_so_far, force=True)
                 sys.stderr.write('\n')
             break
 
         local_file.write(chunk)
+        if hasher is not None:
+            t_hash = time.time()
+            hasher.update(chunk)
+            hash_time += time.time() - t_hash
         if report_hook:
-            chunk_report(bytes_so_far, total_size, initial_size, t0)
-
+            report(bytes_so_far)
+
+        # Adapt reads to the throughput of the connection.
+        if n_bytes == chunk_size and read_time < CHUNK_READ_TIME / 2:
+            chunk_size = min(2 * chunk_size, max_chunk_size)
+        elif read_time > 2 * CHUNK_READ_TIME and chunk_size > CHUNK_SIZE:
+            chunk_size //= 2
+
+    if stats is not None:
+        stats.bytes += bytes_so_far - initial_size
+        stats.add('hash', hash_time)
+        stats.add('transfer', time.time() - t0 - hash_time)
     return
 
 
-def _uncompress_file(file_, delete_archive=True, verbose=1):
+def _member_selector(members):
+    """Return a function telling whether an archive member must be
+    extracted: members lists requested paths (files or directories); None
+    selects everything."""
+    if members is None:
+        return lambda name: True
+    requested = set(m.replace(os.sep, '/').strip('/') for m in members)
+
+    def is_requested(name):
+        parts = name.replace('\\', '/').strip('/').split('/')
+        if parts[0] == '.':
+            parts = parts[1:]
+        # Requested itself, or inside a requested directory.
+        return any('/'.join(parts[:pi]) in requested
+                   for pi in range(1, len(parts) + 1))
+    return is_requested
+
+
+def _zip_target(data_dir, name):
+    """Return the path a zip member is extracted to, as ZipFile.extract
+    sanitizes it (no absolute paths, no '..')."""
+    arcname = name.replace('/', os.sep)
+    if os.altsep:
+        arcname = arcname.replace(os.altsep, os.sep)
+    arcname = op.splitdrive(arcname)[1]
+    parts = [part for part in arcname.split(os.sep)
+             if part not in ('', os.curdir, os.pardir)]
+    return op.join(data_dir, *parts)
+
+
+def _extract_zip(file_, data_dir, is_requested, max_workers=None):
+    """Extract the requested members of a zip archive, decompressing them
+    on a pool of threads (zlib releases the GIL); returns the number of
+    bytes extracted."""
+    if max_workers is None:
+        max_workers = EXTRACT_WORKERS
+    with contextlib.closing(zipfile.ZipFile(file_)) as z:
+        infos = [info for info in z.infolist() if is_requested(info.filename)]
+    # Directories are created first, so workers never race to create them.
+    for info in infos:
+        target = _zip_target(data_dir, info.filename)
+        target_dir = (target if info.filename.endswith('/')
+                      else op.dirname(target))
+        if not op.isdir(target_dir):
+            os.makedirs(target_dir)
+    infos = [info for info in infos if not info.filename.endswith('/')]
+
+    if max_workers <= 1 or len(infos) <= 1:
+        with contextlib.closing(zipfile.ZipFile(file_)) as z:
+            for info in infos:
+                z.extract(info, data_dir)
+        return sum(info.file_size for info in infos)
+
+    # Each worker reads the archive through its own file object; the
+    # largest members go first, to balance the workers.
+    local = threading.local()
+    archives = []
+
+    def extract(info):
+        if not hasattr(local, 'zip'):
+            local.zip = zipfile.ZipFile(file_)
+            archives.append(local.zip)
+        local.zip.extract(info, data_dir)
+
+    infos.sort(key=lambda info: -info.compress_size)
+    pool = ThreadPool(min(max_workers, len(infos)))
+    try:
+        pool.map(extract, infos, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        for archive in archives:
+            archive.close()
+    return sum(info.file_size for info in infos)
+
+
+def _find_decompressor(header):
+    """Return the command line of a multi-threaded decompressor (writing to
+    stdout) for a file starting with header, or None if none is
+    installed."""
+    which = getattr(shutil, 'which', None)  # python 3.3+
+    if which is None:
+        return None
+    for magic, command in PARALLEL_DECOMPRESSORS:
+        if header.startswith(magic) and which(command[0]):
+            return list(command)
+    return None
+
+
+def _decompress_command(command, file_, out_fp):
+    """Run a decompressor command on file_, writing to out_fp."""
+    process = subprocess.Popen(command + [file_], stdout=out_fp)
+    if process.wait() != 0:
+        raise IOError("%s failed on %s (exit code %d)" % (
+            command[0], file_, process.returncode))
+
+
+def _select_members(tar, is_requested, extracted):
+    """Yield the requested members of a tarball, appending them to the
+    extracted list."""
+    for member in tar:
+        if is_requested(member.name):
+            extracted.append(member)
+            yield member
+
+
+def _members_size(members):
+    """Return the total size of the files among tar members."""
+    return sum(member.size for member in members if member.isfile())
+
+
+def _extract_tar(file_, data_dir, is_requested, header=b''):
+    """Extract the requested members of a tarball; returns the number of
+    bytes extracted.
+
+    Compressed tarballs are decompressed by a multi-threaded decompressor
+    (see PARALLEL_DECOMPRESSORS) if one is installed, and extracted as a
+    stream from its output; otherwise, by tarfile.
+    """
+    extracted = []
+    command = _find_decompressor(header)
+    if command is None:
+        # Compressed tarballs are decompressed on the fly, without writing
+        # an intermediate .tar file.
+        with contextlib.closing(tarfile.open(file_, "r:*")) as tar:
+            tar.extractall(path=data_dir, members=list(
+                _select_members(tar, is_requested, extracted)))
+    else:
+        process = subprocess.Popen(command + [file_], stdout=subprocess.PIPE)
+        try:
+            with contextlib.closing(tarfile.open(fileobj=process.stdout,
+                                                 mode='r|')) as tar:
+                # In stream mode, members must be extracted as they are read.
+                tar.extractall(path=data_dir, members=_select_members(
+                    tar, is_requested, extracted))
+            # Zero padding may follow the end of the tar archive.
+            while process.stdout.read(1024 * 1024):
+                pass
+        finally:
+            process.stdout.close()
+            if process.wait() != 0:
+                raise IOError("%s failed on %s (exit code %d)" % (
+                    command[0], file_, process.returncode))
+    return _members_size(extracted)
+
+
+def _uncompress_file(file_, delete_archive=True, verbose=1, members=None,
+                     max_workers=None, stats=None):
     """Uncompress files contained in a data_set.
 
     Parameters
@@ -158,61 +355,319 @@ def _uncompress_file(file_, delete_archive=True, verbose=1):
     verbose: int, optional
         verbosity level (0 means no message).
 
+    members: list of string, optional
+        Paths (relative to the archive root) of the files or directories to
+        extract from zip and tar archives; other members are skipped.
+        Default: None (extract everything)
+
+    max_workers: int, optional
+        Number of threads decompressing the members of zip archives.
+        Default: EXTRACT_WORKERS
+
+    stats: FetchStats, optional
+        If given, the time spent and the bytes extracted are added to it.
+
     Notes
     -----
-    This handles zip, tar, gzip and bzip files only.
+    This handles zip, tar, gzip and bzip files only. Gzip and bzip2 files
+    (and compressed tarballs) are decompressed by pigz, pbzip2 or lbzip2
+    when they are installed.
     """
     if verbose > 0:
         print('Extracting data from %s...' % file_)
     data_dir = op.dirname(file_)
+    t0 = time.time()
     # We first try to see if it is a zip file
     try:
         filename, ext = op.splitext(file_)
         with open(file_, "rb") as fd:
             header = fd.read(4)
-        processed = False
+        is_requested = _member_selector(members)
         if zipfile.is_zipfile(file_):
-            z = zipfile.ZipFile(file_)
-            z.extractall(data_dir)
-            z.close()
-            processed = True
+            n_bytes = _extract_zip(file_, data_dir, is_requested,
+                                   max_workers=max_workers)
+        elif tarfile.is_tarfile(file_):
+            n_bytes = _extract_tar(file_, data_dir, is_requested,
+                                   header=header)
         elif ext == '.gz' or header.startswith(b'\x1f\x8b'):
-            import gzip
-            gz = gzip.open(file_)
-            if ext == '.tgz':
-                filename = filename + '.tar'
-            out = open(filename, 'wb')
-            shutil.copyfileobj(gz, out, 8192)
-            gz.close()
-            out.close()
-
-            # If file is .tar.gz, this will be handle in the next case
-            if delete_archive:
-                os.remove(file_)
-            file_ = filename
-            filename, ext = op.splitext(file_)
-            processed = True
-
-        if tarfile.is_tarfile(file_):
-            with contextlib.closing(tarfile.open(file_, "r")) as tar:
-                tar.extractall(path=data_dir)
-            processed = True
-        if not processed:
+            command = _find_decompressor(header)
+            with open(filename, 'wb') as out:
+                if command is not None:
+                    _decompress_command(command, file_, out)
+                else:
+                    import gzip
+                    with contextlib.closing(gzip.open(file_)) as gz:
+                        shutil.copyfileobj(gz, out, CHUNK_SIZE)
+            n_bytes = op.getsize(filename)
+        else:
             raise IOError("[Uncompress] unknown archive file format: "
                           "%s" % file_)
         if delete_archive:
             os.remove(file_)
+        dt = time.time() - t0
+        if stats is not None:
+            stats.add('extract', dt)
+            stats.extracted_bytes += n_bytes
         if verbose > 0:
-            print('   ...done.')
+            print('   ...done. (%s at %s/s)' % (
+                format_size(n_bytes), format_size(n_bytes / max(dt, 1e-6))))
     except Exception as e:
         if verbose > 0:
             print('Error uncompressing file: %s' % e)
         raise
 
 
+def _get_url_opener(url, username=None, passwd=None, handlers=(),
+                    connection_pool=None):
+    """Build the urllib opener used to download url."""
+    handlers = list(handlers)
+    if username:
+        # Make sure we're secure, basic auth is unencrypted
+        scheme = _urllib.parse.urlparse(url).scheme
+        if scheme and scheme != 'https':
+            raise ValueError("Specifying username currently requires using"
+                             " a secure (https) URL (%s)." % url)
+        password_mgr = _urllib.request.HTTPPasswordMgrWithDefaultRealm()
+        password_mgr.add_password(None, url, username, passwd)
+        handlers = ([_urllib.request.HTTPBasicAuthHandler(password_mgr)] +
+                    handlers)
+    if connection_pool is not None:
+        handlers = add_keep_alive_handler(handlers, connection_pool)
+    return _urllib.request.build_opener(*handlers)
+
+
+def _get_file_name(url):
+    """Return the name under which url is downloaded."""
+    parse = _urllib.parse.urlparse(url)
+    file_name = op.basename(parse.path)
+    if file_name == '':
+        file_name = md5_hash(parse.path)
+    return file_name
+
+
+def _make_request(url, headers=None, cookies=None):
+    """Prepare a request for url, with extra headers and cookies."""
+    headers = dict(headers or dict())
+    request = _urllib.request.Request(url)
+    request.add_header('Connection', 'Keep-Alive')
+    if cookies:
+        if 'Cookie' in headers:
+            headers['Cookie'] += ';'
+        else:
+            headers['Cookie'] = ''
+        headers['Cookie'] += ';'.join(['%s=%s' % (k, v)
+                                       for k, v in cookies.items()])
+    for header_name, header_val in headers.items():
+        request.add_header(header_name, header_val)
+    return request
+
+
+def _get_range_size(url_opener, request):
+    """Return the size of the file behind request if the server answers
+    range requests for it, None otherwise."""
+    request.add_header('Range', 'bytes=0-0')
+    try:
+        data = url_opener.open(request)
+    except _urllib.error.HTTPError as e:
+        e.close()  # releases its (pooled) connection
+        return None
+    try:
+        if data.getcode() != 206:
+            return None  # The whole file is coming; don't read it.
+        match = re.match(r'bytes 0-0/(\d+)$',
+                         data.info().get('Content-Range') or '')
+        data.read()
+        return int(match.group(1)) if match else None
+    finally:
+        data.close()
+
+
+def _get_url_size(url, opts, connection_pool=None):
+    """Return the size of the file at url, from a HEAD request; None if the
+    server does not tell."""
+    url_opener = _get_url_opener(url, username=opts.get('username'),
+                                 passwd=opts.get('passwd'),
+                                 handlers=opts.get('handlers', []),
+                                 connection_pool=connection_pool)
+    request = _make_request(url, headers=opts.get('headers'),
+                            cookies=opts.get('cookies'))
+    request.get_method = lambda: 'HEAD'
+    try:
+        data = url_opener.open(request)
+    except _urllib.error.HTTPError as e:
+        e.close()  # releases its (pooled) connection
+        return None
+    except (_urllib.error.URLError, IOError):
+        return None
+    try:
+        length = data.info().get('Content-Length')
+        return int(length) if length is not None else None
+    finally:
+        data.close()
+
+
+def _save_segments(segments_file, state):
+    """Atomically write the state of a segmented download."""
+    with open(segments_file + '.tmp', 'w') as fp:
+        json.dump(state, fp)
+    os.rename(segments_file + '.tmp', segments_file)
+
+
+def _fetch_file_segments(url_opener, make_request, temp_full_name,
+                         n_segments, min_segment_size=None, resume=True,
+                         report_hook=False, verbose=1, stats=None):
+    """Download a file as concurrent byte ranges.
+
+    The file is preallocated to its full size, and every segment is written
+    in place by its own worker. Progress of each segment is kept in a
+    '.segments' sidecar file, so an interrupted download resumes every
+    segment where it stopped.
+
+    Parameters
+    ----------
+    url_opener: OpenerDirector
+        Opener used for all requests.
+
+    make_request: callable
+        Returns a new request for the file (without Range header).
+
+    temp_full_name: string
+        Path of the '.part' file to download to.
+
+    n_segments: int
+        Maximum number of segments.
+
+    stats: FetchStats, optional
+        If given, the bytes downloaded are added to it.
+
+    Returns
+    -------
+    segmented: bool
+        False if nothing was done, because the server does not support range
+        requests or the file is too small to be split.
+    """
+    if min_segment_size is None:
+        min_segment_size = SEGMENT_MIN_SIZE
+    segments_file = temp_full_name + '.segments'
+
+    state = None
+    if resume and op.exists(segments_file) and op.exists(temp_full_name):
+        try:
+            with open(segments_file, 'r') as fp:
+                state = json.load(fp)
+        except ValueError:
+            state = None
+        if state is not None and state['size'] != op.getsize(temp_full_name):
+            state = None
+
+    if state is None:
+        for path in (temp_full_name, segments_file):
+            if op.exists(path):
+                os.remove(path)
+        size = _get_range_size(url_opener, make_request())
+        if size is None:
+            return False
+        n_segments = min(n_segments, size // max(1, min_segment_size))
+        if n_segments <= 1:
+            return False
+        # Each segment is [first byte, last byte, next byte to download]
+        step = size // n_segments
+        bounds = [si * step for si in range(n_segments)] + [size]
+        state = dict(size=size,
+                     segments=[[bounds[si], bounds[si + 1] - 1, bounds[si]]
+                               for si in range(n_segments)])
+        with open(temp_full_name, 'wb') as fp:
+            fp.truncate(size)
+        _save_segments(segments_file, state)
+    elif verbose > 0:
+        print('Resuming segmented download of %s' % temp_full_name)
+
+    lock = threading.Lock()
+    size = state['size']
+    progress = dict(bytes=sum(seg[2] - seg[0] for seg in state['segments']))
+    initial_size = progress['bytes']
+    report = ProgressReport(size, initial_size)
+
+    def fetch_segment(segment):
+        start, end, offset = segment
+        if offset > end:
+            return
+        request = make_request()
+        request.add_header('Range', 'bytes=%d-%d' % (offset, end))
+        data = url_opener.open(request)
+        try:
+            content_range = data.info().get('Content-Range')
+            if (content_range is None or
+                    not content_range.startswith('bytes %d-' % offset)):
+                raise IOError('Server does not support range requests')
+            with open(temp_full_name, 'r+b') as fp:
+                fp.seek(offset)
+                last_save = time.time()
+                while offset <= end:
+                    chunk = data.read(min(65536, end - offset + 1))
+                    if not chunk:
+                        raise _urllib.error.URLError(
+                            'Connection closed after byte %d of segment '
+                            '%d-%d' % (offset, start, end))
+                    fp.write(chunk)
+                    offset += len(chunk)
+                    with lock:
+                        progress['bytes'] += len(chunk)
+                        if report_hook:
+                            report(progress['bytes'])
+                    if offset > end or time.time() - last_save > 1.:
+                        # Only record what has reached the file.
+                        fp.flush()
+                        last_save = time.time()
+                        with lock:
+                            segment[2] = offset
+                            _save_segments(segments_file, state)
+        finally:
+            data.close()
+
+    pool = ThreadPool(len(state['segments']))
+    try:
+        pool.map(fetch_segment, state['segments'], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        if report_hook:
+            report(progress['bytes'], force=True)
+            sys.stderr.write('\n')
+
+    if any(seg[2] <= seg[1] for seg in state['segments']):
+        raise IOError('Segmented download of %s is incomplete.'
+                      % temp_full_name)
+    os.remove(segments_file)
+    if stats is not None:
+        stats.bytes += progress['bytes'] - initial_size
+    return True
+
+
+def _expected_digest(md5sum=None, checksum=None):
+    """Return the (algorithm, hexdigest) a download must match, or None."""
+    if checksum is not None:
+        return parse_checksum(checksum)
+    if md5sum is not None:
+        return 'md5', md5sum.lower()
+    return None
+
+
+def _file_digests(opts):
+    """Return the digests given in the options of a file, by algorithm."""
+    digests = dict()
+    for checksum in (opts.get('md5sum'), opts.get('checksum')):
+        if checksum is not None:
+            algorithm, digest = parse_checksum(checksum)
+            digests[algorithm] = digest
+    return digests
+
+
 def _fetch_file(url, data_dir, resume=True, overwrite=False,
                 md5sum=None, username=None, passwd=None,
-                handlers=None, headers=None, cookies=None, verbose=1):
+                handlers=None, headers=None, cookies=None, verbose=1,
+                report_hook=None, connection_pool=None, n_segments=1,
+                min_segment_size=None, checksum=None, stats=None):
     """Load requested file, downloading it if needed or requested.
 
     Parameters
@@ -250,6 +705,29 @@ def _fetch_file(url, data_dir, resume=True, overwrite=False,
     verbose: int, optional
         verbosity level (0 means no message).
 
+    report_hook: bool, optional
+        Whether to show download progress. Default: verbose > 0
+
+    connection_pool: HttpConnectionPool, optional
+        If given, requests reuse the keep-alive connections of this pool.
+
+    n_segments: int, optional
+        If greater than 1 and the server supports range requests, the file is
+        downloaded as up to n_segments concurrent byte ranges. Default: 1
+
+    min_segment_size: int, optional
+        Minimum size of a segment, in bytes. Default: SEGMENT_MIN_SIZE
+
+    checksum: string, optional
+        Checksum of the file, as 'algorithm:hexdigest' with one of
+        HASH_ALGORITHMS (e.g. 'sha256:9f86d0...'). Takes precedence over
+        md5sum. The checksum is computed while the file downloads.
+
+    stats: FetchStats, optional
+        If given, the bytes downloaded and the time spent connecting,
+        transferring and hashing are added to it (segmented downloads
+        count as transfer only).
+
     Returns
     -------
     files: string
@@ -263,102 +741,130 @@ def _fetch_file(url, data_dir, resume=True, overwrite=False,
     if handlers is None:
         handlers = []
     if headers is None:
-        headers = dict(),
+        headers = dict()
     if cookies is None:
         cookies = dict()
+    if report_hook is None:
+        report_hook = verbose > 0
+    if stats is None:
+        stats = FetchStats()
 
     # Determine data path
     if not op.exists(data_dir):
         os.makedirs(data_dir)
 
     # Determine filename using URL
-    parse = _urllib.parse.urlparse(url)
-    file_name = op.basename(parse.path)
-    if file_name == '':
-        file_name = md5_hash(parse.path)
+    file_name = _get_file_name(url)
 
     temp_file_name = file_name + ".part"
     full_name = op.join(data_dir, file_name)
     temp_full_name = op.join(data_dir, temp_file_name)
+    segments_file = temp_full_name + '.segments'
     if op.exists(full_name):
         if overwrite:
             os.remove(full_name)
         else:
             return full_name
-    if op.exists(temp_full_name):
-        if overwrite:
-            os.remove(temp_full_name)
+    if overwrite:
+        for path in (temp_full_name, segments_file):
+            if op.exists(path):
+                os.remove(path)
     t0 = time.time()
     local_file = None
+    data = None
     initial_size = 0
+    expected = _expected_digest(md5sum, checksum)
+    hasher = None
 
     try:
         # Download data
-        if username:
-            # Make sure we're secure, basic auth is unencrypted
-            if parse.scheme and parse.scheme != 'https':
-                raise ValueError("Specifying username currently requires using"
-                                 " a secure (https) URL (%s)." % url)
-            password_mgr = _urllib.request.HTTPPasswordMgrWithDefaultRealm()
-            password_mgr.add_password(None, url, username, passwd)
-            # Don't append, don't want to update caller's list with this!
-            handlers = ([_urllib.request.HTTPBasicAuthHandler(password_mgr)] +
-                        handlers)
-        url_opener = _urllib.request.build_opener(*handlers)
+        url_opener = _get_url_opener(url, username=username, passwd=passwd,
+                                     handlers=handlers,
+                                     connection_pool=connection_pool)
 
         # Prep the request (add headers, cookies)
-        request = _urllib.request.Request(url)
-        request.add_header('Connection', 'Keep-Alive')
-        if cookies:
-            if 'Cookie' in headers:
-                headers['Cookie'] += ';'
-            else:
-                headers['Cookie'] = ''
-            headers['Cookie'] += ';'.join(['%s=%s' % (k, v)
-                                           for k, v in cookies.items()])
-        for header_name, header_val in headers.items():
-            request.add_header(header_name, header_val)
+        request = _make_request(url, headers=headers, cookies=cookies)
 
         if verbose > 0:
             displayed_url = url.split('?')[0] if verbose == 1 else url
             print('Downloading data from %s ...' % displayed_url)
-        if not resume or not op.exists(temp_full_name):
-            # Simple case: no resume
-            data = url_opener.open(request)
-            local_file = open(temp_full_name, "wb")
+
+        # Large files can be downloaded as several concurrent byte ranges.
+        # An interrupted segmented download must be resumed as such.
+        if op.exists(segments_file) or (
+                n_segments > 1 and not (resume and
+                                        op.exists(temp_full_name))):
+            with stats.timing('transfer'):
+                segmented = _fetch_file_segments(
+                    url_opener, lambda: _make_request(url, headers=headers,
+                                                      cookies=cookies),
+                    temp_full_name, n_segments=n_segments,
+                    min_segment_size=min_segment_size, resume=resume,
+                    report_hook=report_hook, verbose=verbose, stats=stats)
         else:
-            # Complex case: download has been interrupted, we try to resume it.
-            local_file_size = op.getsize(temp_full_name)
-            # If the file exists, then only download the remainder
-            request.add_header("Range", "bytes=%s-" % (local_file_size))
-            try:
-                data = url_opener.open(request)
-                content_range = data.info().get('Content-Range')
-                if (content_range is None or not content_range.startswith(
-                        'bytes %s-' % local_file_size)):
-                    raise IOError('Server does not support resuming')
-            except Exception:
-                # A wide number of errors can be raised here. HTTPError,
-                # URLError... I prefer to catch them all and rerun without
-                # resuming.
-                if verbose > 0:
-                    print('Resuming failed, try to download the whole file.')
-                return _fetch_file(
-                    url, data_dir, resume=False, overwrite=overwrite,
-                    md5sum=md5sum, username=username, passwd=passwd,
-                    handlers=handlers, headers=headers, cookies=cookies,
-                    verbose=verbose)
+            segmented = False
+        if not segmented:
+            if not resume or not op.exists(temp_full_name):
+                # Simple case: no resume
+                with stats.timing('connect'):
+                    data = url_opener.open(request)
+                local_file = open(temp_full_name, "wb")
             else:
+                # Complex case: download has been interrupted, we try to
+                # resume it.
+                local_file_size = op.getsize(temp_full_name)
+                # If the file exists, then only download the remainder
+                request.add_header("Range", "bytes=%s-" % (local_file_size))
+                resumed = False
+                try:
+                    with stats.timing('connect'):
+                        data = url_opener.open(request)
+                    content_range = data.info().get('Content-Range')
+                    if (content_range is None or
+                            not content_range.startswith(
+                                'bytes %s-' % local_file_size)):
+                        raise IOError('Server does not support resuming')
+                    resumed = True
+                except Exception:
+                    # A wide number of errors can be raised here. HTTPError,
+                    # URLError... I prefer to catch them all and rerun without
+                    # resuming.
+                    if verbose > 0:
+                        print('Resuming failed, try to download the whole '
+                              'file.')
+                finally:
+                    # The unread response holds a (pooled) connection.
+                    if not resumed and data is not None:
+                        data.close()
+                        data = None
+                if not resumed:
+                    return _fetch_file(
+                        url, data_dir, resume=False, overwrite=overwrite,
+                        md5sum=md5sum, username=username, passwd=passwd,
+                        handlers=handlers, headers=headers, cookies=cookies,
+                        verbose=verbose, report_hook=report_hook,
+                        connection_pool=connection_pool,
+                        n_segments=n_segments,
+                        min_segment_size=min_segment_size,
+                        checksum=checksum, stats=stats)
                 local_file = open(temp_full_name, "ab")
                 initial_size = local_file_size
 
-        # Download the file.
-        _chunk_read_(data, local_file, report_hook=(verbose > 0),
-                     initial_size=initial_size, verbose=verbose)
-
-        # temp file must be closed prior to the move
-        if not local_file.closed:
-            local_file.close()
+            if expected is not None:
+                hasher = new_hasher(expected[0])
+                if initial_size:
+                    # Resuming: hash what was downloaded before.
+                    with stats.timing('hash'):
+                        hash_file(temp_full_name, hasher=hasher)
+
+            # Download the file.
+            _chunk_read_(data, local_file, report_hook=report_hook,
+                         initial_size=initial_size, verbose=verbose,
+                         hasher=hasher, stats=stats)
+
+            # temp file must be closed prior to the move
+            if not local_file.closed:
+                local_file.close()
         shutil.move(temp_full_name, full_name)
         dt = time.time() - t0
         if verbose > 0:
@@ -380,15 +886,358 @@ def _fetch_file(url, data_dir, resume=True, overwrite=False,
     finally:
         if local_file is not None and not local_file.closed:
             local_file.close()
-    if md5sum is not None:
-        if (md5_sum_file(full_name) != md5sum):
+        if data is not None:
+            data.close()  # releases its connection, if not entirely read
+    if expected is not None:
+        algorithm, digest = expected
+        # Segments arrive out of order: hash them once complete.
+        with stats.timing('hash'):
+            digest_found = (hasher.hexdigest() if hasher is not None
+                            else hash_file(full_name, algorithm))
+        if digest_found != digest:
+            os.remove(full_name)  # do not leave it for the next fetch
             raise ValueError("File %s checksum verification has failed."
-                             " Dataset fetching aborted." % local_file)
+                             " Dataset fetching aborted." % full_name)
+    return full_name
+
+
+class _TeeReader(object):
+    """Read-only file object, copying whatever is read from fp to out_fp
+    (if any) and to hasher (if any)."""
+
+    def __init__(self, fp, out_fp=None, hasher=None, report_hook=False,
+                 total_size=None):
+        self.fp = fp
+        self.out_fp = out_fp
+        self.hasher = hasher
+        self.report_hook = report_hook
+        self.report = ProgressReport(total_size)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.fp.read() if size is None or size < 0 else \
+            self.fp.read(size)
+        if self.out_fp is not None:
+            self.out_fp.write(data)
+        if self.hasher is not None:
+            self.hasher.update(data)
+        self.bytes_read += len(data)
+        if self.report_hook and data:
+            self.report(self.bytes_read)
+        return data
+
+    def drain(self, chunk_size=1024 * 1024):
+        """Read (and copy) everything left in fp."""
+        while self.read(chunk_size):
+            pass
+
+
+def _is_tar_url(url):
+    """Return True if url points to a (possibly compressed) tarball."""
+    path = _urllib.parse.urlparse(url).path.lower()
+    return path.endswith(TAR_EXTENSIONS)
+
+
+def _fetch_file_streamed(url, data_dir, keep_archive=False, md5sum=None,
+                         username=None, passwd=None, handlers=None,
+                         headers=None, cookies=None, verbose=1,
+                         report_hook=None, connection_pool=None,
+                         members=None, checksum=None, stats=None):
+    """Download a tarball and extract it into data_dir as it arrives.
+
+    The response is decompressed (gzip or bz2) and extracted in tarfile
+    stream mode, so the archive never needs to be on disk.
+
+    Parameters
+    ----------
+    url: string
+        Url of a tarball (see _is_tar_url).
+
+    data_dir: string
+        Directory the archive is extracted to.
+
+    keep_archive: bool, optional
+        If True, the archive is also written to data_dir while it is
+        extracted.
+
+    members: list of string, optional
+        Files or directories to extract (see _uncompress_file). Other
+        members are decompressed, but never written.
+
+    stats: FetchStats, optional
+        If given, the bytes downloaded and the time spent connecting are
+        added to it; extraction overlaps the transfer, and is counted as
+        transfer.
+
+    Other parameters are those of _fetch_file.
+
+    Returns
+    -------
+    archive: string or None
+        Path of the archive, if keep_archive is True.
+    """
+    if report_hook is None:
+        report_hook = verbose > 0
+    if stats is None:
+        stats = FetchStats()
+    if not op.exists(data_dir):
+        os.makedirs(data_dir)
+    full_name = op.join(data_dir, _get_file_name(url))
+    temp_full_name = full_name + '.part'
+
+    url_opener = _get_url_opener(url, username=username, passwd=passwd,
+                                 handlers=handlers or [],
+                                 connection_pool=connection_pool)
+    if verbose > 0:
+        displayed_url = url.split('?')[0] if verbose == 1 else url
+        print('Downloading and extracting data from %s ...' % displayed_url)
+    t0 = time.time()
+    expected = _expected_digest(md5sum, checksum)
+    with stats.timing('connect'):
+        data = url_opener.open(_make_request(url, headers=headers,
+                                             cookies=cookies))
+    archive = open(temp_full_name, 'wb') if keep_archive else None
+    t_transfer = time.time()
+    try:
+        total_size = data.info().get('Content-Length')
+        stream = _TeeReader(data, out_fp=archive,
+                            hasher=expected and new_hasher(expected[0]),
+                            report_hook=report_hook,
+                            total_size=int(total_size) if total_size
+                            else None)
+        is_requested = _member_selector(members)
+        with contextlib.closing(tarfile.open(fileobj=stream,
+                                             mode='r|*')) as tar:
+            # In stream mode, members must be extracted as they are read.
+            extracted = []
+            tar.extractall(path=data_dir,
+                           members=_select_members(tar, is_requested,
+                                                   extracted))
+            stats.extracted_bytes += _members_size(extracted)
+        # Zero padding may follow the end of the tar archive.
+        stream.drain()
+        stats.bytes += stream.bytes_read
+    finally:
+        stats.add('transfer', time.time() - t_transfer)
+        data.close()
+        if archive is not None:
+            archive.close()
+        if report_hook:
+            sys.stderr.write('\n')
+
+    if expected is not None and stream.hasher.hexdigest() != expected[1]:
+        raise ValueError("File %s checksum verification has failed."
+                         " Dataset fetching aborted." % url)
+    if verbose > 0:
+        dt = time.time() - t0
+        print('...done. (%i seconds, %i min)' % (dt, dt // 60))
+    if not keep_archive:
+        return None
+    shutil.move(temp_full_name, full_name)
     return full_name
 
 
+def _get_temp_dir(data_dir, url):
+    """Return the sandbox (staging) directory in which url is downloaded."""
+    return get_staging_dir(data_dir, url)
+
+
+def _fetch_url_files(data_dir, url, entries, resume=True, force=False,
+                     verbose=1, delete_archive=True, report_hook=None,
+                     connection_pool=None, n_segments=1, stream=False,
+                     cache=None, stats=None):
+    """Fetch every target that comes from a single url.
+
+    Parameters
+    ----------
+    data_dir: string
+        Path of the dataset directory.
+
+    url: string
+        Url shared by all entries.
+
+    entries: list of (string, dict)
+        Target file (relative to data_dir) and options, as in fetch_files.
+
+    stats: FetchStats, optional
+        Filled with the bytes downloaded, and the time spent in each phase.
+
+    Notes
+    -----
+    Targets sharing a url also share a sandbox directory, so they must be
+    processed sequentially, by a single worker. The url is downloaded at
+    most once, and only the missing targets are extracted from archives
+    (unless the 'extract_all' option is set).
+    """
+    # There are two working directories here:
+    # - data_dir is the destination directory of the dataset
+    # - temp_dir is a temporary directory dedicated to this fetching call.
+    #   All files that must be downloaded will be in this directory. If a
+    #   corrupted file is found, or a file is missing, this working
+    #   directory will be deleted.
+    temp_dir = _get_temp_dir(data_dir, url)
+
+    # 3 possibilities:
+    # - the file exists in data_dir, nothing to do.
+    # - the file does not exists: we download it in temp_dir
+    # - the file exists in temp_dir: this can happen if an archive has
+    #   been downloaded. There is nothing to do
+    missing = [file_ for file_, opts in entries
+               if force or not op.exists(op.join(data_dir, file_))]
+    if not missing:
+        return
+    # Targets coming from the same url share their download options.
+    opts = entries[0][1]
+    members = None if opts.get('extract_all') else missing
+
+    # The download may already be in the shared cache.
+    archive_name = op.join(temp_dir, _get_file_name(url))
+    cache_key = cache and cache.key(url=url, md5sum=opts.get('md5sum'))
+    cached = False
+    if (cache is not None and not force and not op.exists(archive_name) and
+            not op.exists(archive_name + '.part')):
+        if not op.exists(temp_dir):
+            os.makedirs(temp_dir)
+        cached = cache.get(cache_key, archive_name)
+        if cached and verbose > 0:
+            print('Found %s in %s' % (url, cache.root))
+        if cached and stats is not None:
+            stats.cached = True
+
+    # Tarballs can be extracted while they download, unless a previous
+    # download left (part of) the archive in the sandbox.
+    streamed = (opts.get('uncompress') and opts.get('stream', stream) and
+                _is_tar_url(url) and
+                not op.exists(archive_name) and
+                not op.exists(archive_name + '.part'))
+    if streamed:
+        # The archive is written to disk if it must be cached.
+        try:
+            fetched_file = _fetch_file_streamed(
+                url, temp_dir,
+                keep_archive=cache is not None or not delete_archive,
+                md5sum=opts.get('md5sum'), username=opts.get('username'),
+                passwd=opts.get('passwd'),
+                handlers=opts.get('handlers', []),
+                headers=opts.get('headers', dict()),
+                cookies=opts.get('cookies', dict()), verbose=verbose,
+                report_hook=report_hook, connection_pool=connection_pool,
+                members=members, checksum=opts.get('checksum'),
+                stats=stats)
+        except ValueError:
+            # Files extracted from a corrupted archive must not be kept.
+            shutil.rmtree(temp_dir)
+            raise
+    elif cached:
+        fetched_file = archive_name
+    else:
+        # Fetch the file, if it doesn't already exist.
+        fetched_file = _fetch_file(url, temp_dir,
+                                   resume=resume,
+                                   overwrite=force,
+                                   verbose=verbose,
+                                   md5sum=opts.get('md5sum'),
+                                   username=opts.get('username'),
+                                   passwd=opts.get('passwd'),
+                                   handlers=opts.get('handlers', []),
+                                   headers=opts.get('headers', dict()),
+                                   cookies=opts.get('cookies', dict()),
+                                   report_hook=report_hook,
+                                   connection_pool=connection_pool,
+                                   n_segments=opts.get('segments',
+                                                       n_segments),
+                                   checksum=opts.get('checksum'),
+                                   stats=stats)
+    if cache is not None and not cached and fetched_file is not None:
+        cache.put(cache_key, fetched_file)
+
+    _install_url_files(data_dir, temp_dir, fetched_file, missing, opts,
+                       extracted=streamed, delete_archive=delete_archive,
+                       members=members, verbose=verbose, stats=stats,
+                       url=url)
+
+
+def _install_url_files(data_dir, temp_dir, fetched_file, missing, opts,
+                       extracted=False, delete_archive=True, members=None,
+                       verbose=1, stats=None, url=None):
+    """Move the targets of a url from its sandbox into data_dir.
+
+    Parameters
+    ----------
+    fetched_file: string
+        File downloaded from the url, in the sandbox temp_dir.
+
+    missing: list of string
+        Targets to install (relative to data_dir).
+
+    opts: dict
+        Options of the targets, as in fetch_files.
+
+    extracted: bool, optional
+        If True, archives were already extracted to temp_dir.
+
+    stats: FetchStats, optional
+        If given, the time spent uncompressing and the bytes extracted are
+        added to it.
+
+    url: string, optional
+        Url of the targets, recorded in the commit journal.
+
+    Notes
+    -----
+    Targets are first laid out in temp_dir, which is then committed into
+    data_dir (see nidata.core.fetchers.staging).
+    """
+    # First, uncompress.
+    if opts.get('uncompress') and not extracted:
+        _uncompress_file(fetched_file, verbose=verbose,
+                         delete_archive=False, members=members, stats=stats)
+
+    if opts.get('move'):
+        raise NotImplementedError('Move options has been removed.')
+
+    # Let's examine our work: extracted targets are in temp_dir, a
+    # downloaded file may need to be renamed to its target. Targets are
+    # laid out in temp_dir as in data_dir...
+    renamed = [file_ for file_ in missing
+               if not op.exists(op.join(temp_dir, file_))]
+    # The downloaded file may itself be a target (e.g. the one named after
+    # the url): then it is copied to the others, and stays in place.
+    fetched_is_target = fetched_file is not None and any(
+        op.abspath(op.join(temp_dir, file_)) == op.abspath(fetched_file)
+        for file_ in missing)
+    for fi, file_ in enumerate(renamed):
+        target_file = op.join(temp_dir, file_)
+        if fetched_file is None or not op.exists(fetched_file):
+            raise Exception("An error occurred while fetching %s; "
+                            "the expected target file cannot be "
+                            "found. (%s)\nDebug info: %s" % (
+                                file_, target_file,
+                                {'fetched_file': fetched_file}))
+        target_dir = op.dirname(target_file)
+        if not op.exists(target_dir):
+            os.makedirs(target_dir)
+        if fi < len(renamed) - 1 or fetched_is_target:
+            copy_file(fetched_file, target_file)
+        else:
+            os.rename(fetched_file, target_file)
+
+    if (opts.get('uncompress') and delete_archive and
+            not fetched_is_target and
+            fetched_file is not None and op.exists(fetched_file)):
+        os.remove(fetched_file)
+
+    # ... and committed, with renames; data_dir is shared by all workers.
+    if op.exists(temp_dir):
+        with _commit_lock:
+            commit_staged(temp_dir, data_dir, url=url)
+
+
 def fetch_files(data_dir, files, resume=True, force=False, verbose=1,
-                delete_archive=True):
+                delete_archive=True, max_workers=1, max_per_host=None,
+                connection_pool=None, n_segments=1, stream=False,
+                check=False, cache=None, retry=None, rate_limiter=None,
+                fail_fast=True, events=None):
     """Load requested dataset, downloading it if needed or requested.
 
     This function retrieves files from the hard drive or download them from
@@ -407,8 +1256,12 @@ def fetch_files(data_dir, files, resume=True, force=False, verbose=1,
         List of files and their corresponding url. The dictionary contains
         options regarding the files. Options supported are 'uncompress' to
         indicates that the file is an archive, 'md5sum' to check the md5 sum of
-        the file and 'move' if renaming the file or moving it to a subfolder is
-        needed.
+        the file, 'checksum' to check it with another algorithm (as
+        'sha256:<hexdigest>' or 'blake2b:<hexdigest>'), 'segments' to
+        override n_segments for this file, 'stream' to override stream for
+        this file, 'extract_all' to extract whole archives rather than only
+        the requested targets and 'move' if renaming the file or moving it
+        to a subfolder is needed.
 
     data_dir: string, optional
         Path of the data directory. Used to force data storage in a specified
@@ -424,11 +1277,72 @@ def fetch_files(data_dir, files, resume=True, force=False, verbose=1,
     verbose: int, optional
         verbosity level (0 means no message).
 
+    max_workers: int, optional
+        Number of urls downloaded concurrently. Files sharing a url are
+        always handled by the same worker. Default: 1 (sequential)
+
+    max_per_host: int, optional
+        Maximum number of concurrent downloads against a single host.
+        Default: None (only bounded by max_workers)
+
+    connection_pool: HttpConnectionPool, optional
+        Pool of keep-alive connections, reused across files and workers.
+        Default: None (one connection per file)
+
+    n_segments: int, optional
+        Number of concurrent byte ranges used to download each large file,
+        when the server supports range requests. Default: 1
+
+    stream: bool, optional
+        If True, tarballs to uncompress are extracted while they are
+        downloaded, instead of being extracted from disk once downloaded.
+        The archive is then only written to disk if delete_archive is False.
+        Partially downloaded archives are still resumed from disk.
+        Default: False
+
+    check: bool, optional
+        Files recorded in the download manifest of data_dir are considered
+        present without touching the filesystem. If check is True, they are
+        also stat'ed, and fetched again if they changed or disappeared.
+        Default: False
+
+    cache: BlobStore, optional
+        Shared store of downloads: files found there are linked instead of
+        downloaded, and new downloads are added to it. Default: None
+
+    retry: RetryPolicy, optional
+        How failed urls are retried; retries resume partial downloads.
+        Default: None (no retry)
+
+    rate_limiter: HostRateLimiter, optional
+        Limits the rate of downloads started against each host.
+        Default: None
+
+    fail_fast: bool, optional
+        If True, the first url that fails (after retries) aborts the fetch.
+        Otherwise, all other urls are fetched first, and a FetchError lists
+        the failed ones. Either way, failures are recorded in the
+        FailureJournal of data_dir, until they succeed. Default: True
+
+    events: EventBus, optional
+        Bus on which the progress of each url is emitted (see
+        nidata.core.fetchers.events). Default: None
+
     Returns
     -------
     files: list of string
         Absolute paths of downloaded files on disk
     """
+    out_files = [op.join(data_dir, file_) for file_, url, opts in files]
+
+    # Files already fetched are found in the manifest, in a single read.
+    manifest = DownloadManifest(data_dir)
+    if not force:
+        files = [(file_, url, opts) for file_, url, opts in files
+                 if not manifest.is_fetched(file_, url=url, check=check)]
+        if not files:
+            return out_files
+
     # We may be in a global read-only repository. If so, we cannot
     # download files.
     if not os.access(data_dir, os.W_OK):
@@ -440,94 +1354,151 @@ def fetch_files(data_dir, files, resume=True, force=False, verbose=1,
     if not op.exists(data_dir):
         os.makedirs(data_dir)
 
-    files_ = []
-    for file_, url, opts in files:
-        # There are two working directories here:
-        # - data_dir is the destination directory of the dataset
-        # - temp_dir is a temporary directory dedicated to this fetching call.
-        #   All files that must be downloaded will be in this directory. If a
-        #   corrupted file is found, or a file is missing, this working
-        #   directory will be deleted.
-        files_pickle = cPickle.dumps(url)
-        files_md5 = hashlib.md5(files_pickle).hexdigest()
-        temp_dir = op.join(data_dir, files_md5)
-
-        # 3 possibilities:
-        # - the file exists in data_dir, nothing to do.
-        # - the file does not exists: we download it in temp_dir
-        # - the file exists in temp_dir: this can happen if an archive has been
-        #   downloaded. There is nothing to do
-
-        # Target file in the data_dir
-        target_file = op.join(data_dir, file_)
-
-        if force or not op.exists(target_file):
-            # if not op.exists(temp_target_dir):
-            #     os.makedirs(temp_target_dir)
-            # Fetch the file, if it doesn't already exist.
-            fetched_file = _fetch_file(url, temp_dir,
-                                       resume=resume,
-                                       overwrite=force,
-                                       verbose=verbose,
-                                       md5sum=opts.get('md5sum'),
-                                       username=opts.get('username'),
-                                       passwd=opts.get('passwd'),
-                                       handlers=opts.get('handlers', []),
-                                       headers=opts.get('headers', dict()),
-                                       cookies=opts.get('cookies', dict()))
-
-            # First, uncompress.
-            if opts.get('uncompress'):
-                target_files = _uncompress_file(fetched_file, verbose=verbose,
-                                                delete_archive=False)
-            else:
-                target_files = [fetched_file]
-
-            if opts.get('move'):
-                raise NotImplementedError('Move options has been removed.')
+    # Commits interrupted by a crash are finished first.
+    with _commit_lock:
+        recover_staged(data_dir, verbose=verbose)
 
-                # XXX: here, move is supposed to be a dir, it can be a name
-                move_dir = op.join(temp_dir, opts['move'])
-
-                if len(target_files) > 1:
-                    target_files = [op.join(op.dirname(move_dir),
-                                    op.basename(f))
-                                    for f in target_files]
-                    # Do the move
-                else:
-                    if not op.exists(move_dir):
-                        os.makedirs(move_dir)
-                    shutil.move(fetched_file, move_dir)
-                    target_files = [move_dir]
-
-            # Let's examine our work
-            if not op.exists(target_file):
-                if op.exists(fetched_file):
-                    target_dir = op.dirname(target_file)
-                    if not op.exists(target_dir):
-                        os.makedirs(target_dir)
-                    shutil.move(fetched_file, target_file)
-                else:
-                    raise Exception("An error occurred while fetching %s; "
-                                    "the expected target file cannot be found."
-                                    " (%s)\nDebug info: %s" % (
-                                        file_, target_file,
-                                        {'fetched_file': fetched_file,
-                                         'target_files': target_files}))
+    # Group targets by url, keeping the order in which urls were requested.
+    url_entries = collections.OrderedDict()
+    for file_, url, opts in files:
+        url_entries.setdefault(url, []).append((file_, opts))
 
-            if opts.get('uncompress') and delete_archive:
-                os.remove(fetched_file)
+    journal = FailureJournal(data_dir)
+    failures = []
 
-            # If needed, move files from temps directory to final directory.
-            if op.exists(temp_dir):
-                # XXX We could only moved the files requested
-                # XXX Movetree can go wrong
-                movetree(temp_dir, data_dir)
-                shutil.rmtree(temp_dir)
+    def record(url):
+        for file_, opts in url_entries[url]:
+            manifest.add(file_, url=url, digests=_file_digests(opts))
+        journal.remove(url)
 
-        files_.append(target_file)
+    def record_failure(url, exc):
+        failures.append((url, exc))
+        journal.record(url, [file_ for file_, opts in url_entries[url]],
+                       exc)
 
-    return files_
+    try:
+        _fetch_urls(data_dir, url_entries, record, resume=resume, force=force,
+                    verbose=verbose, delete_archive=delete_archive,
+                    max_workers=max_workers, max_per_host=max_per_host,
+                    connection_pool=connection_pool, n_segments=n_segments,
+                    stream=stream, cache=cache, retry=retry,
+                    rate_limiter=rate_limiter, fail_fast=fail_fast,
+                    failed_callback=record_failure, events=events)
+    finally:
+        # Keep track of what was fetched, even if some url failed.
+        manifest.save()
+        journal.save()
+
+    if failures:
+        raise FetchError(
+            "%d of %d urls could not be fetched (recorded in %s): %s" % (
+                len(failures), len(url_entries), journal.path,
+                '; '.join('%s (%s)' % (url, exc) for url, exc in failures)),
+            failures)
+    return out_files
+
+
+def _fetch_urls(data_dir, url_entries, done_callback, resume=True,
+                force=False, verbose=1, delete_archive=True, max_workers=1,
+                max_per_host=None, connection_pool=None, n_segments=1,
+                stream=False, cache=None, retry=None, rate_limiter=None,
+                fail_fast=True, failed_callback=None, events=None):
+    """Run _fetch_url_files on every url of url_entries, sequentially or
+    on a pool of threads, and call done_callback(url) as each one is
+    complete, or failed_callback(url, exc) if it failed (even after
+    retries). Unless fail_fast is True, a failure does not stop the other
+    urls. If given, events (an EventBus) receives the progress of each
+    url."""
+    # Per-host caps are shared by all workers of this call.
+    host_slots = dict()
+    if max_per_host is not None and max_workers > 1:
+        for url in url_entries:
+            host = _urllib.parse.urlparse(url).netloc
+            if host not in host_slots:
+                host_slots[host] = threading.BoundedSemaphore(max_per_host)
+    # Interleaved progress lines would be unreadable.
+    report_hook = None if max_workers <= 1 else False
+    # Set on the first failure, with fail_fast: urls not started are skipped.
+    stopped = threading.Event()
+
+    def attempt(url, state):
+        if state['attempts'] and events:
+            events.emit('retry', url=url, attempt=state['attempts'],
+                        error=state['error'])
+        state['attempts'] += 1
+        if rate_limiter is not None:
+            rate_limiter.wait(url)
+        # Retries resume partial downloads left by failed attempts.
+        try:
+            _fetch_url_files(data_dir, url, url_entries[url], resume=resume,
+                             force=force, verbose=verbose,
+                             delete_archive=delete_archive,
+                             report_hook=report_hook,
+                             connection_pool=connection_pool,
+                             n_segments=n_segments, stream=stream,
+                             cache=cache, stats=state['stats'])
+        except Exception as exc:
+            state['error'] = exc
+            raise
+
+    def fetch_url(url):
+        slot = host_slots.get(_urllib.parse.urlparse(url).netloc)
+        if slot is not None:
+            slot.acquire()
+        if stopped.is_set():
+            if slot is not None:
+                slot.release()
+            return
+        targets = [file_ for file_, opts in url_entries[url]]
+        state = dict(attempts=0, error=None, stats=FetchStats())
+        t0 = time.time()
+        if events:
+            events.emit('started', url=url, targets=targets)
+        try:
+            if retry is None:
+                attempt(url, state)
+            else:
+                retry.call(attempt, url, state)
+        except Exception as exc:
+            if events:
+                events.emit('failed', url=url, targets=targets,
+                            seconds=time.time() - t0,
+                            attempts=state['attempts'], error=exc)
+            if failed_callback is not None:
+                failed_callback(url, exc)
+            if fail_fast:
+                stopped.set()
+                raise
+            return
+        finally:
+            if slot is not None:
+                slot.release()
+        if events:
+            seconds = time.time() - t0
+            events.emit('fetched', url=url, targets=targets, seconds=seconds,
+                        rate=state['stats'].bytes / max(seconds, 1e-6),
+                        attempts=state['attempts'],
+                        **state['stats'].as_dict())
+        done_callback(url)
+
+    if max_workers <= 1 or len(url_entries) <= 1:
+        for url in url_entries:
+            fetch_url(url)
+    else:
+        pool = ThreadPool(min(max_workers, len(url_entries)))
+        try:
+            # Results are consumed as they come, so that the first failure
+            # is raised without waiting for the other urls.
+            for _ in pool.imap_unordered(fetch_url, list(url_entries),
+                                         chunksize=1):
+                pass
+        except Exception:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
 
 
 def copytree(src, dst, symlinks=False, ignore=None):
@@ -563,10 +1534,30 @@ def copytree(src, dst, symlinks=False, ignore=None):
 
 class HttpFetcher(Fetcher):
 
-    def __init__(self, data_dir=None, username=None, passwd=None):
+    def __init__(self, data_dir=None, username=None, passwd=None,
+                 max_workers=1, max_per_host=None, n_segments=1,
+                 stream=False, cache=None, max_retries=0, max_rate=None,
+                 fail_fast=True):
+        """
+        Failed urls are retried max_retries times (none by default), with
+        jittered exponential backoff (honouring Retry-After); max_rate caps
+        the number of downloads started per second against each host. If
+        fail_fast is False, urls that still fail are reported by a
+        FetchError once all others are fetched (see fetch_files).
+        """
         super(HttpFetcher, self).__init__(data_dir=data_dir)
         self.username = username
         self.passwd = passwd
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.n_segments = n_segments
+        self.stream = stream
+        self.connection_pool = HttpConnectionPool()
+        # Shared download store; configured from the environment by default.
+        self.cache = cache if cache is not None else BlobStore.from_environ()
+        self.max_retries = max_retries
+        self.rate_limiter = HostRateLimiter(max_rate) if max_rate else None
+        self.fail_fast = fail_fast
 
     def fetch(self, files, force=False, resume=True, check=False, verbose=1,
               delete_archive=True):
@@ -577,4 +1568,36 @@ class HttpFetcher(Fetcher):
                 opts['passwd'] = opts.get('passwd', self.username)
 
         return fetch_files(self.data_dir, files, resume=resume, force=force,
-                           verbose=verbose, delete_archive=delete_archive)
+                           verbose=verbose, delete_archive=delete_archive,
+                           max_workers=self.max_workers,
+                           max_per_host=self.max_per_host,
+                           connection_pool=self.connection_pool,
+                           n_segments=self.n_segments, stream=self.stream,
+                           check=check, cache=self.cache,
+                           retry=RetryPolicy(self.max_retries,
+                                             exceptions=HTTP_ERRORS,
+                                             verbose=verbose),
+                           rate_limiter=self.rate_limiter,
+                           fail_fast=self.fail_fast, events=self.events)
+
+    def get_sizes(self, urls, max_workers=8, verbose=1):
+        """Return the sizes of remote files, given as (url, options) pairs,
+        from concurrent HEAD requests; None where the server does not
+        tell."""
+        def get_size(url_opts):
+            url, opts = url_opts
+            if self.username is not None:
+                opts = dict(opts)
+                opts.setdefault('username', self.username)
+                opts.setdefault('passwd', self.passwd)
+            return _get_url_size(url, opts,
+                                 connection_pool=self.connection_pool)
+
+        if max_workers <= 1 or len(urls) <= 1:
+            return [get_size(url_opts) for url_opts in urls]
+        pool = ThreadPool(min(max_workers, len(urls)))
+        try:
+            return pool.map(get_size, urls, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
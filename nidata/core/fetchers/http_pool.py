@@ -0,0 +1,199 @@
+"""
+Persistent (keep-alive) HTTP connections for urllib.
+
+urllib opens a new connection for every request and forces a
+`Connection: close` header. KeepAliveHandler replaces the default http/https
+handlers of an opener, and reuses idle connections kept in an
+HttpConnectionPool, so repeated requests to a host share their TCP and TLS
+handshakes.
+"""
+
+import collections
+import socket
+import threading
+
+from six.moves import http_client
+
+from .._utils.compat import _urllib
+
+
+class HttpConnectionPool(object):
+    """Idle keep-alive connections, by host; shared across threads.
+
+    Parameters
+    ----------
+    max_idle_per_host: int, optional
+        Number of idle connections kept for each host. Extra connections are
+        closed when released.
+    """
+    def __init__(self, max_idle_per_host=8):
+        self.max_idle_per_host = max_idle_per_host
+        self.n_connections = 0  # total number of connections opened
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def acquire(self, key, factory):
+        """Return a (connection, reused) pair for key, creating a
+        connection with factory() if no idle one is available."""
+        with self._lock:
+            if self._idle[key]:
+                return self._idle[key].pop(), True
+            self.n_connections += 1
+        return factory(), False
+
+    def release(self, key, conn):
+        """Give an idle connection back to the pool."""
+        with self._lock:
+            if len(self._idle[key]) < self.max_idle_per_host:
+                self._idle[key].append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, collections.defaultdict(list)
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+class _PooledResponse(object):
+    """urllib-compatible response, which gives its connection back to the
+    pool as soon as the body has been entirely read."""
+
+    def __init__(self, response, conn, key, pool, url):
+        self._response = response
+        self._conn = conn
+        self._key = key
+        self._pool = pool
+        self.url = url
+        self.code = self.status = response.status
+        self.msg = response.reason  # urllib expects the reason in .msg
+        self._release_if_done()  # e.g. HEAD requests, empty bodies
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def info(self):
+        return self._response.msg
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        self._release_if_done()
+        return data
+
+    def readinto(self, b):
+        n_bytes = self._response.readinto(b)
+        self._release_if_done()
+        return n_bytes
+
+    def readline(self, limit=-1):
+        line = self._response.readline(limit)
+        self._release_if_done()
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def _release_if_done(self):
+        if self._conn is not None and self._response.isclosed():
+            conn, self._conn = self._conn, None
+            if self._response.will_close:
+                conn.close()
+            else:
+                self._pool.release(self._key, conn)
+
+    def close(self):
+        self._release_if_done()
+        if self._conn is not None:
+            # Unread data is left on the socket; it cannot be reused.
+            conn, self._conn = self._conn, None
+            self._response.close()
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class KeepAliveHandler(_urllib.request.HTTPHandler,
+                       _urllib.request.HTTPSHandler):
+    """urllib handler sending http and https requests over pooled
+    connections.
+
+    Parameters
+    ----------
+    pool: HttpConnectionPool, optional
+        Pool of connections to use. Default: a new pool.
+
+    context: ssl.SSLContext, optional
+        SSL context used for https connections.
+    """
+    def __init__(self, pool=None, context=None):
+        _urllib.request.AbstractHTTPHandler.__init__(self)
+        self.pool = pool if pool is not None else HttpConnectionPool()
+        self._context = context
+
+    def http_open(self, req):
+        return self._open(http_client.HTTPConnection, req)
+
+    def https_open(self, req):
+        conn_args = dict()
+        if self._context is not None:
+            conn_args['context'] = self._context
+        return self._open(http_client.HTTPSConnection, req, **conn_args)
+
+    def _open(self, http_class, req, **conn_args):
+        if getattr(req, '_tunnel_host', None):
+            # Proxy tunnels are not pooled.
+            return self.do_open(http_class, req, **conn_args)
+
+        host = req.host if hasattr(req, 'host') else req.get_host()
+        if not host:
+            raise _urllib.error.URLError('no host given')
+        key = (http_class.__name__, host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), val) for name, val in headers.items())
+        selector = (req.selector if hasattr(req, 'selector')
+                    else req.get_selector())
+
+        def new_connection():
+            return http_class(host, timeout=req.timeout, **conn_args)
+
+        while True:
+            conn, reused = self.pool.acquire(key, new_connection)
+            try:
+                conn.request(req.get_method(), selector, req.data, headers)
+                response = conn.getresponse()
+            except (socket.error, http_client.HTTPException) as err:
+                conn.close()
+                if reused:
+                    continue  # the server closed an idle connection.
+                raise _urllib.error.URLError(err)
+            break
+
+        return _PooledResponse(response, conn, key, self.pool,
+                               req.get_full_url())
+
+
+def add_keep_alive_handler(handlers, pool):
+    """Return handlers, with a KeepAliveHandler using pool appended, unless
+    the caller already customized http/https handling."""
+    for handler in handlers:
+        if isinstance(handler, (_urllib.request.HTTPHandler,
+                                _urllib.request.HTTPSHandler)):
+            return handlers
+    return list(handlers) + [KeepAliveHandler(pool)]
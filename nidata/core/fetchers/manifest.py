@@ -0,0 +1,183 @@
+"""
+Index of the files downloaded into a dataset directory.
+
+Checking that a dataset is already downloaded used to open (or list) every
+target, which is slow on network filesystems. A DownloadManifest keeps the
+target path, url, size, mtime and checksums of every fetched file in a single
+JSON file at the root of the dataset directory, so a fetch with nothing to do
+costs one read, and one existence check per target.
+
+A FailureJournal, next to it, keeps the urls that could not be fetched.
+"""
+
+import json
+import os
+import os.path as op
+import tempfile
+import threading
+import time
+
+
+class _JsonIndex(object):
+    """Entries, keyed by name, saved to a JSON file of data_dir.
+
+    Changes are kept in memory until save() is called; save() merges them
+    with the index on disk (which another process may have updated) and
+    replaces it atomically.
+    """
+    filename = None
+    version = 1
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.path = op.join(data_dir, self.filename)
+        self._lock = threading.RLock()
+        self._changes = dict()  # name => entry, or None when removed
+        self.entries = self._read()
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as fp:
+                index = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return dict()  # missing, unreadable or corrupted: start over
+        if index.get('version') != self.version:
+            return dict()
+        return index.get('files', dict())
+
+    def get(self, name):
+        """Return the entry of name, or None."""
+        with self._lock:
+            return self.entries.get(name)
+
+    def _set(self, name, entry):
+        with self._lock:
+            self.entries[name] = self._changes[name] = entry
+
+    def remove(self, name):
+        """Forget name."""
+        with self._lock:
+            if name in self.entries:
+                del self.entries[name]
+                self._changes[name] = None
+
+    def save(self):
+        """Write pending changes to disk, atomically."""
+        with self._lock:
+            if not self._changes:
+                return
+            entries = self._read()
+            for name, entry in self._changes.items():
+                if entry is None:
+                    entries.pop(name, None)
+                else:
+                    entries[name] = entry
+
+            if not op.exists(self.data_dir):
+                os.makedirs(self.data_dir)
+            fd, tmp_path = tempfile.mkstemp(dir=self.data_dir,
+                                            prefix=self.filename)
+            try:
+                with os.fdopen(fd, 'w') as fp:
+                    json.dump(dict(version=self.version, files=entries), fp)
+                os.rename(tmp_path, self.path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+            self.entries = entries
+            self._changes = dict()
+
+
+class DownloadManifest(_JsonIndex):
+    """Persistent index of the files fetched into data_dir.
+
+    Entries are keyed by target path, relative to data_dir.
+
+    Parameters
+    ----------
+    data_dir: string
+        Path of the dataset directory.
+    """
+    filename = '.nidata_manifest.json'
+
+    def is_fetched(self, file_, url=None, check=False):
+        """Tell whether target file_ was fetched (from url, if given), and
+        is still on disk.
+
+        If check is True, the file must also still have the size and mtime
+        it had when it was recorded.
+        """
+        entry = self.get(file_)
+        if entry is None or (url is not None and entry.get('url') != url):
+            return False
+        if not check:
+            return op.exists(op.join(self.data_dir, file_))
+        try:
+            stat = os.stat(op.join(self.data_dir, file_))
+        except OSError:
+            return False
+        return (entry.get('mtime') == stat.st_mtime and
+                entry.get('size') in (None, stat.st_size))
+
+    def add(self, file_, url=None, digests=None, **extra):
+        """Record that target file_ is on disk; returns its entry, or None
+        if the file does not exist.
+
+        digests maps hash algorithms to the (verified) hexdigests of the
+        file.
+        """
+        try:
+            stat = os.stat(op.join(self.data_dir, file_))
+        except OSError:
+            self.remove(file_)
+            return None
+        entry = dict(url=url, digests=dict(digests or ()),
+                     mtime=stat.st_mtime,
+                     # Directories (extracted archives) have no usable size.
+                     size=None if op.isdir(op.join(self.data_dir, file_))
+                     else stat.st_size)
+        entry.update(extra)
+        self._set(file_, entry)
+        return entry
+
+    def get_digest(self, file_, algorithm):
+        """Return the recorded digest of file_, if the file did not change
+        since it was recorded."""
+        entry = self.get(file_)
+        if entry is None or algorithm not in entry.get('digests', ()):
+            return None
+        if not self.is_fetched(file_, check=True):
+            return None
+        return entry['digests'][algorithm]
+
+    def set_digest(self, file_, algorithm, digest):
+        """Record the digest of file_, for its current size and mtime."""
+        entry = self.get(file_)
+        if entry is None or not self.is_fetched(file_, check=True):
+            entry = self.add(file_, url=entry and entry.get('url'))
+            if entry is None:
+                return
+        self._set(file_, dict(entry, digests=dict(entry.get('digests', ()),
+                                                  **{algorithm: digest})))
+
+
+class FailureJournal(_JsonIndex):
+    """Persistent record of the urls that could not be fetched into
+    data_dir, so that a batch can go on and report them at the end.
+
+    Entries are keyed by url, and give the targets of the url, the last
+    error, the number of failed fetches and the time of the last one.
+
+    Parameters
+    ----------
+    data_dir: string
+        Path of the dataset directory.
+    """
+    filename = '.nidata_failures.json'
+
+    def record(self, url, targets, error):
+        """Record that url (with its targets) failed with error."""
+        entry = self.get(url) or dict(n_failures=0)
+        self._set(url, dict(targets=list(targets), error=str(error),
+                            n_failures=entry['n_failures'] + 1,
+                            time=time.time()))
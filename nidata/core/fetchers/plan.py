@@ -0,0 +1,204 @@
+"""
+Plans of downloads: what a fetch would download, and how much.
+
+A FetchPlan is built by Fetcher.plan, before anything is downloaded; it can
+be inspected (number of files, bytes, free disk space), split into batches,
+and executed.
+"""
+
+import collections
+import os
+import os.path as op
+import shutil
+
+# A file of a plan. size is the size of the remote file (in bytes), or None
+# if unknown; fetched tells if the target is already on disk.
+PlanEntry = collections.namedtuple(
+    'PlanEntry', ['target', 'url', 'opts', 'size', 'fetched'])
+
+
+def format_size(n_bytes):
+    """Return a human readable size, e.g. '1.2 GB'."""
+    for unit, power in (('TB', 4), ('GB', 3), ('MB', 2), ('KB', 1)):
+        if n_bytes >= 1024 ** power:
+            return '%.1f %s' % (float(n_bytes) / 1024 ** power, unit)
+    return '%d B' % n_bytes
+
+
+def disk_free(path):
+    """Return the space available (in bytes) on the filesystem of path, or
+    of its closest existing parent."""
+    path = op.abspath(path)
+    while not op.exists(path):
+        path = op.dirname(path)
+    if hasattr(os, 'statvfs'):
+        stat = os.statvfs(path)
+        return stat.f_bavail * stat.f_frsize
+    return shutil.disk_usage(path).free
+
+
+class FetchPlan(object):
+    """Files a fetch would download.
+
+    Parameters
+    ----------
+    fetcher: Fetcher
+        Fetcher executing the plan.
+
+    entries: list of PlanEntry
+        All requested files, fetched or not, in the requested order.
+
+    force, check: optional
+        Passed to fetcher.fetch when the plan is executed.
+    """
+    def __init__(self, fetcher, entries, force=False, check=False):
+        self.fetcher = fetcher
+        self.entries = list(entries)
+        self.force = force
+        self.check = check
+
+    @property
+    def pending(self):
+        """Entries that remain to be downloaded."""
+        return [entry for entry in self.entries if not entry.fetched]
+
+    def _sizes_by_url(self):
+        # Targets extracted from the same archive are downloaded once.
+        sizes = collections.OrderedDict()
+        for entry in self.pending:
+            sizes.setdefault(entry.url, entry.size)
+        return sizes
+
+    @property
+    def n_bytes(self):
+        """Bytes to download, for the files of known size."""
+        return sum(size for size in self._sizes_by_url().values()
+                   if size is not None)
+
+    @property
+    def n_unknown(self):
+        """Number of files to download whose size is unknown."""
+        return sum(1 for size in self._sizes_by_url().values()
+                   if size is None)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __str__(self):
+        msg = '%d files to download (%d already fetched), %s' % (
+            len(self), len(self.entries) - len(self),
+            format_size(self.n_bytes))
+        if self.n_unknown:
+            msg += ' + %d files of unknown size' % self.n_unknown
+        return msg
+
+    def check_space(self, margin=0):
+        """Raise IOError if the files to download, plus margin bytes, do not
+        fit in the free space of the data directory."""
+        free = disk_free(self.fetcher.data_dir)
+        if self.n_bytes + margin > free:
+            raise IOError("Not enough space in %s: %s to download, %s "
+                          "free." % (self.fetcher.data_dir,
+                                     format_size(self.n_bytes),
+                                     format_size(free)))
+
+    def split(self, max_bytes=None, max_files=None):
+        """Split the files to download into smaller plans.
+
+        Parameters
+        ----------
+        max_bytes: int, optional
+            Maximum size of each plan (a single file can exceed it).
+
+        max_files: int, optional
+            Maximum number of files of each plan.
+
+        Returns
+        -------
+        plans: list of FetchPlan
+            Plans of consecutive files; targets sharing a url are always
+            in the same plan.
+        """
+        by_url = collections.OrderedDict()
+        for entry in self.pending:
+            by_url.setdefault(entry.url, []).append(entry)
+
+        plans, batch, batch_bytes = [], [], 0
+        for url, entries in by_url.items():
+            size = entries[0].size or 0
+            if batch and (
+                    (max_bytes is not None and
+                     batch_bytes + size > max_bytes) or
+                    (max_files is not None and
+                     len(batch) + len(entries) > max_files)):
+                plans.append(batch)
+                batch, batch_bytes = [], 0
+            batch += entries
+            batch_bytes += size
+        if batch:
+            plans.append(batch)
+        return [FetchPlan(self.fetcher, entries, force=self.force,
+                          check=self.check) for entries in plans]
+
+    def execute(self, max_bytes=None, max_files=None, check_space=True,
+                verbose=1):
+        """Download the files of the plan.
+
+        Files are fetched in batches (see split); each completed batch is
+        recorded, so an interrupted execution resumes after the last
+        completed batch.
+
+        Returns
+        -------
+        files: list of string
+            Absolute paths of all files of the plan, as returned by the
+            fetcher (e.g. None for missing S3 keys).
+        """
+        if check_space:
+            self.check_space()
+        out_files = dict()
+        for plan in self.split(max_bytes=max_bytes, max_files=max_files):
+            if verbose > 0:
+                print('Fetching %s' % plan)
+            fetched = self.fetcher.fetch(
+                [(entry.target, entry.url, entry.opts)
+                 for entry in plan.entries],
+                force=self.force, check=self.check, verbose=verbose)
+            out_files.update(zip([entry.target for entry in plan.entries],
+                                 fetched))
+            self.entries = [entry._replace(fetched=True)
+                            if entry.target in out_files else entry
+                            for entry in self.entries]
+        return [out_files.get(entry.target,
+                              op.join(self.fetcher.data_dir, entry.target))
+                for entry in self.entries]
+
+
+class OpaqueFetchPlan(FetchPlan):
+    """Plan of a fetch whose files are not known in advance, e.g. of a
+    dataset fetched by a function of another package.
+
+    It has no entries, and is executed by calling fetch, whose result is
+    returned.
+
+    Parameters
+    ----------
+    fetch: callable
+        Function doing the fetch, called without arguments.
+    """
+    def __init__(self, fetch):
+        super(OpaqueFetchPlan, self).__init__(None, [])
+        self._fetch = fetch
+
+    def __str__(self):
+        return 'unknown files to download'
+
+    def check_space(self, margin=0):
+        pass  # sizes are unknown.
+
+    def split(self, max_bytes=None, max_files=None):
+        return [self]
+
+    def execute(self, max_bytes=None, max_files=None, check_space=True,
+                verbose=1):
+        return self._fetch()
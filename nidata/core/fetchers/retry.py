@@ -0,0 +1,188 @@
+"""
+Rate limiting and retries for network transfers.
+"""
+
+import email.utils
+import itertools
+import random
+import socket
+import threading
+import time
+
+from six.moves import http_client
+from six.moves.urllib.parse import urlparse
+
+from .._utils.compat import _urllib
+
+# HTTP statuses worth retrying: timeouts, throttling and server errors.
+RETRY_STATUSES = (408, 425, 429, 500, 502, 503, 504)
+
+try:
+    _CONNECTION_ERRORS = (ConnectionError, socket.timeout)
+except NameError:  # Python 2
+    _CONNECTION_ERRORS = (socket.error, socket.timeout)
+
+# Errors of HTTP transfers worth retrying: network and protocol errors
+# (HTTPError is a URLError, further filtered by status). Other IOErrors,
+# e.g. a full disk, are not retried.
+HTTP_ERRORS = ((_urllib.error.URLError, http_client.HTTPException) +
+               _CONNECTION_ERRORS)
+
+
+class TokenBucket(object):
+    """Rate limiter, shared across threads.
+
+    Parameters
+    ----------
+    rate: float
+        Tokens (e.g. bytes) added per second.
+
+    capacity: float, optional
+        Maximum number of tokens saved up when idle, i.e. the largest burst
+        allowed. Default: rate (one second worth of tokens)
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, n_tokens=1):
+        """Take n_tokens, sleeping as long as needed for them to accumulate.
+        Consumers queue up: a large request delays the following ones."""
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self._last) * self.rate)
+            self._last = now
+            self.tokens -= n_tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.
+        if wait > 0:
+            time.sleep(wait)
+
+
+class HostRateLimiter(object):
+    """Limits the rate of requests to each host, with a TokenBucket per
+    host.
+
+    Parameters
+    ----------
+    rate: float
+        Requests per second allowed to each host.
+
+    capacity: float, optional
+        Burst of requests allowed to each host. Default: 1
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._buckets = dict()
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        """Wait until a request to the host of url is allowed."""
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, self.capacity)
+            bucket = self._buckets[host]
+        bucket.consume(1)
+
+
+def get_retry_after(exc):
+    """Return the delay (in seconds) requested by the Retry-After header of
+    an HTTP error, or None."""
+    headers = getattr(exc, 'headers', None) or getattr(exc, 'hdrs', None)
+    value = headers and headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    date = email.utils.parsedate_tz(value)  # or an HTTP date
+    if date is None:
+        return None
+    return max(0., email.utils.mktime_tz(date) - time.time())
+
+
+class RetryPolicy(object):
+    """Retries failed calls, with jittered exponential backoff.
+
+    Parameters
+    ----------
+    max_retries: int, optional
+        Number of retries after the first attempt. Default: 3
+
+    backoff: float, optional
+        Delay before the first retry, in seconds; it doubles with each
+        retry. Default: 1
+
+    max_backoff: float, optional
+        Maximum delay between two attempts, in seconds. Default: 60
+
+    exceptions: tuple of exception classes, optional
+        Errors that are retried; others are raised immediately.
+        Default: (Exception,)
+
+    jitter: bool, optional
+        If True, delays are drawn between half and all of the backoff, so
+        that clients failing together do not retry together. Default: True
+
+    statuses: tuple of int, optional
+        HTTP errors (errors with a code or status) are only retried for
+        these statuses. Default: RETRY_STATUSES
+
+    max_retry_after: float, optional
+        Longest Retry-After delay honoured, in seconds; the server may ask
+        for longer delays than max_backoff. Default: 600
+
+    verbose: int, optional
+        verbosity level (0 means no message).
+    """
+    def __init__(self, max_retries=3, backoff=1., max_backoff=60.,
+                 exceptions=(Exception,), jitter=True,
+                 statuses=RETRY_STATUSES, max_retry_after=600., verbose=0):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.exceptions = exceptions
+        self.jitter = jitter
+        self.statuses = statuses
+        self.max_retry_after = max_retry_after
+        self.verbose = verbose
+
+    def is_retryable(self, exc):
+        """Tell whether a call that raised exc can be retried."""
+        if not isinstance(exc, self.exceptions):
+            return False
+        status = getattr(exc, 'code', None) or getattr(exc, 'status', None)
+        if isinstance(status, int) and status >= 400:
+            return status in self.statuses
+        return True
+
+    def delay(self, attempt, exc=None):
+        """Delay (in seconds) before retrying a call that failed attempt + 1
+        times, the last time with exc."""
+        retry_after = get_retry_after(exc)
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        if self.jitter:
+            delay = random.uniform(delay / 2., delay)
+        return delay
+
+    def call(self, fn, *args, **kwargs):
+        """Return fn(*args, **kwargs), retrying it when it fails."""
+        for attempt in itertools.count():
+            try:
+                return fn(*args, **kwargs)
+            except self.exceptions as exc:
+                if attempt >= self.max_retries or not self.is_retryable(exc):
+                    raise
+                delay = self.delay(attempt, exc)
+                if self.verbose > 0:
+                    print("%s; retrying in %.1fs (%d/%d)." % (
+                        exc, delay, attempt + 1, self.max_retries))
+                time.sleep(delay)
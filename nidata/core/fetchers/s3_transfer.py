@@ -0,0 +1,293 @@
+"""
+Concurrent downloads of S3 objects.
+
+Keys are downloaded by a pool of threads, each with its own connection
+(boto connections are not thread-safe). Large objects are split in parts,
+fetched as ranged GETs by several threads and written in place into a
+preallocated file.
+
+Only the bucket and key API of boto is used (get_bucket, get_all_buckets,
+get_key, Key.size and Key.get_contents_to_file), so any object providing it
+can stand in for a connection.
+"""
+
+import os
+import os.path as op
+import sys
+import threading
+import time
+import warnings
+from multiprocessing.pool import ThreadPool
+
+from .base import ProgressReport
+from .events import FetchStats
+from .retry import RetryPolicy, TokenBucket
+
+# Objects at least that large (in bytes) are downloaded in parts...
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+# ... of this size.
+PART_SIZE = 16 * 1024 * 1024
+
+
+class _MonitoredFile(object):
+    """File object whose writes consume tokens from a TokenBucket, and are
+    counted by on_write(n_bytes), when given."""
+
+    def __init__(self, fp, token_bucket=None, on_write=None):
+        self.fp = fp
+        self.token_bucket = token_bucket
+        self.on_write = on_write
+
+    def write(self, data):
+        if self.token_bucket is not None:
+            self.token_bucket.consume(len(data))
+        written = self.fp.write(data)
+        if self.on_write is not None:
+            self.on_write(len(data))
+        return written
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+
+class S3Downloader(object):
+    """Downloads S3 keys concurrently.
+
+    Parameters
+    ----------
+    connect: callable
+        Returns a new S3 connection; it is called once in each thread.
+
+    max_workers: int, optional
+        Number of concurrent requests. Default: 4
+
+    part_size: int, optional
+        Size of the parts of large objects, in bytes. Default: PART_SIZE
+
+    multipart_threshold: int, optional
+        Objects at least that large are downloaded in parts.
+        Default: MULTIPART_THRESHOLD
+
+    max_bandwidth: float, optional
+        Total download rate limit, in bytes per second. Default: None
+
+    retry: RetryPolicy, optional
+        How failed requests are retried. Default: RetryPolicy()
+
+    events: EventBus, optional
+        Bus on which the progress of each key is emitted, with the key name
+        as url; the transfer time of a key is summed over its parts.
+        Default: None
+
+    verbose: int, optional
+        verbosity level (0 means no message). If positive, the progress of
+        each call to download (all keys together) is shown.
+    """
+    def __init__(self, connect, max_workers=4, part_size=PART_SIZE,
+                 multipart_threshold=MULTIPART_THRESHOLD, max_bandwidth=None,
+                 retry=None, events=None, verbose=1):
+        self.connect = connect
+        self.max_workers = max_workers
+        self.part_size = part_size
+        self.multipart_threshold = multipart_threshold
+        self.token_bucket = (TokenBucket(max_bandwidth)
+                             if max_bandwidth else None)
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.events = events
+        self.verbose = verbose
+        self.etags = dict()  # ETag of downloaded keys, by target file
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._progress = dict()  # by temp file; see download
+        self._report = None  # ProgressReport of download, if verbose
+        self._bytes_written = 0
+
+    def get_bucket(self, bucket_name):
+        """Return a bucket of this thread's connection (None means the first
+        bucket)."""
+        local = self._local
+        if not hasattr(local, 'conn'):
+            local.conn = self.connect()
+            local.buckets = dict()
+        if bucket_name not in local.buckets:
+            if bucket_name:
+                bucket = local.conn.get_bucket(bucket_name)
+            else:  # default to first bucket
+                bucket = local.conn.get_all_buckets()[0]
+            local.buckets[bucket_name] = bucket
+        return local.buckets[bucket_name]
+
+    def get_key(self, bucket_name, key_name, validate=True):
+        return self.retry.call(self.get_bucket(bucket_name).get_key,
+                               key_name, validate=validate)
+
+    def map(self, fn, items):
+        """Return [fn(item) for item in items], computed by the workers."""
+        if self.max_workers <= 1 or len(items) <= 1:
+            return [fn(item) for item in items]
+        pool = ThreadPool(min(self.max_workers, len(items)))
+        try:
+            return pool.map(fn, items, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _download(self, task):
+        """Download a whole key, or a byte range of it, into a file."""
+        bucket_name, key_name, temp_file, byte_range = task
+        progress = self._progress[temp_file]
+        state = dict(attempts=0, error=None)
+        with self._lock:
+            started = progress['t0'] is None
+            if started:
+                progress['t0'] = time.time()
+        if started and self.events:
+            self.events.emit('started', url=key_name,
+                             targets=[progress['target']])
+
+        def attempt():
+            if state['attempts'] and self.events:
+                self.events.emit('retry', url=key_name,
+                                 attempt=state['attempts'],
+                                 error=state['error'])
+            state['attempts'] += 1
+            # Each thread uses its own connection; no need for a HEAD.
+            key = self.get_key(bucket_name, key_name, validate=False)
+            headers = dict()
+            try:
+                with open(temp_file, 'r+b' if byte_range else 'wb') as fp:
+                    if byte_range:
+                        fp.seek(byte_range[0])
+                        headers['Range'] = 'bytes=%d-%d' % byte_range
+                    out_fp = fp
+                    if (self.token_bucket is not None or
+                            self._report is not None):
+                        out_fp = _MonitoredFile(
+                            fp, self.token_bucket,
+                            self._on_write if self._report else None)
+                    key.get_contents_to_file(out_fp, headers=headers)
+            except Exception as exc:
+                state['error'] = exc
+                raise
+
+        t0 = time.time()
+        try:
+            self.retry.call(attempt)
+        finally:
+            with self._lock:
+                progress['stats'].add('transfer', time.time() - t0)
+                progress['attempts'] += state['attempts']
+        with self._lock:
+            progress['stats'].bytes += (
+                byte_range[1] - byte_range[0] + 1 if byte_range
+                else op.getsize(temp_file))
+            progress['parts'] -= 1
+            done = not progress['parts']
+        if not done:
+            return
+        # Install the key as soon as it is complete, so that it is kept
+        # even if other keys fail.
+        target_file = progress['target']
+        if op.exists(target_file):
+            os.remove(target_file)
+        os.rename(temp_file, target_file)
+        if self.events:
+            self._emit_end('fetched', key_name, progress)
+
+    def _on_write(self, n_bytes):
+        with self._lock:
+            self._bytes_written += n_bytes
+            self._report(self._bytes_written)
+
+    def _emit_end(self, kind, key_name, progress, error=None):
+        """Emit the 'fetched' or 'failed' event of a key."""
+        seconds = time.time() - progress['t0']
+        fields = dict(progress['stats'].as_dict(), url=key_name,
+                      targets=[progress['target']], seconds=seconds,
+                      attempts=progress['attempts'])
+        if kind == 'fetched':
+            fields['rate'] = progress['stats'].bytes / max(seconds, 1e-6)
+        else:
+            fields['error'] = error
+        self.events.emit(kind, **fields)
+
+    def download(self, keys):
+        """Download keys.
+
+        Parameters
+        ----------
+        keys: list of (string, string, string)
+            Bucket name (None for the first bucket), key name and target
+            file of each object.
+
+        Returns
+        -------
+        files: list of string
+            Target files, or None for keys that do not exist.
+        """
+        # Sizes tell which keys must be split.
+        def head(item):
+            bucket_name, key_name, target_file = item
+            key = self.get_key(bucket_name, key_name)
+            if not key:
+                warnings.warn('Failed to find key: %s' % key_name)
+                return None
+            self.etags[target_file] = getattr(key, 'etag', None)
+            return key.size
+        sizes = self.map(head, keys)
+
+        # Parts of all objects are downloaded by a single pool, so that
+        # small and large objects share the available workers.
+        tasks = []
+        for (bucket_name, key_name, target_file), size in zip(keys, sizes):
+            if size is None:
+                continue
+            target_dir = op.dirname(target_file)
+            if not op.isdir(target_dir):
+                try:
+                    os.makedirs(target_dir)
+                except OSError:
+                    if not op.isdir(target_dir):
+                        raise
+            temp_file = target_file + '.part'
+            if self.verbose > 0:
+                print("Downloading [%s]/%s to %s." % (
+                    bucket_name or 'default bucket', key_name, target_file))
+            n_tasks = len(tasks)
+            if size < self.multipart_threshold or size <= self.part_size:
+                tasks.append((bucket_name, key_name, temp_file, None))
+            else:
+                with open(temp_file, 'wb') as fp:
+                    fp.truncate(size)
+                for start in range(0, size, self.part_size):
+                    end = min(start + self.part_size, size) - 1
+                    tasks.append((bucket_name, key_name, temp_file,
+                                  (start, end)))
+            self._progress[temp_file] = dict(
+                target=target_file, parts=len(tasks) - n_tasks,
+                stats=FetchStats(), attempts=0, t0=None)
+        if self.verbose > 0 and tasks:
+            self._report = ProgressReport(sum(
+                size for size in sizes if size is not None))
+            self._bytes_written = 0
+        try:
+            self.map(self._download, tasks)
+        except Exception as exc:
+            if self.events:
+                for bucket_name, key_name, target_file in keys:
+                    progress = self._progress.get(target_file + '.part')
+                    if progress is not None and progress['parts'] and \
+                            progress['t0'] is not None:
+                        self._emit_end('failed', key_name, progress,
+                                       error=exc)
+            raise
+        finally:
+            self._progress = dict()
+            if self._report is not None:
+                self._report(self._bytes_written, force=True)
+                sys.stderr.write('\n')
+                self._report = None
+
+        return [None if size is None else target_file
+                for (bucket_name, key_name, target_file), size
+                in zip(keys, sizes)]
@@ -0,0 +1,124 @@
+"""
+Staging directories, and their commit into dataset directories.
+
+Each url is downloaded (and extracted) in its own staging directory, under
+the STAGING_DIR of the dataset directory, so on the same filesystem. Once
+complete, it is committed: its entries are renamed into the dataset
+directory. Each entry that is new to the dataset directory (a file, or a
+whole directory tree) is committed by a single, atomic rename, so readers
+never see a partial tree; directories that already exist are merged, entry
+by entry.
+
+A commit journal is written before the first rename and removed after the
+last one. If the process dies in between, recover_staged finishes the
+commit on the next fetch: the staging directory was complete when its
+journal was written.
+"""
+
+import hashlib
+import json
+import os
+import os.path as op
+import shutil
+
+from .._utils.compat import cPickle
+
+# Directory of the staging directories, inside a dataset directory.
+STAGING_DIR = '.staging'
+
+# Suffix of commit journals, next to their staging directory.
+JOURNAL_SUFFIX = '.commit'
+
+# Atomic rename, replacing the destination (os.rename does not replace
+# files on Windows).
+_replace = getattr(os, 'replace', os.rename)
+
+
+def get_staging_dir(data_dir, url):
+    """Return the staging directory of url, in data_dir."""
+    files_md5 = hashlib.md5(cPickle.dumps(url)).hexdigest()
+    return op.join(data_dir, STAGING_DIR, files_md5)
+
+
+def _rename_tree(src, dst):
+    """Move the entries of directory src into directory dst, with renames;
+    entries of dst that are not in src are kept, files in src replace
+    those of dst."""
+    for name in os.listdir(src):
+        src_name = op.join(src, name)
+        dst_name = op.join(dst, name)
+        src_is_dir = op.isdir(src_name) and not op.islink(src_name)
+        dst_is_dir = op.isdir(dst_name) and not op.islink(dst_name)
+        if src_is_dir and dst_is_dir:
+            _rename_tree(src_name, dst_name)
+            os.rmdir(src_name)
+            continue
+        if dst_is_dir:
+            shutil.rmtree(dst_name)
+        elif src_is_dir and op.lexists(dst_name):
+            os.remove(dst_name)
+        _replace(src_name, dst_name)
+
+
+def commit_staged(staging_dir, data_dir, url=None):
+    """Commit a complete staging directory into data_dir, and remove it.
+
+    Parameters
+    ----------
+    staging_dir: string
+        Staging directory (see get_staging_dir).
+
+    data_dir: string
+        Dataset directory.
+
+    url: string, optional
+        Url the staging directory was downloaded from, recorded in the
+        journal for information.
+    """
+    journal = staging_dir + JOURNAL_SUFFIX
+    with open(journal + '.tmp', 'w') as fp:
+        json.dump(dict(url=url, data_dir=op.abspath(data_dir)), fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    _replace(journal + '.tmp', journal)
+    _finish_commit(staging_dir, data_dir)
+
+
+def _finish_commit(staging_dir, data_dir):
+    """Move the contents of a journaled staging directory to data_dir;
+    can be called again if it was interrupted."""
+    if op.isdir(staging_dir):
+        _rename_tree(staging_dir, data_dir)
+        os.rmdir(staging_dir)
+    os.remove(staging_dir + JOURNAL_SUFFIX)
+
+
+def recover_staged(data_dir, verbose=1):
+    """Finish the commits of data_dir that were interrupted.
+
+    Staging directories without a journal are incomplete downloads; they
+    are left, to be resumed.
+
+    Returns
+    -------
+    urls: list of string
+        Urls whose commit was finished.
+    """
+    root = op.join(data_dir, STAGING_DIR)
+    if not op.isdir(root):
+        return []
+    urls = []
+    for name in sorted(os.listdir(root)):
+        if not name.endswith(JOURNAL_SUFFIX):
+            continue
+        journal = op.join(root, name)
+        try:
+            with open(journal) as fp:
+                url = json.load(fp).get('url')
+        except (IOError, ValueError):
+            url = None
+        if verbose > 0:
+            print('Finishing the interrupted commit of %s' % (url or name))
+        _finish_commit(journal[:-len(JOURNAL_SUFFIX)], data_dir)
+        urls.append(url)
+    return urls
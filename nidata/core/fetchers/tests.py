@@ -0,0 +1,1229 @@
+import errno
+import hashlib
+import io
+import json
+import os
+import os.path as op
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import unittest
+import warnings
+import zipfile
+
+try:
+    import asyncio
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import nibabel as nib
+import numpy as np
+from unittest import TestCase
+
+from nose.tools import assert_equal, assert_raises, assert_true
+
+from nidata.core.datasets import FetcherFunctionDataset, HttpDataset
+from nidata.core.fetchers import HttpFetcher
+from nidata.core.fetchers.aws_fetcher import (_check_recorded_etag,
+                                              check_s3_file)
+from nidata.core.fetchers.base import (copy_file, FetchError, hash_file,
+                                       verify_files)
+from nidata.core.fetchers.events import FetchStats
+from nidata.core.fetchers import http_fetcher
+from nidata.core.fetchers.http_pool import HttpConnectionPool
+from nidata.core.fetchers.http_fetcher import (_chunk_read_, _fetch_file,
+                                               _get_range_size,
+                                               _get_temp_dir, _get_url_opener,
+                                               _get_url_size, _make_request,
+                                               _uncompress_file, fetch_files)
+from nidata.core.fetchers.cache import BlobStore, ImageCache
+from nidata.core.fetchers.events import (EventBus, EventLog,
+                                         JsonLinesExporter, PHASES,
+                                         PrometheusExporter)
+from nidata.core.fetchers.manifest import DownloadManifest, FailureJournal
+from nidata.core.fetchers.retry import (HostRateLimiter, HTTP_ERRORS,
+                                        RetryPolicy, TokenBucket)
+from nidata.core._utils.compat import _urllib
+from nidata.core._utils.niimg import load_niimg
+from nidata.core.fetchers.s3_transfer import S3Downloader
+from nidata.core.fetchers.staging import (commit_staged, get_staging_dir,
+                                          JOURNAL_SUFFIX, recover_staged,
+                                          STAGING_DIR)
+from nidata.core._utils.testing import (FakeS3Connection, FakeS3Key,
+                                        serve_directory)
+
+
+class HttpFetchTestCase(TestCase):
+    n_files = 8
+
+    def setUp(self):
+        self.src_dir = tempfile.mkdtemp()
+        self.data_dir = tempfile.mkdtemp()
+        self.contents = dict()
+        for fi in range(self.n_files):
+            name = 'sub%02d/file%02d.txt' % (fi % 3, fi)
+            self.write_src(name, ('contents of %s\n' % name) * (fi + 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.src_dir)
+        shutil.rmtree(self.data_dir)
+
+    def write_src(self, name, contents):
+        path = op.join(self.src_dir, name)
+        if not op.exists(op.dirname(path)):
+            os.makedirs(op.dirname(path))
+        with open(path, 'wb') as fp:
+            fp.write(contents.encode('utf-8'))
+        self.contents[name] = contents
+
+    def files(self, server):
+        return [(name, server.url + name, dict())
+                for name in sorted(self.contents)]
+
+    def assert_fetched(self, out_files, files):
+        assert_equal(out_files, [op.join(self.data_dir, name)
+                                 for name, url, opts in files])
+        for name, url, opts in files:
+            with open(op.join(self.data_dir, name), 'rb') as fp:
+                assert_equal(fp.read().decode('utf-8'), self.contents[name])
+        # Sandboxes have all been cleaned up.
+        assert_equal(sorted(os.listdir(self.data_dir)),
+                     sorted(set(name.split('/')[0]
+                                for name in self.contents) |
+                            set([DownloadManifest.filename, STAGING_DIR])))
+        assert_equal(os.listdir(op.join(self.data_dir, STAGING_DIR)), [])
+
+
+class FetchFilesTest(HttpFetchTestCase):
+    def test_sequential(self):
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            out_files = fetch_files(self.data_dir, files, verbose=0)
+        self.assert_fetched(out_files, files)
+
+    def test_concurrent(self):
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            out_files = fetch_files(self.data_dir, files, verbose=0,
+                                    max_workers=4, max_per_host=2)
+        self.assert_fetched(out_files, files)
+
+    def test_resume_partial_download(self):
+        name = sorted(self.contents)[-1]
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            # Leave a half-downloaded file in the sandbox of its url.
+            fetcher = HttpFetcher(data_dir=self.data_dir, max_workers=3)
+            fetch_files(self.data_dir, [f for f in files if f[0] != name],
+                        verbose=0)
+            url = server.url + name
+            temp_dir = _get_temp_dir(self.data_dir, url)
+            os.makedirs(temp_dir)
+            with open(op.join(temp_dir, op.basename(name) + '.part'),
+                      'wb') as fp:
+                fp.write(self.contents[name][:10].encode('utf-8'))
+
+            n_requests = server.n_requests
+            out_files = fetcher.fetch(files, verbose=0)
+            assert_equal(server.n_requests, n_requests + 1)
+        self.assert_fetched(out_files, files)
+        assert_true(not op.exists(temp_dir))
+
+
+    def test_targets_sharing_a_url(self):
+        name = sorted(self.contents)[0]
+        with serve_directory(self.src_dir) as server:
+            url = server.url + name
+            # One of the targets is named after the url.
+            files = [('copy1.txt', url, dict()),
+                     (op.basename(name), url, dict()),
+                     ('copy2.txt', url, dict())]
+            fetch_files(self.data_dir, files, verbose=0)
+        for file_, url, opts in files:
+            with open(op.join(self.data_dir, file_)) as fp:
+                assert_equal(fp.read(), self.contents[name])
+
+
+class StagingTest(HttpFetchTestCase):
+    def write(self, path, contents):
+        if not op.exists(op.dirname(path)):
+            os.makedirs(op.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write(contents)
+
+    def read(self, path):
+        with open(op.join(self.data_dir, path)) as fp:
+            return fp.read()
+
+    def test_commit(self):
+        self.write(op.join(self.data_dir, 'sub00', 'old.txt'), 'old')
+        self.write(op.join(self.data_dir, 'sub00', 'file.txt'), 'old')
+        staging_dir = get_staging_dir(self.data_dir, 'http://a.org/f.zip')
+        self.write(op.join(staging_dir, 'sub00', 'file.txt'), 'new')
+        self.write(op.join(staging_dir, 'sub01', 'file.txt'), 'new')
+        inode = os.stat(op.join(staging_dir, 'sub01')).st_ino
+
+        commit_staged(staging_dir, self.data_dir)
+        assert_equal(self.read('sub00/old.txt'), 'old')
+        assert_equal(self.read('sub00/file.txt'), 'new')
+        assert_equal(self.read('sub01/file.txt'), 'new')
+        # New directories are committed whole, by a single rename.
+        assert_equal(os.stat(op.join(self.data_dir, 'sub01')).st_ino, inode)
+        assert_equal(os.listdir(op.join(self.data_dir, STAGING_DIR)), [])
+
+    def test_recovery(self):
+        names = sorted(self.contents)
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            # A crash in the middle of the commit of the first url...
+            staging_dir = get_staging_dir(self.data_dir, files[0][1])
+            self.write(op.join(staging_dir, names[0]),
+                       self.contents[names[0]])
+            with open(staging_dir + JOURNAL_SUFFIX, 'w') as fp:
+                json.dump(dict(url=files[0][1]), fp)
+            # ... and in the download of the second one.
+            partial_dir = get_staging_dir(self.data_dir, files[1][1])
+            self.write(op.join(partial_dir, op.basename(names[1]) + '.part'),
+                       self.contents[names[1]][:5])
+            assert_equal(recover_staged(op.join(self.data_dir, 'none')), [])
+
+            # The commit is finished; the download is resumed.
+            n_requests = server.n_requests
+            out_files = fetch_files(self.data_dir, files, verbose=0)
+            assert_equal(server.n_requests, n_requests + len(files) - 1)
+        self.assert_fetched(out_files, files)
+
+
+class ManifestTest(HttpFetchTestCase):
+    def test_warm_fetch_uses_manifest(self):
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            fetch_files(self.data_dir, files, verbose=0)
+            manifest = DownloadManifest(self.data_dir)
+            for name, url, opts in files:
+                entry = manifest.get(name)
+                assert_equal(entry['url'], url)
+                assert_equal(entry['size'], len(self.contents[name]))
+
+            # Deleted files are fetched again.
+            n_requests = server.n_requests
+            os.remove(op.join(self.data_dir, files[0][0]))
+            out_files = fetch_files(self.data_dir, files, verbose=0)
+            assert_equal(server.n_requests, n_requests + 1)
+            os.remove(op.join(self.data_dir, files[1][0]))
+            out_files = fetch_files(self.data_dir, files, verbose=0,
+                                    check=True)
+            assert_equal(server.n_requests, n_requests + 2)
+        self.assert_fetched(out_files, files)
+
+    def test_files_fetched_before_manifest(self):
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            fetch_files(self.data_dir, files, verbose=0)
+            os.remove(op.join(self.data_dir, DownloadManifest.filename))
+            n_requests = server.n_requests
+            out_files = fetch_files(self.data_dir, files, verbose=0)
+            assert_equal(server.n_requests, n_requests)
+        self.assert_fetched(out_files, files)
+        assert_true(DownloadManifest(self.data_dir).is_fetched(
+            files[0][0], check=True))
+
+
+class RetryTest(HttpFetchTestCase):
+    def test_transient_errors(self):
+        names = sorted(self.contents)
+        failures = {names[0]: [(503, 0), (503, None)], names[1]: [(429, 0)]}
+        retry = RetryPolicy(backoff=0., exceptions=HTTP_ERRORS)
+        with serve_directory(self.src_dir, failures=failures) as server:
+            files = self.files(server)
+            out_files = fetch_files(self.data_dir, files, verbose=0,
+                                    retry=retry, max_workers=3)
+            assert_equal(server.n_requests, len(files) + 3)
+        self.assert_fetched(out_files, files)
+
+    def test_failure_journal(self):
+        names = sorted(self.contents)
+        os.rename(op.join(self.src_dir, names[0]),
+                  op.join(self.src_dir, 'moved'))
+        retry = RetryPolicy(backoff=0., exceptions=HTTP_ERRORS)
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            n_requests = server.n_requests
+            with assert_raises(FetchError) as cm:
+                fetch_files(self.data_dir, files, verbose=0, retry=retry,
+                            fail_fast=False)
+            assert_equal(server.n_requests, n_requests + len(files))  # 404
+            assert_equal([url for url, exc in cm.exception.failures],
+                         [files[0][1]])
+            entry = FailureJournal(self.data_dir).get(files[0][1])
+            assert_equal(entry['targets'], [names[0]])
+            assert_equal(entry['n_failures'], 1)
+            for name, url, opts in files[1:]:
+                assert_true(op.exists(op.join(self.data_dir, name)))
+
+            # The failure stays in the journal until the url is fetched.
+            os.rename(op.join(self.src_dir, 'moved'),
+                      op.join(self.src_dir, names[0]))
+            out_files = fetch_files(self.data_dir, files, verbose=0)
+        assert_equal(FailureJournal(self.data_dir).entries, dict())
+        for out_file, (name, url, opts) in zip(out_files, files):
+            with open(out_file, 'rb') as fp:
+                assert_equal(fp.read().decode('utf-8'), self.contents[name])
+
+    def test_fail_fast(self):
+        names = sorted(self.contents)
+        os.rename(op.join(self.src_dir, names[0]),
+                  op.join(self.src_dir, 'moved'))
+
+        class SlowLimiter(object):
+            # Delays all urls but the failing one.
+            def wait(self, url):
+                if not url.endswith(names[0]):
+                    time.sleep(0.2)
+
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            assert_raises(IOError, fetch_files, self.data_dir, files,
+                          verbose=0, max_workers=2,
+                          rate_limiter=SlowLimiter())
+            # The url started along with the failing one, and no other.
+            assert_equal(server.n_requests, 2)
+
+    def test_policy(self):
+        policy = RetryPolicy(backoff=2., max_backoff=5.)
+        for attempt in range(4):
+            delay = policy.delay(attempt)
+            assert_true(min(5., 2. * 2 ** attempt) / 2 <= delay <=
+                        min(5., 2. * 2 ** attempt))
+        error = _urllib.error.HTTPError('http://localhost/', 503, 'Busy',
+                                        {'Retry-After': '120'}, None)
+        assert_equal(policy.delay(0, error), 120.)
+        assert_true(policy.is_retryable(error))
+        assert_true(not policy.is_retryable(_urllib.error.HTTPError(
+            'http://localhost/', 404, 'Not Found', {}, None)))
+        assert_true(policy.is_retryable(IOError('Connection reset')))
+        assert_true(not isinstance(ValueError('checksum'), HTTP_ERRORS))
+        assert_true(isinstance(_urllib.error.URLError('refused'),
+                               HTTP_ERRORS))
+
+    def test_disk_errors_not_retried(self):
+        def disk_full(*args, **kwargs):
+            raise IOError(errno.ENOSPC, 'No space left on device')
+        retry = RetryPolicy(backoff=0., exceptions=HTTP_ERRORS)
+        chunk_read = http_fetcher._chunk_read_
+        try:
+            http_fetcher._chunk_read_ = disk_full
+            with serve_directory(self.src_dir) as server:
+                files = self.files(server)[:1]
+                with assert_raises(IOError) as cm:
+                    fetch_files(self.data_dir, files, verbose=0, retry=retry)
+                assert_equal(server.n_requests, 1)
+        finally:
+            http_fetcher._chunk_read_ = chunk_read
+        assert_equal(cm.exception.errno, errno.ENOSPC)
+
+    def test_host_rate_limiter(self):
+        limiter = HostRateLimiter(50.)
+        t0 = time.time()
+        for _ in range(6):
+            limiter.wait('http://a.org/file')
+            limiter.wait('http://b.org/file')
+        dt = time.time() - t0
+        assert_true(0.09 <= dt < 0.5, dt)
+
+
+class PlanTest(HttpFetchTestCase):
+    def test_plan_sizes(self):
+        fetcher = HttpFetcher(data_dir=self.data_dir)
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            plan = fetcher.plan(files, verbose=0)
+            assert_equal(server.n_requests, len(files))
+        assert_equal(len(plan), len(files))
+        assert_equal(plan.n_unknown, 0)
+        assert_equal(plan.n_bytes, sum(len(contents)
+                                       for contents in self.contents.values()))
+        assert_equal(os.listdir(self.data_dir), [])  # nothing downloaded
+
+    def test_plan_and_execute(self):
+        fetcher = HttpFetcher(data_dir=self.data_dir)
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            fetch_files(self.data_dir, files[:3], verbose=0)
+            plan = fetcher.plan(files, verbose=0)
+            assert_equal([entry.target for entry in plan.pending],
+                         [name for name, url, opts in files[3:]])
+            out_files = plan.execute(max_files=2, verbose=0)
+            assert_equal(len(plan), 0)
+            assert_equal(len(fetcher.plan(files, verbose=0)), 0)
+        self.assert_fetched(out_files, files)
+
+    def test_split(self):
+        fetcher = HttpFetcher(data_dir=self.data_dir)
+        files = [('a/%d' % fi, 'http://localhost/%d' % (fi // 2),
+                  dict(estimated_size=10)) for fi in range(6)]
+        plan = fetcher.plan(files, sizes=False, verbose=0)
+        assert_equal(plan.n_bytes, 30)  # one download per url
+        plans = plan.split(max_bytes=25)
+        assert_equal([[entry.target for entry in sub_plan.entries]
+                      for sub_plan in plans],
+                     [['a/0', 'a/1', 'a/2', 'a/3'], ['a/4', 'a/5']])
+        assert_equal(len(plan.split(max_files=3)), 3)
+
+    def test_check_space(self):
+        fetcher = HttpFetcher(data_dir=self.data_dir)
+        files = [('a', 'http://localhost/a', dict(estimated_size=2 ** 60)),
+                 ('b', 'http://localhost/b', dict())]
+        plan = fetcher.plan(files, sizes=False, verbose=0)
+        assert_equal(plan.n_unknown, 1)
+        assert_raises(IOError, plan.check_space)
+        assert_raises(IOError, plan.execute, verbose=0)
+
+    def test_fetcher_function_plan(self):
+        class FunctionDataset(FetcherFunctionDataset):
+            fetcher_function = 'os.path.join'
+        dataset = FunctionDataset(data_dir=self.data_dir)
+        plan = dataset.plan('a', 'b')
+        assert_equal(len(plan), 0)
+        plan.check_space()
+        assert_equal(plan.execute(verbose=0), op.join('a', 'b'))
+
+
+class EventsTest(HttpFetchTestCase):
+    def test_fetch_events(self):
+        names = sorted(self.contents)
+        fetcher = HttpFetcher(data_dir=self.data_dir, max_workers=3,
+                              max_retries=1)
+        log = fetcher.add_listener(EventLog())
+        metrics = fetcher.add_listener(PrometheusExporter())
+        with serve_directory(self.src_dir,
+                             failures={names[0]: [(503, 0)]}) as server:
+            fetcher.fetch(self.files(server), verbose=0)
+        assert_equal(len(log.of_kind('started')), len(names))
+        assert_equal([event['url'] for event in log.of_kind('retry')],
+                     [server.url + names[0]])
+        fetched = dict((event['targets'][0], event)
+                       for event in log.of_kind('fetched'))
+        assert_equal(sorted(fetched), names)
+        for name, event in fetched.items():
+            assert_equal(event['bytes'], len(self.contents[name]))
+            assert_equal(event['attempts'], 2 if name == names[0] else 1)
+            assert_true(sum(event[phase] for phase in PHASES) <=
+                        event['seconds'])
+
+        text = metrics.render()
+        assert_true('nidata_fetch_urls_total{status="fetched"} 8.0\n'
+                    in text)
+        assert_true('nidata_fetch_retries_total 1.0\n' in text)
+        assert_true('nidata_fetch_bytes_total{host="%s"} %r\n' % (
+            server.url.split('/')[2],
+            float(sum(len(c) for c in self.contents.values()))) in text)
+        assert_true('nidata_fetch_in_flight 0.0\n' in text)
+
+    def test_exporters(self):
+        bus = EventBus()
+        jsonl_file = op.join(self.data_dir, 'events.jsonl')
+        exporter = bus.add_listener(JsonLinesExporter(jsonl_file))
+        metrics = bus.add_listener(PrometheusExporter())
+        bus.emit('started', url='http://a.org/f', targets=['f'])
+        bus.emit('failed', url='http://a.org/f', targets=['f'],
+                 error=IOError('Connection reset'))
+        bus.remove_listener(exporter)
+        exporter.close()
+        with open(jsonl_file) as fp:
+            events = [json.loads(line) for line in fp]
+        assert_equal([event['event'] for event in events],
+                     ['started', 'failed'])
+        assert_equal(events[1]['error'], 'IOError: Connection reset'
+                     if str is bytes else 'OSError: Connection reset')
+
+        metrics_file = op.join(self.data_dir, 'nidata.prom')
+        metrics.write(metrics_file)
+        with open(metrics_file) as fp:
+            text = fp.read()
+        assert_true('nidata_fetch_urls_total{status="failed"} 1.0\n'
+                    in text)
+        assert_true('# TYPE nidata_fetch_in_flight gauge\n' in text)
+
+        # Listeners cannot break fetches.
+        bus.add_listener(lambda event: 1 / 0)
+        with warnings.catch_warnings(record=True) as warned:
+            warnings.simplefilter('always')
+            bus.emit('started', url='http://a.org/g', targets=['g'])
+        assert_equal(len(warned), 1)
+
+
+class AsyncFetchTest(HttpFetchTestCase):
+    n_files = 40
+
+    def fetcher(self, data_dir=None, **kwargs):
+        from nidata.core.fetchers.async_fetcher import AsyncHttpFetcher
+        return AsyncHttpFetcher(data_dir=data_dir or self.data_dir,
+                                **kwargs)
+
+    def test_fetch(self):
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            out_files = self.fetcher(max_in_flight=4).fetch(files, verbose=0)
+            assert_true(server.n_connections <= 4)
+            assert_equal(server.n_requests, len(files))
+        self.assert_fetched(out_files, files)
+
+    def test_resume_and_checksums(self):
+        name = sorted(self.contents)[-1]
+        contents = self.contents[name].encode('utf-8')
+        with serve_directory(self.src_dir) as server:
+            url = server.url + name
+            temp_dir = _get_temp_dir(self.data_dir, url)
+            os.makedirs(temp_dir)
+            with open(op.join(temp_dir, op.basename(name)) + '.part',
+                      'wb') as fp:
+                fp.write(contents[:10])
+            checksum = 'sha256:' + hashlib.sha256(contents).hexdigest()
+            files = [(name, url, dict(checksum=checksum))]
+            loop = asyncio.new_event_loop()
+            try:
+                out_files = loop.run_until_complete(
+                    self.fetcher().fetch_async(files, verbose=0))
+            finally:
+                loop.close()
+            with open(out_files[0], 'rb') as fp:
+                assert_equal(fp.read(), contents)
+
+            # A complete .part is answered with a 416, and downloaded again.
+            name = sorted(self.contents)[-2]
+            contents = self.contents[name].encode('utf-8')
+            url = server.url + name
+            temp_dir = _get_temp_dir(self.data_dir, url)
+            os.makedirs(temp_dir)
+            with open(op.join(temp_dir, op.basename(name)) + '.part',
+                      'wb') as fp:
+                fp.write(contents)
+            out_files = self.fetcher().fetch([(name, url, dict())],
+                                             verbose=0)
+            with open(out_files[0], 'rb') as fp:
+                assert_equal(fp.read(), contents)
+
+            bad = [(sorted(self.contents)[0],
+                    server.url + sorted(self.contents)[0],
+                    dict(md5sum='0' * 32))]
+            assert_raises(ValueError, self.fetcher().fetch, bad, verbose=0)
+            assert_true(not op.exists(op.join(self.data_dir, bad[0][0])))
+
+    def test_dataset_fetch_async(self):
+        dataset = HttpDataset(data_dir=self.data_dir)
+        dataset.fetcher = self.fetcher(data_dir=dataset.data_dir)
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            loop = asyncio.new_event_loop()
+            try:
+                out_files = loop.run_until_complete(
+                    dataset.fetch_async(files=files, verbose=0))
+            finally:
+                loop.close()
+        assert_equal(out_files, [op.join(dataset.data_dir, name)
+                                 for name, url, opts in files])
+        assert_true(all(op.exists(out_file) for out_file in out_files))
+
+
+class BlobStoreTest(HttpFetchTestCase):
+    def setUp(self):
+        super(BlobStoreTest, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(BlobStoreTest, self).tearDown()
+        shutil.rmtree(self.cache_dir)
+
+    def test_shared_downloads(self):
+        cache = BlobStore(self.cache_dir)
+        other_dir = tempfile.mkdtemp()
+        try:
+            with serve_directory(self.src_dir) as server:
+                files = self.files(server)
+                fetch_files(other_dir, files, verbose=0, cache=cache)
+                n_requests = server.n_requests
+                out_files = fetch_files(self.data_dir, files, verbose=0,
+                                        cache=cache)
+                assert_equal(server.n_requests, n_requests)
+            self.assert_fetched(out_files, files)
+            for name, url, opts in files:
+                # Both copies are links to the stored file.
+                assert_true(op.samefile(op.join(other_dir, name),
+                                        op.join(self.data_dir, name)))
+        finally:
+            shutil.rmtree(other_dir)
+
+    def test_eviction(self):
+        cache = BlobStore(self.cache_dir, max_bytes='1K')
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            out_files = fetch_files(self.data_dir, files, verbose=0,
+                                    cache=cache)
+        self.assert_fetched(out_files, files)
+        sizes = [size for path, size, atime in cache.blobs()]
+        assert_true(0 < sum(sizes) <= 1024)
+        # The last file stored is always kept.
+        assert_true(op.exists(cache.path(BlobStore.key(url=files[-1][1]))))
+
+    def test_put_does_not_walk_the_store(self):
+        cache = BlobStore(self.cache_dir, max_bytes=10000)
+        walks = []
+        blobs = cache.blobs
+        cache.blobs = lambda: walks.append(None) or blobs()
+        src = op.join(self.src_dir, 'blob')
+        for i in range(20):
+            with open(src, 'wb') as fp:
+                fp.write(b'%04d' % i * 250)
+            cache.put(BlobStore.key(url=str(i)), src)
+        # Walked once to size the store, then on every other put once it
+        # is full (eviction frees 10% of the budget).
+        assert_equal(len(walks), 6)
+        assert_true(sum(size for path, size, atime in blobs()) <= 10000)
+
+
+class ImageCacheTest(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_dir = op.join(self.temp_dir, 'cache')
+        self.data = np.arange(10 * 10 * 10 * 2, dtype=np.float32).reshape(
+            (10, 10, 10, 2))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def save(self, name, data):
+        path = op.join(self.temp_dir, name)
+        nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+        return path
+
+    def test_load(self):
+        cache = ImageCache(self.cache_dir)
+        path = self.save('img.nii.gz', self.data)
+        img = load_niimg(path, cache=cache)
+        cached = img.get_filename()
+        assert_equal(op.dirname(op.dirname(op.dirname(cached))),
+                     self.cache_dir)
+        data = np.asanyarray(img.dataobj)
+        assert_true(isinstance(data, np.memmap))
+        np.testing.assert_array_equal(data, self.data)
+
+        # Loaded again from the same copy, without hashing the source.
+        mtime = os.stat(cached).st_mtime
+        cache = ImageCache(self.cache_dir)
+        cache.sources.entries[op.abspath(path)]['md5'] = 'recorded'
+        assert_equal(cache.checksum(path), 'recorded')
+        assert_equal(load_niimg(path, cache=ImageCache(self.cache_dir))
+                     .get_filename(), cached)
+        assert_equal(os.stat(cached).st_mtime, mtime)
+
+        # A copy of the image shares its decompressed copy; a changed
+        # image gets a new one.
+        other = op.join(self.temp_dir, 'copy.nii.gz')
+        shutil.copy(path, other)
+        assert_equal(load_niimg(other, cache=cache).get_filename(), cached)
+        time.sleep(0.01)
+        self.save('img.nii.gz', 2 * self.data)
+        img = load_niimg(path, cache=cache)
+        assert_true(img.get_filename() != cached)
+        np.testing.assert_array_equal(np.asanyarray(img.dataobj),
+                                      2 * self.data)
+
+        # Uncompressed images, and disabled caches, are left alone.
+        path = self.save('img.nii', self.data)
+        assert_equal(load_niimg(path, cache=cache).get_filename(), path)
+        path = self.save('img2.nii.gz', self.data)
+        assert_equal(load_niimg(path, cache=False).get_filename(), path)
+
+    def test_eviction(self):
+        cache = ImageCache(self.cache_dir, max_bytes=12000)
+        paths = [self.save('img%d.nii.gz' % i, i * self.data)
+                 for i in range(3)]
+        cached = [cache.decompressed(path) for path in paths]
+        assert_true(not op.exists(cached[0]))
+        assert_true(op.exists(cached[2]))
+        # The index of sources is not evicted.
+        assert_true(op.exists(cache.sources.path))
+
+    def test_from_environ(self):
+        environ = dict(os.environ)
+        try:
+            os.environ.pop('NIDATA_IMAGE_CACHE_DIR', None)
+            assert_true(ImageCache.from_environ() is None)
+            os.environ['NIDATA_IMAGE_CACHE_DIR'] = self.cache_dir
+            os.environ['NIDATA_IMAGE_CACHE_SIZE'] = '1G'
+            cache = ImageCache.from_environ()
+            assert_equal(cache.store.max_bytes, 1024 ** 3)
+            assert_true(ImageCache.from_environ() is cache)
+            path = self.save('img.nii.gz', self.data)
+            assert_true(load_niimg(path).get_filename().startswith(
+                self.cache_dir))
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+
+class _Response(object):
+    """Response of a fake server, logging the size of reads."""
+
+    def __init__(self, data, readinto=True):
+        self.fp = io.BytesIO(data)
+        self.read_sizes = []
+        if readinto:
+            self.readinto = self._readinto
+
+    def info(self):
+        return dict()
+
+    def read(self, size):
+        self.read_sizes.append(size)
+        return self.fp.read(size)
+
+    def _readinto(self, b):
+        self.read_sizes.append(len(b))
+        return self.fp.readinto(b)
+
+
+class ChunkReadTest(TestCase):
+    def test_chunk_read(self):
+        data = os.urandom(3 * 1024 * 1024 + 17)
+        for readinto in (True, False):
+            response = _Response(data, readinto=readinto)
+            local_file = io.BytesIO()
+            hasher = hashlib.sha256()
+            stats = FetchStats()
+            _chunk_read_(response, local_file, chunk_size=4096,
+                         report_hook=False, verbose=0, hasher=hasher,
+                         stats=stats, max_chunk_size=256 * 1024)
+            assert_equal(local_file.getvalue(), data)
+            assert_equal(hasher.hexdigest(), hashlib.sha256(data).hexdigest())
+            assert_equal(stats.bytes, len(data))
+            # Fast reads grow up to max_chunk_size.
+            assert_equal(max(response.read_sizes), 256 * 1024)
+            assert_true(len(response.read_sizes) < 30)
+
+    def test_copy_file(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            src = op.join(temp_dir, 'src')
+            with open(src, 'wb') as fp:
+                fp.write(os.urandom(100000))
+            for name in ('dst', 'empty'):
+                if name == 'empty':
+                    open(src, 'wb').close()
+                dst = op.join(temp_dir, name)
+                copy_file(src, dst)
+                assert_equal(hash_file(dst), hash_file(src))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+class ExtractTest(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.contents = dict(('sub%02d/file%03d.nii' % (fi % 4, fi),
+                              os.urandom(100) * (fi + 1))
+                             for fi in range(40))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def assert_extracted(self, names, n_bytes=None, stats=None):
+        extracted = set()
+        for root, dirs, files in os.walk(self.temp_dir):
+            extracted.update(op.relpath(op.join(root, name), self.temp_dir)
+                             .replace(os.sep, '/') for name in files)
+        assert_equal(extracted, set(names))
+        for name in names:
+            with open(op.join(self.temp_dir, name), 'rb') as fp:
+                assert_equal(fp.read(), self.contents[name])
+        if stats is not None:
+            assert_equal(stats.extracted_bytes,
+                         sum(len(self.contents[name]) for name in names))
+
+    def test_parallel_zip(self):
+        archive = op.join(self.temp_dir, 'archive.zip')
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as z:
+            for name, data in sorted(self.contents.items()):
+                z.writestr(name, data)
+        stats = FetchStats()
+        _uncompress_file(archive, verbose=0, max_workers=4, stats=stats,
+                         members=['sub01', 'sub02/file002.nii'])
+        self.assert_extracted(
+            [name for name in self.contents
+             if name.startswith('sub01/') or name == 'sub02/file002.nii'],
+            stats=stats)
+        assert_true(stats.seconds['extract'] > 0)
+
+    @unittest.skipIf(os.name != 'posix', 'needs a shell script')
+    def test_parallel_decompressor(self):
+        # A pigz standing for the real one, to take the subprocess path.
+        bin_dir = op.join(self.temp_dir, 'bin')
+        os.makedirs(bin_dir)
+        with open(op.join(bin_dir, 'pigz'), 'w') as fp:
+            fp.write('#!/bin/sh\ntouch %s/ran\nexec gzip "$@"\n' % bin_dir)
+        os.chmod(op.join(bin_dir, 'pigz'), 0o755)
+        path = os.environ['PATH']
+        data_dir = op.join(self.temp_dir, 'data')
+        os.makedirs(data_dir)
+        archive = op.join(data_dir, 'archive.tar.gz')
+        with tarfile.open(archive, 'w:gz') as tar:
+            for name, data in sorted(self.contents.items()):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        for use_pigz in (True, False):
+            os.environ['PATH'] = (bin_dir + os.pathsep + path if use_pigz
+                                  else path)
+            try:
+                stats = FetchStats()
+                _uncompress_file(archive, verbose=0, delete_archive=False,
+                                 members=['sub03'], stats=stats)
+            finally:
+                os.environ['PATH'] = path
+            assert_equal(op.exists(op.join(bin_dir, 'ran')), use_pigz)
+            if use_pigz:
+                os.remove(op.join(bin_dir, 'ran'))
+            for name in self.contents:
+                path_ = op.join(data_dir, name)
+                if name.startswith('sub03/'):
+                    with open(path_, 'rb') as fp:
+                        assert_equal(fp.read(), self.contents[name])
+                else:
+                    assert_true(not op.exists(path_))
+            assert_equal(stats.extracted_bytes, sum(
+                len(data) for name, data in self.contents.items()
+                if name.startswith('sub03/')))
+            shutil.rmtree(op.join(data_dir, 'sub03'))
+
+
+class ChecksumTest(HttpFetchTestCase):
+    def digest(self, name, algorithm='md5'):
+        return hashlib.new(algorithm,
+                           self.contents[name].encode('utf-8')).hexdigest()
+
+    def test_checksums(self):
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            files[0][2]['md5sum'] = self.digest(files[0][0])
+            files[1][2]['checksum'] = 'sha256:' + self.digest(files[1][0],
+                                                              'sha256')
+            out_files = fetch_files(self.data_dir, files, verbose=0)
+            self.assert_fetched(out_files, files)
+            assert_equal(DownloadManifest(self.data_dir).get(
+                files[1][0])['digests'],
+                dict(sha256=self.digest(files[1][0], 'sha256')))
+
+            # Corrupted downloads are not kept.
+            name, url, opts = files[2]
+            data_dir = op.join(self.data_dir, 'corrupted')
+            assert_raises(ValueError, _fetch_file, url, data_dir, verbose=0,
+                          md5sum=self.digest(files[3][0]))
+            assert_equal(os.listdir(data_dir), [])
+            os.rmdir(data_dir)
+
+    def test_resumed_download_checksum(self):
+        name = sorted(self.contents)[-1]
+        with open(op.join(self.data_dir, op.basename(name) + '.part'),
+                  'wb') as fp:
+            fp.write(self.contents[name][:10].encode('utf-8'))
+        with serve_directory(self.src_dir) as server:
+            path = _fetch_file(server.url + name, self.data_dir, verbose=0,
+                               checksum='blake2b:' + self.digest(name,
+                                                                 'blake2b'))
+            assert_equal(hash_file(path, 'blake2b'),
+                         self.digest(name, 'blake2b'))
+
+    def test_verify_files(self):
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            fetch_files(self.data_dir, files, verbose=0)
+        checksums = [(name, 'sha256:' + self.digest(name, 'sha256'))
+                     for name, url, opts in files]
+        assert_equal(verify_files(self.data_dir, checksums, verbose=0), [])
+        manifest = DownloadManifest(self.data_dir)
+        assert_equal(manifest.get_digest(files[0][0], 'sha256'),
+                     self.digest(files[0][0], 'sha256'))
+
+        # Changed files are hashed again.
+        with open(op.join(self.data_dir, files[0][0]), 'ab') as fp:
+            fp.write(b'more')
+        assert_equal(verify_files(self.data_dir, checksums, verbose=0),
+                     [files[0][0]])
+
+
+class _TrackingPool(HttpConnectionPool):
+    """Connection pool remembering the connections it hands out."""
+
+    def __init__(self, *args, **kwargs):
+        super(_TrackingPool, self).__init__(*args, **kwargs)
+        self.acquired = []
+
+    def acquire(self, key, factory):
+        conn, reused = super(_TrackingPool, self).acquire(key, factory)
+        self.acquired.append(conn)
+        return conn, reused
+
+    def assert_released(self):
+        # Connections are all idle in the pool, or closed.
+        idle = [conn for conns in self._idle.values() for conn in conns]
+        assert_true(all(conn in idle or conn.sock is None
+                        for conn in self.acquired))
+
+
+class KeepAliveTest(HttpFetchTestCase):
+    def test_connections_are_reused(self):
+        fetcher = HttpFetcher(data_dir=self.data_dir)
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            out_files = fetcher.fetch(files, verbose=0)
+            assert_equal(server.n_connections, 1)
+        self.assert_fetched(out_files, files)
+        assert_equal(fetcher.connection_pool.n_connections, 1)
+
+    def test_concurrent_connections_are_bounded(self):
+        fetcher = HttpFetcher(data_dir=self.data_dir, max_workers=3)
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            out_files = fetcher.fetch(files, verbose=0)
+            assert_true(server.n_connections <= 3)
+        self.assert_fetched(out_files, files)
+
+    def test_server_closing_connections(self):
+        fetcher = HttpFetcher(data_dir=self.data_dir)
+        with serve_directory(self.src_dir,
+                             protocol_version='HTTP/1.0') as server:
+            files = self.files(server)
+            out_files = fetcher.fetch(files, verbose=0)
+            assert_equal(server.n_connections, len(files))
+        self.assert_fetched(out_files, files)
+
+
+    def test_failed_resume_releases_connection(self):
+        name = sorted(self.contents)[-1]
+        with open(op.join(self.data_dir, op.basename(name) + '.part'),
+                  'wb') as fp:
+            fp.write(self.contents[name][:5].encode('utf-8'))
+        pool = _TrackingPool()
+        with serve_directory(self.src_dir, accept_ranges=False) as server:
+            _fetch_file(server.url + name, self.data_dir, verbose=0,
+                        connection_pool=pool)
+        with open(op.join(self.data_dir, op.basename(name))) as fp:
+            assert_equal(fp.read(), self.contents[name])
+        assert_equal(len(pool.acquired), 2)
+        pool.assert_released()
+
+    def test_error_responses_release_connection(self):
+        pool = _TrackingPool()
+        with serve_directory(self.src_dir) as server:
+            url = server.url + 'missing'  # 404, with a body
+            opener = _get_url_opener(url, connection_pool=pool)
+            assert_equal(_get_range_size(opener, _make_request(url)), None)
+            assert_equal(_get_url_size(url, dict(), connection_pool=pool),
+                         None)
+        assert_equal(len(pool.acquired), 2)
+        pool.assert_released()
+
+
+class SegmentedDownloadTest(TestCase):
+    size = 200003
+
+    def setUp(self):
+        self.src_dir = tempfile.mkdtemp()
+        self.data_dir = tempfile.mkdtemp()
+        self.contents = os.urandom(self.size)
+        with open(op.join(self.src_dir, 'big.tgz'), 'wb') as fp:
+            fp.write(self.contents)
+
+    def tearDown(self):
+        shutil.rmtree(self.src_dir)
+        shutil.rmtree(self.data_dir)
+
+    def fetch(self, server, **kwargs):
+        path = _fetch_file(server.url + 'big.tgz', self.data_dir, verbose=0,
+                           n_segments=4, min_segment_size=1000, **kwargs)
+        with open(path, 'rb') as fp:
+            assert_equal(fp.read(), self.contents)
+        assert_equal(os.listdir(self.data_dir), ['big.tgz'])
+
+    def test_segmented(self):
+        with serve_directory(self.src_dir) as server:
+            self.fetch(server)
+            # One probe, and one request per segment.
+            assert_equal(server.n_requests, 5)
+
+    def test_resume_segments(self):
+        # Each segment was half downloaded when the process died.
+        part_file = op.join(self.data_dir, 'big.tgz.part')
+        step = self.size // 4
+        segments = []
+        with open(part_file, 'wb') as fp:
+            fp.truncate(self.size)
+            for si in range(4):
+                start = si * step
+                end = self.size - 1 if si == 3 else start + step - 1
+                offset = start + step // 2
+                fp.seek(start)
+                fp.write(self.contents[start:offset])
+                segments.append([start, end, offset])
+        with open(part_file + '.segments', 'w') as fp:
+            json.dump(dict(size=self.size, segments=segments), fp)
+
+        with serve_directory(self.src_dir) as server:
+            self.fetch(server)
+            assert_equal(server.n_requests, 4)
+
+    def test_no_range_support(self):
+        with serve_directory(self.src_dir, accept_ranges=False) as server:
+            self.fetch(server)
+            assert_equal(server.n_requests, 2)
+
+
+class ArchiveTest(HttpFetchTestCase):
+    def make_tarball(self, name='archive.tar.gz', mode='w:gz'):
+        with tarfile.open(op.join(self.src_dir, name), mode) as tar:
+            for member in sorted(self.contents):
+                tar.add(op.join(self.src_dir, member), arcname=member)
+        return name
+
+    def fetch_archive(self, server, name, **kwargs):
+        files = [(member, server.url + name, dict(uncompress=True))
+                 for member in sorted(self.contents)]
+        return fetch_files(self.data_dir, files, verbose=0, **kwargs), files
+
+    def test_extract(self):
+        name = self.make_tarball()
+        with serve_directory(self.src_dir) as server:
+            out_files, files = self.fetch_archive(server, name)
+        self.assert_fetched(out_files, files)
+
+    def test_stream_extract(self):
+        for name, mode in (('archive.tgz', 'w:gz'),
+                           ('archive.tar.bz2', 'w:bz2'),
+                           ('archive.tar', 'w')):
+            self.make_tarball(name, mode)
+            with serve_directory(self.src_dir) as server:
+                out_files, files = self.fetch_archive(server, name,
+                                                      stream=True)
+                assert_equal(server.n_requests, 1)
+            self.assert_fetched(out_files, files)
+            shutil.rmtree(self.data_dir)
+            os.makedirs(self.data_dir)
+
+    def test_stream_keep_archive(self):
+        name = self.make_tarball()
+        with serve_directory(self.src_dir) as server:
+            out_files, files = self.fetch_archive(server, name, stream=True,
+                                                  delete_archive=False)
+        with open(op.join(self.src_dir, name), 'rb') as fp:
+            self.contents[name] = fp.read()
+        with open(op.join(self.data_dir, name), 'rb') as fp:
+            assert_equal(fp.read(), self.contents[name])
+
+    def test_extract_requested_members(self):
+        zip_name = 'archive.zip'
+        with zipfile.ZipFile(op.join(self.src_dir, zip_name), 'w') as z:
+            for member in sorted(self.contents):
+                z.write(op.join(self.src_dir, member), arcname=member)
+        names = [self.make_tarball(), zip_name, self.make_tarball(
+            'archive.tgz')]
+        for name, stream in zip(names, (False, False, True)):
+            with serve_directory(self.src_dir) as server:
+                # A whole directory, and a single file.
+                files = [('sub00', server.url + name, dict(uncompress=True)),
+                         ('sub01/file01.txt', server.url + name,
+                          dict(uncompress=True))]
+                fetch_files(self.data_dir, files, verbose=0, stream=stream)
+            assert_equal(sorted(os.listdir(self.data_dir)),
+                         [DownloadManifest.filename, STAGING_DIR, 'sub00',
+                          'sub01'])
+            assert_equal(os.listdir(op.join(self.data_dir, STAGING_DIR)),
+                         [])
+            assert_equal(os.listdir(op.join(self.data_dir, 'sub01')),
+                         ['file01.txt'])
+            assert_equal(len(os.listdir(op.join(self.data_dir, 'sub00'))),
+                         len([c for c in self.contents
+                              if c.startswith('sub00/')]))
+            shutil.rmtree(self.data_dir)
+            os.makedirs(self.data_dir)
+
+
+class S3DownloaderTest(TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.contents = dict(('sub%02d/file.nii' % ki, os.urandom(1000 * ki))
+                             for ki in range(1, 9))
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def download(self, conn, key_names, **kwargs):
+        kwargs.setdefault('retry', RetryPolicy(backoff=0.))
+        downloader = S3Downloader(conn, verbose=0, **kwargs)
+        return downloader.download([
+            ('bucket', key_name, op.join(self.data_dir, key_name))
+            for key_name in key_names])
+
+    def assert_downloaded(self, key_names):
+        for key_name in key_names:
+            with open(op.join(self.data_dir, key_name), 'rb') as fp:
+                assert_equal(fp.read(), self.contents[key_name])
+
+    def test_concurrent_keys(self):
+        conn = FakeS3Connection(dict(bucket=self.contents))
+        key_names = sorted(self.contents) + ['missing']
+        files = self.download(conn, key_names, max_workers=4)
+        assert_equal(files[-1], None)
+        assert_equal(files[:-1], [op.join(self.data_dir, key_name)
+                                  for key_name in key_names[:-1]])
+        self.assert_downloaded(key_names[:-1])
+        assert_equal(conn.n_gets, len(self.contents))
+
+    def test_ranged_parts(self):
+        conn = FakeS3Connection(dict(bucket=self.contents))
+        key_name = sorted(self.contents)[-1]  # 8000 bytes
+        self.download(conn, [key_name], max_workers=3, part_size=3000,
+                      multipart_threshold=5000)
+        self.assert_downloaded([key_name])
+        assert_equal(sorted(conn.ranges), ['bytes=0-2999', 'bytes=3000-5999',
+                                           'bytes=6000-7999'])
+
+    def test_retries(self):
+        conn = FakeS3Connection(dict(bucket=self.contents), n_failures=2)
+        self.download(conn, sorted(self.contents), max_workers=2)
+        self.assert_downloaded(sorted(self.contents))
+        assert_equal(conn.n_gets, len(self.contents) + 2)
+
+        conn = FakeS3Connection(dict(bucket=self.contents), n_failures=2)
+        assert_raises(IOError, self.download, conn, sorted(self.contents),
+                      max_workers=1,
+                      retry=RetryPolicy(max_retries=1, backoff=0.))
+
+    def test_failed_key_keeps_others(self):
+        key_names = sorted(self.contents)
+        conn = FakeS3Connection(dict(bucket=self.contents),
+                                failing_keys=key_names[-1:])
+        assert_raises(IOError, self.download, conn, key_names,
+                      max_workers=1, part_size=3000, multipart_threshold=5000,
+                      retry=RetryPolicy(max_retries=0, backoff=0.))
+        # Keys downloaded before the failure are installed, without their
+        # temporary file.
+        self.assert_downloaded(key_names[:-1])
+        for key_name in key_names[:-1]:
+            assert_true(not op.exists(
+                op.join(self.data_dir, key_name + '.part')))
+        assert_true(not op.exists(op.join(self.data_dir, key_names[-1])))
+
+    def test_events(self):
+        conn = FakeS3Connection(dict(bucket=self.contents), n_failures=1)
+        key_name = sorted(self.contents)[-1]  # 8000 bytes
+        log = EventLog()
+        bus = EventBus()
+        bus.add_listener(log)
+        self.download(conn, [key_name], max_workers=3, part_size=3000,
+                      multipart_threshold=5000, events=bus)
+        assert_equal([event['event'] for event in log],
+                     ['started', 'retry', 'fetched'])
+        assert_equal(log[-1]['bytes'], 8000)
+        assert_equal(log[-1]['attempts'], 4)
+
+    def test_progress(self):
+        conn = FakeS3Connection(dict(bucket=self.contents))
+        downloader = S3Downloader(conn, max_workers=3, part_size=3000,
+                                  multipart_threshold=5000,
+                                  retry=RetryPolicy(backoff=0.))
+        stdout, stderr = sys.stdout, sys.stderr
+        try:
+            sys.stdout, sys.stderr = io.StringIO(), io.StringIO()
+            downloader.download([
+                ('bucket', key_name, op.join(self.data_dir, key_name))
+                for key_name in sorted(self.contents)])
+            report = sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        total = sum(len(data) for data in self.contents.values())
+        last_report = report.rstrip('\n').split('\r')[-2]
+        assert_true(last_report.startswith(
+            'Downloaded %d of %d bytes (100.00%%' % (total, total)))
+
+    def test_bandwidth_limit(self):
+        bucket = TokenBucket(rate=100000, capacity=1000)
+        t0 = time.time()
+        for _ in range(10):
+            bucket.consume(5000)
+        # 50kB at 100kB/s, less the initial burst.
+        assert_true(time.time() - t0 >= 0.45)
+
+
+class S3CheckTest(TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def key_for(self, path):
+        with open(path, 'rb') as fp:
+            return FakeS3Key(None, op.basename(path), fp.read())
+
+    def test_size_and_etag(self):
+        path = op.join(self.data_dir, 'file.txt')
+        with open(path, 'wb') as fp:
+            fp.write(b'0123456789')
+        key = self.key_for(path)
+        for mode in ('size', 'etag', 'header', 'full'):
+            assert_true(check_s3_file(path, lambda: key, mode))
+        with open(path, 'wb') as fp:
+            fp.write(b'012345678X')
+        assert_true(check_s3_file(path, lambda: key, 'size'))
+        assert_true(not check_s3_file(path, lambda: key, 'etag'))
+        # Multipart ETags are not md5 sums.
+        key.etag = '"%s-2"' % key.etag.strip('"')
+        assert_true(check_s3_file(path, lambda: key, 'etag'))
+        key.size += 1
+        assert_true(not check_s3_file(path, lambda: key, 'size'))
+        assert_true(not check_s3_file(op.join(self.data_dir, 'missing'),
+                                      lambda: key, 'size'))
+
+    def test_recorded_etag(self):
+        path = op.join(self.data_dir, 'file.txt')
+        with open(path, 'wb') as fp:
+            fp.write(b'0123456789')
+        key = self.key_for(path)
+        manifest = DownloadManifest(self.data_dir)
+        manifest.add('file.txt', url='file.txt', etag=key.etag)
+        assert_true(_check_recorded_etag(manifest, 'file.txt'))
+        # The md5 sum is recorded, and not computed again.
+        manifest.set_digest('file.txt', 'md5', 'recorded')
+        assert_true(not _check_recorded_etag(manifest, 'file.txt'))
+
+        # A file of the same size, with other contents.
+        stat = os.stat(path)
+        with open(path, 'wb') as fp:
+            fp.write(b'012345678X')
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+        manifest.add('file.txt', url='file.txt', etag=key.etag)
+        assert_true(not _check_recorded_etag(manifest, 'file.txt'))
+        manifest.add('file.txt', url='file.txt')
+        assert_true(not _check_recorded_etag(manifest, 'file.txt'))
+        manifest.add('file.txt', url='file.txt', etag='"abc-2"')
+        assert_true(_check_recorded_etag(manifest, 'file.txt'))
+
+    def test_header(self):
+        path = op.join(self.data_dir, 'img.nii')
+        nib.save(nib.Nifti1Image(np.ones((10, 10, 10), dtype=np.float32),
+                                 np.eye(4)), path)
+
+        def no_key():
+            raise AssertionError('Image checks need no request.')
+        assert_true(check_s3_file(path, no_key, 'header'))
+        assert_true(check_s3_file(path, no_key, 'full'))
+
+        # Truncated image.
+        with open(path, 'r+b') as fp:
+            fp.truncate(op.getsize(path) - 100)
+        assert_true(not check_s3_file(path, no_key, 'header'))
+        assert_true(not check_s3_file(path, no_key, 'full'))
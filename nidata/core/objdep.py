@@ -3,21 +3,53 @@ Functions for dynamically managing dependencies.
 """
 
 import importlib
+import os
 import subprocess
+import threading
 import warnings
 
-import pip
 from six import with_metaclass
 
+# Dependencies known to be importable, and classes whose dependencies are
+# all satisfied; both are cleared whenever something gets installed.
+_satisfied_dependencies = set()
+_satisfied_classes = set()
+_resolution_lock = threading.Lock()
+
+# Set NIDATA_NO_INSTALL to a non-empty value to never run pip; missing
+# dependencies then raise an ImportError.
+_no_install = bool(os.environ.get('NIDATA_NO_INSTALL'))
+
+
+def set_no_install(no_install=True):
+    """Forbid (or allow again) installing missing dependencies with pip."""
+    global _no_install
+    _no_install = no_install
+
+
+def clear_dependency_cache():
+    """Forget which dependencies were found; they are imported again the
+    next time they are checked."""
+    with _resolution_lock:
+        _satisfied_dependencies.clear()
+        _satisfied_classes.clear()
+    if hasattr(importlib, 'invalidate_caches'):  # python 3
+        importlib.invalidate_caches()
+
 
 def install_dependency(module_name, install_info=None, verify=False):
     """
     TODO: install_dependency docstring.
     """
     install_info = install_info or module_name
+    if _no_install:
+        raise ImportError("Dependency %s is missing, and installing "
+                          "dependencies is disabled (NIDATA_NO_INSTALL)."
+                          % module_name)
 
     # Install it.
     try:
+        import pip  # slow to import; only needed here.
         print("Installing %s from %s..." % (module_name, install_info))
         rv = pip.main(['install', install_info])
         if rv != 0:
@@ -25,6 +57,8 @@ def install_dependency(module_name, install_info=None, verify=False):
     except Exception as ex:
         print("Exception while installing %s: %s" % (module_name, ex))
         return False
+    finally:
+        clear_dependency_cache()
 
     # Verify it
     if verify:
@@ -43,11 +77,16 @@ def get_missing_dependencies(dependencies):
     """
     missing_dependencies = []
     for dep in dependencies:
+        if dep in _satisfied_dependencies:
+            continue
         try:
             importlib.import_module(dep)
         except ImportError:  # as ie:
             # print('Import error: %s' % str(ie))
             missing_dependencies.append(dep)
+        else:
+            with _resolution_lock:
+                _satisfied_dependencies.add(dep)
     return missing_dependencies
 
 
@@ -86,7 +125,13 @@ class ClassWithDependencies(with_metaclass(DependenciesMeta, object)):
         TODO: install_missing_dependencies docstring
         """
         if dependencies is None:
+            if cls in _satisfied_classes:
+                return  # checked already
             dependencies = cls.get_missing_dependencies()
+            if not dependencies:
+                with _resolution_lock:
+                    _satisfied_classes.add(cls)
+                return
         for dep in dependencies:
             print("Installing missing dependencies '%s', for %s" % (
                 dep, str(cls)))
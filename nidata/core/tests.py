@@ -0,0 +1,53 @@
+import os
+import shutil
+import sys
+import tempfile
+from unittest import TestCase
+
+from nose.tools import assert_equal, assert_raises, assert_true
+
+from nidata.core import objdep
+from nidata.core.objdep import ClassWithDependencies
+
+
+class DependencyCacheTest(TestCase):
+    def setUp(self):
+        # A dependency that can be "installed" by writing a module.
+        self.module_dir = tempfile.mkdtemp()
+        sys.path.insert(0, self.module_dir)
+        self.module_name = 'nidata_test_dependency_%d' % os.getpid()
+        objdep.clear_dependency_cache()
+
+    def tearDown(self):
+        sys.path.remove(self.module_dir)
+        sys.modules.pop(self.module_name, None)
+        shutil.rmtree(self.module_dir)
+        objdep.set_no_install(False)
+        objdep.clear_dependency_cache()
+
+    def make_class(self):
+        class WithDependency(ClassWithDependencies):
+            dependencies = [self.module_name, 'os']
+        return WithDependency
+
+    def install(self):
+        with open(os.path.join(self.module_dir,
+                               self.module_name + '.py'), 'w') as fp:
+            fp.write('\n')
+
+    def test_no_install(self):
+        cls = self.make_class()
+        objdep.set_no_install()
+        assert_raises(ImportError, cls)
+        assert_equal(cls.get_missing_dependencies(), [self.module_name])
+
+        # Found once installed; then not looked up anymore.
+        self.install()
+        objdep.clear_dependency_cache()
+        cls()
+        assert_true(cls in objdep._satisfied_classes)
+        assert_true(self.module_name in objdep._satisfied_dependencies)
+        sys.modules.pop(self.module_name)
+        os.remove(os.path.join(self.module_dir, self.module_name + '.py'))
+        cls()
+        assert_equal(cls.get_missing_dependencies(), [])
@@ -2,23 +2,18 @@ from __future__ import division, print_function, absolute_import
 
 import os
 import os.path as op
-import sys
 import textwrap
-import contextlib
-import zipfile
-
-if sys.version_info[0] < 3:
-    from urllib2 import urlopen
-else:
-    from urllib.request import urlopen
 
 from os.path import join as pjoin
-from hashlib import md5
-from shutil import copyfileobj
 
 import numpy as np
 import nibabel as nib
 
+from ..core._utils.niimg import _take_volumes, load_niimg
+from ..core.fetchers.base import hash_file, verify_files
+from ..core.fetchers.http_fetcher import fetch_files
+from ..core.fetchers.manifest import DownloadManifest
+
 
 class FetcherError(Exception):
     pass
@@ -29,52 +24,182 @@ def _log(msg):
 
 dipy_home = pjoin(op.expanduser('~'), '.dipy')
 
-
-def fetch_data(files, folder):
+# Suffix of the binary sidecars of gradient tables, next to bval files.
+GRADIENTS_SUFFIX = '_gradients.npz'
+
+
+def _verify_unrecorded(folder, files):
+    """Check the md5 sums of files that are in folder but not recorded in
+    its download manifest: downloaded by former versions, or changed since
+    they were downloaded. Those that do not match are removed, to be
+    downloaded again. Verified digests are cached in the manifest, so each
+    file is hashed once."""
+    manifest = DownloadManifest(folder)
+    unrecorded = [(f, md5) for f, (url, md5) in files.items()
+                  if md5 and op.exists(pjoin(folder, f)) and
+                  not manifest.is_fetched(f, url=url, check=True)]
+    if not unrecorded:
+        return
+    failed = verify_files(folder, unrecorded, verbose=0)
+    if not failed:
+        return
+    manifest = DownloadManifest(folder)
+    for f in failed:
+        _log('Removing "%s", which does not have the expected md5 '
+             'checksum' % f)
+        os.remove(pjoin(folder, f))
+        manifest.remove(f)
+    manifest.save()
+
+
+def fetch_data(files, folder, max_workers=4, description=None):
     """Downloads files to folder and checks their md5 checksums
 
+    Files are downloaded concurrently, written to disk as they arrive and
+    hashed while they download. Files are recorded in the download
+    manifest of folder once verified, so fetching them again costs a
+    single read of that manifest.
+
     Parameters
     ----------
     files : dictionary
         For each file in `files` the value should be (url, md5). The file will
         be downloaded from url if the file does not already exist or if the
-        file exists but the md5 checksum does not match.
+        file exists but the md5 checksum does not match. md5 can be None,
+        and url can be shared by several files extracted from the same zip
+        or tar archive, with a md5 of None.
     folder : str
         The directory where to save the file, the directory will be created if
         it does not already exist.
+    max_workers : int, optional
+        Number of files downloaded concurrently.
+    description : str, optional
+        Message logged before files are downloaded, if any is.
 
     Raises
     ------
     FetcherError
         Raises if the md5 checksum of the file does not match the expected
-        value. The downloaded file is not deleted when this error is raised.
+        value. The downloaded file is left in the staging directory of
+        folder when this error is raised.
 
     """
     if not op.exists(folder):
         _log("Creating new folder %s" % (folder))
         os.makedirs(folder)
 
-    all_skip = True
-    for f in files:
+    _verify_unrecorded(folder, files)
+    manifest = DownloadManifest(folder)
+    entries = []
+    for f in sorted(files):
         url, md5 = files[f]
-        fullpath = pjoin(folder, f)
-        if op.exists(fullpath) and (_get_file_md5(fullpath) == md5):
-            continue
-        all_skip = False
-        _log('Downloading "%s" to %s' % (f, folder))
-        _get_file_data(fullpath, url)
-        if _get_file_md5(fullpath) != md5:
-            msg = """The downloaded file, %s, does not have the expected md5
-checksum of "%s". This could mean that that something is wrong with the file or
-that the upstream file has been updated. You can try downloading the file again
-or updating to the newest version of dipy.""" % (fullpath, md5)
-            msg = textwrap.fill(msg)
-            raise FetcherError(msg)
-
-    if all_skip:
+        opts = dict(md5sum=md5) if md5 else dict()
+        if url.endswith(('.zip', '.tar.gz', '.tgz', '.tar.bz2')):
+            opts.update(uncompress=True, extract_all=True)
+        entries.append((f, url, opts))
+    if all(manifest.is_fetched(f, url=url, check=True)
+           for f, url, opts in entries):
         _log("All files already in %s." % (folder))
-    else:
-        _log("Files successfully downloaded to %s" % (folder))
+        return
+
+    if description is not None:
+        _log(description)
+    try:
+        fetch_files(folder, entries, max_workers=max_workers, check=True)
+    except ValueError as exc:  # checksum mismatch
+        msg = """%s This could mean that that something is wrong with the
+file or that the upstream file has been updated. You can try downloading the
+file again or updating to the newest version of dipy.""" % exc
+        raise FetcherError(textwrap.fill(msg))
+    _log("Files successfully downloaded to %s" % (folder))
+
+
+def _read_gradients(fbval, fbvec):
+    """Return the b-values and b-vectors of bval and bvec text files.
+
+    They are parsed once, and saved to a binary sidecar next to fbval
+    (see GRADIENTS_SUFFIX), along with the size and mtime of both files;
+    the sidecar is read instead as long as they do not change.
+    """
+    sidecar = op.splitext(fbval)[0] + GRADIENTS_SUFFIX
+    stats = [os.stat(f) for f in (fbval, fbvec)]
+    stamp = np.array([[st.st_size, st.st_mtime] for st in stats])
+    try:
+        with np.load(sidecar) as gradients:
+            if np.array_equal(gradients['stamp'], stamp):
+                return gradients['bvals'], gradients['bvecs']
+    except (IOError, OSError, KeyError, ValueError):
+        pass  # missing, corrupted, or from another version
+
+    # Same layout rules as dipy.io.gradients.read_bvals_bvecs
+    bvals = np.loadtxt(fbval, ndmin=1).ravel()
+    bvecs = np.loadtxt(fbvec, ndmin=2)
+    if bvecs.shape[1] > bvecs.shape[0] > 1:
+        bvecs = bvecs.T
+    if bvecs.shape[1] != 3:
+        raise IOError('bvec file should have three rows: %s' % fbvec)
+    if len(bvals) != len(bvecs):
+        raise IOError('b-values and b-vectors shapes do not correspond: '
+                      '%s, %s' % (fbval, fbvec))
+
+    temp_file = '%s.%d.tmp.npz' % (sidecar, os.getpid())
+    try:
+        np.savez(temp_file, bvals=bvals, bvecs=bvecs, stamp=stamp)
+        os.rename(temp_file, sidecar)
+    except (IOError, OSError):
+        pass  # read-only dataset
+    return bvals, bvecs
+
+
+def _load_image(filename, mmap=True, cache=None):
+    """Load an image. If mmap is True, images are memory mapped; gzipped
+    images are loaded from their decompressed copy (made on first use) in
+    cache, or in the image cache configured by NIDATA_IMAGE_CACHE_DIR (see
+    nidata.core.fetchers.cache.ImageCache). Without an image cache, they
+    are read lazily from the compressed file."""
+    if not mmap:
+        return nib.load(filename)
+    return load_niimg(filename, cache=cache)
+
+
+def _read_dwi(fraw, fbval, fbvec, shells=None, shell_tolerance=50,
+              mmap=True, normalize_bvecs=False, cache=None):
+    """Return the DWI image, b-values and b-vectors of a dataset, restricted
+    to the volumes of the given shells.
+
+    Parameters
+    ----------
+    fraw, fbval, fbvec : str
+        DWI image, bval and bvec files.
+    shells : list of float, optional
+        b-values of the volumes to return (0 for b=0 volumes); all volumes
+        are returned if None.
+    shell_tolerance : float, optional
+        Volumes whose b-value is within this tolerance of one of the shells
+        are returned.
+    mmap : bool, optional
+        If True, the image is memory mapped (see _load_image).
+    normalize_bvecs : bool, optional
+        If True, b-vectors (except the first one) are normalized.
+    cache : ImageCache, optional
+        Image cache of memory mapped images (see _load_image).
+    """
+    bvals, bvecs = _read_gradients(fbval, fbvec)
+    if normalize_bvecs:
+        bvecs = bvecs.copy()
+        norms = np.sqrt(np.sum(bvecs[1:] * bvecs[1:], axis=1))
+        bvecs[1:] = bvecs[1:] / norms[:, None]
+    img = _load_image(fraw, mmap=mmap, cache=cache)
+    if shells is not None:
+        distances = np.abs(bvals[:, np.newaxis] -
+                           np.asarray(shells, dtype=float)[np.newaxis])
+        keep = np.where(np.any(distances <= shell_tolerance, axis=1))[0]
+        if len(keep) == 0:
+            raise ValueError('No volume in shells %s; b-values are %s' % (
+                shells, np.unique(bvals)))
+        img = _take_volumes(img, keep)
+        bvals, bvecs = bvals[keep], bvecs[keep]
+    return img, bvals, bvecs
 
 
 def fetch_scil_b0():
@@ -84,26 +209,18 @@ def fetch_scil_b0():
     zipname = 'datasets_multi-site_all_companies'
     url = 'http://scil.dinf.usherbrooke.ca/wp-content/data/'
     uraw = url + zipname + '.zip'
-    folder = pjoin(dipy_home, zipname)
 
-    if not op.exists(folder):
-        print('Creating new directory %s' % folder)
-        os.makedirs(folder)
-        print('Downloading SCIL b=0 datasets from multiple sites and multiple companies (9.2MB)...')
-        opener = urlopen(uraw)
-        open(folder+'.zip', 'wb').write(opener.read())
-
-        print('Unziping '+folder+'.zip ...')
-        zip = zipfile.ZipFile(folder+'.zip', 'r')
-        zip.extractall(dipy_home)
-
-        print('Done.')
-        print('Files copied in folder %s' % dipy_home)
-    else:
-        print('Dataset already in place. If you want to fetch again please first remove folder %s ' % dipy_home)
+    # The whole archive is extracted; these are the files read from it.
+    files = {}
+    for field, company in (('3T', 'GE'), ('1.5T', 'Siemens')):
+        files[pjoin(zipname, field, company, 'b0.nii.gz')] = (uraw, None)
+    fetch_data(files, dipy_home,
+               description='Downloading SCIL b=0 datasets from multiple '
+                           'sites and multiple companies (9.2MB)...')
+    return files, dipy_home
 
 
-def read_scil_b0():
+def read_scil_b0(mmap=True):
     """ Load GE 3T b0 image form the scil b0 dataset.
 
     Returns
@@ -117,10 +234,10 @@ def read_scil_b0():
                  'GE',
                  'b0.nii.gz')
 
-    return nib.load(file)
+    return _load_image(file, mmap=mmap)
 
 
-def read_siemens_scil_b0():
+def read_siemens_scil_b0(mmap=True):
     """ Load Siemens 1.5T b0 image form the scil b0 dataset.
 
     Returns
@@ -134,22 +251,17 @@ def read_siemens_scil_b0():
                  'Siemens',
                  'b0.nii.gz')
 
-    return nib.load(file)
-
-
-def _get_file_md5(filename):
-    """Compute the md5 checksum of a file"""
-    md5_data = md5()
-    with open(filename, 'rb') as f:
-        for chunk in iter(lambda: f.read(128*md5_data.block_size), b''):
-            md5_data.update(chunk)
-    return md5_data.hexdigest()
+    return _load_image(file, mmap=mmap)
 
 
 def check_md5(filename, stored_md5):
     """
     Computes the md5 of filename and check if it matches with the supplied string md5
 
+    The verified md5 is cached in the download manifest of the folder of
+    filename, along with its size and mtime, so an unchanged file is only
+    hashed once.
+
     Input
     -----
     filename : string
@@ -158,53 +270,46 @@ def check_md5(filename, stored_md5):
         Known md5 of filename to check against.
 
     """
-    computed_md5 = _get_file_md5(filename)
-    if stored_md5 != computed_md5:
+    folder, name = op.split(filename)
+    if verify_files(folder, [(name, stored_md5)], max_workers=1, verbose=0):
+        computed_md5 = hash_file(filename, 'md5')
         print ("MD5 checksum of filename", filename, "failed. Expected MD5 was", stored_md5,
                "but computed MD5 was", computed_md5, '\n',
                "Please check if the data has been downloaded correctly or if the upstream data has changed.")
 
 
-def _get_file_data(fname, url):
-    with contextlib.closing(urlopen(url)) as opener:
-        with open(fname, 'wb') as data:
-            copyfileobj(opener, data)
-
-
 def fetch_isbi2013_2shell():
     """ Download a 2-shell software phantom dataset
     """
     url = 'https://dl.dropboxusercontent.com/u/2481924/isbi2013_merlet/'
-    uraw = url + '2shells-1500-2500-N64-SNR-30.nii.gz'
-    ubval = url + '2shells-1500-2500-N64.bval'
-    ubvec = url + '2shells-1500-2500-N64.bvec'
     folder = pjoin(dipy_home, 'isbi2013')
-
-    md5_list = ['42911a70f232321cf246315192d69c42', # data
-                '90e8cf66e0f4d9737a3b3c0da24df5ea', # bval
-                '4b7aa2757a1ccab140667b76e8075cb1'] # bvec
-
-    url_list = [uraw, ubval, ubvec]
-    fname_list = ['phantom64.nii.gz', 'phantom64.bval', 'phantom64.bvec']
-
-    if not op.exists(folder):
-        print('Creating new directory %s' % folder)
-        os.makedirs(folder)
-        print('Downloading raw 2-shell synthetic data (20MB)...')
-
-        for i in range(len(md5_list)):
-            _get_file_data(pjoin(folder, fname_list[i]), url_list[i])
-            check_md5(pjoin(folder, fname_list[i]), md5_list[i])
-
-        print('Done.')
-        print('Files copied in folder %s' % folder)
-    else:
-        print('Dataset is already in place. If you want to fetch it again, please first remove the folder %s ' % folder)
+    files = {'phantom64.nii.gz': (url + '2shells-1500-2500-N64-SNR-30.nii.gz',
+                                  '42911a70f232321cf246315192d69c42'),
+             'phantom64.bval': (url + '2shells-1500-2500-N64.bval',
+                                '90e8cf66e0f4d9737a3b3c0da24df5ea'),
+             'phantom64.bvec': (url + '2shells-1500-2500-N64.bvec',
+                                '4b7aa2757a1ccab140667b76e8075cb1')}
+    fetch_data(files, folder,
+               description='Downloading raw 2-shell synthetic data (20MB)...')
+    return files, folder
 
 
-def read_isbi2013_2shell():
+def read_isbi2013_2shell(shells=None, shell_tolerance=50, mmap=True):
     """ Load ISBI 2013 2-shell synthetic dataset
 
+    Parameters
+    ----------
+    shells : list of float, optional
+        b-values of the volumes to read (0 for b=0 volumes), e.g. to read
+        a single shell; all volumes are read if None.
+    shell_tolerance : float, optional
+        Volumes whose b-value is within this tolerance of one of the shells
+        are read.
+    mmap : bool, optional
+        If True, the image is memory mapped; if an image cache is configured
+        (see nidata.core.fetchers.cache.ImageCache), it is decompressed
+        there once, and the copy is memory mapped.
+
     Returns
     -------
     img : obj,
@@ -225,12 +330,12 @@ def read_isbi2013_2shell():
     check_md5(fbval, md5_dict['bval'])
     check_md5(fbvec, md5_dict['bvec'])
 
-    from dipy.io.gradients import read_bvals_bvecs
-    bvals, bvecs = read_bvals_bvecs(fbval, fbvec)
+    img, bvals, bvecs = _read_dwi(fraw, fbval, fbvec, shells=shells,
+                                  shell_tolerance=shell_tolerance,
+                                  mmap=mmap)
 
     from dipy.core.gradients import gradient_table
     gtab = gradient_table(bvals, bvecs)
-    img = nib.load(fraw)
     return img, gtab
 
 
@@ -238,36 +343,34 @@ def fetch_sherbrooke_3shell():
     """ Download a 3shell HARDI dataset with 192 gradient directions
     """
     url = 'https://dl.dropboxusercontent.com/u/2481924/sherbrooke_data/'
-    uraw = url + '3shells-1000-2000-3500-N193.nii.gz'
-    ubval = url + '3shells-1000-2000-3500-N193.bval'
-    ubvec = url + '3shells-1000-2000-3500-N193.bvec'
     folder = pjoin(dipy_home, 'sherbrooke_3shell')
-
-    md5_list = ['0b735e8f16695a37bfbd66aab136eb66', # data
-                'e9b9bb56252503ea49d31fb30a0ac637', # bval
-                '0c83f7e8b917cd677ad58a078658ebb7'] # bvec
-
-    url_list = [uraw, ubval, ubvec]
-    fname_list = ['HARDI193.nii.gz', 'HARDI193.bval', 'HARDI193.bvec']
-
-    if not op.exists(folder):
-        print('Creating new directory %s' % folder)
-        os.makedirs(folder)
-        print('Downloading raw 3-shell data (184MB)...')
-
-        for i in range(len(md5_list)):
-            _get_file_data(pjoin(folder, fname_list[i]), url_list[i])
-            check_md5(pjoin(folder, fname_list[i]), md5_list[i])
-
-        print('Done.')
-        print('Files copied in folder %s' % folder)
-    else:
-        print('Dataset is already in place. If you want to fetch it again, please first remove the folder %s ' % folder)
+    files = {'HARDI193.nii.gz': (url + '3shells-1000-2000-3500-N193.nii.gz',
+                                 '0b735e8f16695a37bfbd66aab136eb66'),
+             'HARDI193.bval': (url + '3shells-1000-2000-3500-N193.bval',
+                               'e9b9bb56252503ea49d31fb30a0ac637'),
+             'HARDI193.bvec': (url + '3shells-1000-2000-3500-N193.bvec',
+                               '0c83f7e8b917cd677ad58a078658ebb7')}
+    fetch_data(files, folder,
+               description='Downloading raw 3-shell data (184MB)...')
+    return files, folder
 
 
-def read_sherbrooke_3shell():
+def read_sherbrooke_3shell(shells=None, shell_tolerance=50, mmap=True):
     """ Load Sherbrooke 3-shell HARDI dataset
 
+    Parameters
+    ----------
+    shells : list of float, optional
+        b-values of the volumes to read (0 for b=0 volumes), e.g. to read
+        a single shell; all volumes are read if None.
+    shell_tolerance : float, optional
+        Volumes whose b-value is within this tolerance of one of the shells
+        are read.
+    mmap : bool, optional
+        If True, the image is memory mapped; if an image cache is configured
+        (see nidata.core.fetchers.cache.ImageCache), it is decompressed
+        there once, and the copy is memory mapped.
+
     Returns
     -------
     img : obj,
@@ -287,12 +390,12 @@ def read_sherbrooke_3shell():
     check_md5(fbval, md5_dict['bval'])
     check_md5(fbvec, md5_dict['bvec'])
 
-    from dipy.io.gradients import read_bvals_bvecs
-    bvals, bvecs = read_bvals_bvecs(fbval, fbvec)
+    img, bvals, bvecs = _read_dwi(fraw, fbval, fbvec, shells=shells,
+                                  shell_tolerance=shell_tolerance,
+                                  mmap=mmap)
 
     from dipy.core.gradients import gradient_table
     gtab = gradient_table(bvals, bvecs)
-    img = nib.load(fraw)
     return img, gtab
 
 
@@ -310,16 +413,16 @@ def fetch_stanford_labels():
     return files, folder
 
 
-def read_stanford_labels():
+def read_stanford_labels(mmap=True):
     """Read stanford hardi data and label map"""
     # First get the hardi data
     fetch_stanford_hardi()
-    hard_img, gtab = read_stanford_hardi()
+    hard_img, gtab = read_stanford_hardi(mmap=mmap)
 
     # Fetch and load
     files, folder = fetch_stanford_labels()
     labels_file = pjoin(folder, "aparc-reduced.nii.gz")
-    labels_img = nib.load(labels_file)
+    labels_img = _load_image(labels_file, mmap=mmap)
     return hard_img, gtab, labels_img
 
 
@@ -327,36 +430,34 @@ def fetch_stanford_hardi():
     """ Download a HARDI dataset with 160 gradient directions
     """
     url = 'https://stacks.stanford.edu/file/druid:yx282xq2090/'
-    uraw = url + 'dwi.nii.gz'
-    ubval = url + 'dwi.bvals'
-    ubvec = url + 'dwi.bvecs'
     folder = pjoin(dipy_home, 'stanford_hardi')
-
-    md5_list = ['0b18513b46132b4d1051ed3364f2acbc', # data
-                '4e08ee9e2b1d2ec3fddb68c70ae23c36', # bval
-                '4c63a586f29afc6a48a5809524a76cb4'] # bvec
-
-    url_list = [uraw, ubval, ubvec]
-    fname_list = ['HARDI150.nii.gz', 'HARDI150.bval', 'HARDI150.bvec']
-
-    if not op.exists(folder):
-        print('Creating new directory %s' % folder)
-        os.makedirs(folder)
-        print('Downloading raw HARDI data (87MB)...')
-
-        for i in range(len(md5_list)):
-            _get_file_data(pjoin(folder, fname_list[i]), url_list[i])
-            check_md5(pjoin(folder, fname_list[i]), md5_list[i])
-
-        print('Done.')
-        print('Files copied in folder %s' % folder)
-    else:
-        print('Dataset is already in place. If you want to fetch it again, please first remove the folder %s ' % folder)
+    files = {'HARDI150.nii.gz': (url + 'dwi.nii.gz',
+                                 '0b18513b46132b4d1051ed3364f2acbc'),
+             'HARDI150.bval': (url + 'dwi.bvals',
+                               '4e08ee9e2b1d2ec3fddb68c70ae23c36'),
+             'HARDI150.bvec': (url + 'dwi.bvecs',
+                               '4c63a586f29afc6a48a5809524a76cb4')}
+    fetch_data(files, folder,
+               description='Downloading raw HARDI data (87MB)...')
+    return files, folder
 
 
-def read_stanford_hardi():
+def read_stanford_hardi(shells=None, shell_tolerance=50, mmap=True):
     """ Load Stanford HARDI dataset
 
+    Parameters
+    ----------
+    shells : list of float, optional
+        b-values of the volumes to read (0 for b=0 volumes), e.g. to read
+        a single shell; all volumes are read if None.
+    shell_tolerance : float, optional
+        Volumes whose b-value is within this tolerance of one of the shells
+        are read.
+    mmap : bool, optional
+        If True, the image is memory mapped; if an image cache is configured
+        (see nidata.core.fetchers.cache.ImageCache), it is decompressed
+        there once, and the copy is memory mapped.
+
     Returns
     -------
     img : obj,
@@ -376,12 +477,12 @@ def read_stanford_hardi():
     check_md5(fbval, md5_dict['bval'])
     check_md5(fbvec, md5_dict['bvec'])
 
-    from dipy.io.gradients import read_bvals_bvecs
-    bvals, bvecs = read_bvals_bvecs(fbval, fbvec)
+    img, bvals, bvecs = _read_dwi(fraw, fbval, fbvec, shells=shells,
+                                  shell_tolerance=shell_tolerance,
+                                  mmap=mmap)
 
     from dipy.core.gradients import gradient_table
     gtab = gradient_table(bvals, bvecs)
-    img = nib.load(fraw)
     return img, gtab
 
 
@@ -395,10 +496,10 @@ def fetch_stanford_t1():
     return files, folder
 
 
-def read_stanford_t1():
+def read_stanford_t1(mmap=True):
     files, folder = fetch_stanford_t1()
     f_t1 = pjoin(folder, 't1.nii.gz')
-    img = nib.load(f_t1)
+    img = _load_image(f_t1, mmap=mmap)
     return img
 
 
@@ -418,56 +519,54 @@ def fetch_stanford_pve_maps():
     return files, folder
 
 
-def read_stanford_pve_maps():
+def read_stanford_pve_maps(mmap=True):
     files, folder = fetch_stanford_pve_maps()
     f_pve_csf = pjoin(folder, 'pve_csf.nii.gz')
     f_pve_gm = pjoin(folder, 'pve_gm.nii.gz')
     f_pve_wm = pjoin(folder, 'pve_wm.nii.gz')
-    img_pve_csf = nib.load(f_pve_csf)
-    img_pve_gm = nib.load(f_pve_gm)
-    img_pve_wm = nib.load(f_pve_wm)
+    img_pve_csf = _load_image(f_pve_csf, mmap=mmap)
+    img_pve_gm = _load_image(f_pve_gm, mmap=mmap)
+    img_pve_wm = _load_image(f_pve_wm, mmap=mmap)
     return (img_pve_csf, img_pve_gm, img_pve_wm)
 
 
 def fetch_taiwan_ntu_dsi():
     """ Download a DSI dataset with 203 gradient directions
     """
-    uraw = 'http://dl.dropbox.com/u/2481924/taiwan_ntu_dsi.nii.gz'
-    ubval = 'http://dl.dropbox.com/u/2481924/tawian_ntu_dsi.bval'
-    ubvec = 'http://dl.dropbox.com/u/2481924/taiwan_ntu_dsi.bvec'
-    ureadme = 'http://dl.dropbox.com/u/2481924/license_taiwan_ntu_dsi.txt'
+    url = 'http://dl.dropbox.com/u/2481924/'
     folder = pjoin(dipy_home, 'taiwan_ntu_dsi')
-
-    md5_list = ['950408c0980a7154cb188666a885a91f', # data
-                '602e5cb5fad2e7163e8025011d8a6755', # bval
-                'a95eb1be44748c20214dc7aa654f9e6b', # bvec
-                '7fa1d5e272533e832cc7453eeba23f44'] # license
-
-    url_list = [uraw, ubval, ubvec, ureadme]
-    fname_list = ['DSI203.nii.gz', 'DSI203.bval', 'DSI203.bvec', 'DSI203_license.txt']
-
-    if not op.exists(folder):
-        print('Creating new directory %s' % folder)
-        os.makedirs(folder)
-        print('Downloading raw DSI data (91MB)...')
-
-        for i in range(len(md5_list)):
-            _get_file_data(pjoin(folder, fname_list[i]), url_list[i])
-            check_md5(pjoin(folder, fname_list[i]), md5_list[i])
-
-        print('Done.')
-        print('Files copied in folder %s' % folder)
-        print('See DSI203_license.txt for LICENSE.')
-        print('For the complete datasets please visit :')
-        print('http://dsi-studio.labsolver.org')
-
-    else:
-        print('Dataset is already in place. If you want to fetch it again, please first remove the folder %s ' % folder)
+    files = {'DSI203.nii.gz': (url + 'taiwan_ntu_dsi.nii.gz',
+                               '950408c0980a7154cb188666a885a91f'),
+             'DSI203.bval': (url + 'tawian_ntu_dsi.bval',
+                             '602e5cb5fad2e7163e8025011d8a6755'),
+             'DSI203.bvec': (url + 'taiwan_ntu_dsi.bvec',
+                             'a95eb1be44748c20214dc7aa654f9e6b'),
+             'DSI203_license.txt': (url + 'license_taiwan_ntu_dsi.txt',
+                                    '7fa1d5e272533e832cc7453eeba23f44')}
+    fetch_data(files, folder,
+               description='Downloading raw DSI data (91MB)...')
+    print('See DSI203_license.txt for LICENSE.')
+    print('For the complete datasets please visit :')
+    print('http://dsi-studio.labsolver.org')
+    return files, folder
 
 
-def read_taiwan_ntu_dsi():
+def read_taiwan_ntu_dsi(shells=None, shell_tolerance=50, mmap=True):
     """ Load Taiwan NTU dataset
 
+    Parameters
+    ----------
+    shells : list of float, optional
+        b-values of the volumes to read (0 for b=0 volumes), e.g. to read
+        a single shell; all volumes are read if None.
+    shell_tolerance : float, optional
+        Volumes whose b-value is within this tolerance of one of the shells
+        are read.
+    mmap : bool, optional
+        If True, the image is memory mapped; if an image cache is configured
+        (see nidata.core.fetchers.cache.ImageCache), it is decompressed
+        there once, and the copy is memory mapped.
+
     Returns
     -------
     img : obj,
@@ -489,13 +588,12 @@ def read_taiwan_ntu_dsi():
     check_md5(fbvec, md5_dict['bvec'])
     check_md5(pjoin(folder, 'DSI203_license.txt'), md5_dict['license'])
 
-    from dipy.io.gradients import read_bvals_bvecs
-    bvals, bvecs = read_bvals_bvecs(fbval, fbvec)
-    bvecs[1:] = bvecs[1:] / np.sqrt(np.sum(bvecs[1:] * bvecs[1:], axis=1))[:, None]
+    img, bvals, bvecs = _read_dwi(fraw, fbval, fbvec, shells=shells,
+                                  shell_tolerance=shell_tolerance,
+                                  mmap=mmap, normalize_bvecs=True)
 
     from dipy.core.gradients import gradient_table
     gtab = gradient_table(bvals, bvecs)
-    img = nib.load(fraw)
     return img, gtab
 
 
@@ -503,33 +601,18 @@ def fetch_syn_data():
     """ Download t1 and b0 volumes from the same session
     """
     url = 'https://dl.dropboxusercontent.com/u/5918983/'
-    t1 = url + 't1.nii.gz'
-    b0 = url + 'b0.nii.gz'
-
     folder = pjoin(dipy_home, 'syn_test')
-
-    md5_list = ['701bda02bb769655c7d4a9b1df2b73a6', # t1
-                'e4b741f0c77b6039e67abb2885c97a78'] # b0
-
-    url_list = [t1, b0]
-    fname_list = ['t1.nii.gz', 'b0.nii.gz']
-
-    if not op.exists(folder):
-        print('Creating new directory %s' % folder)
-        os.makedirs(folder)
-        print('Downloading t1 and b0 volumes from the same session (12MB)...')
-
-        for i in range(len(md5_list)):
-            _get_file_data(pjoin(folder, fname_list[i]), url_list[i])
-            check_md5(pjoin(folder, fname_list[i]), md5_list[i])
-
-        print('Done.')
-        print('Files copied in folder %s' % folder)
-    else:
-        print('Dataset is already in place. If you want to fetch it again, please first remove the folder %s ' % folder)
+    files = {'t1.nii.gz': (url + 't1.nii.gz',
+                           '701bda02bb769655c7d4a9b1df2b73a6'),
+             'b0.nii.gz': (url + 'b0.nii.gz',
+                           'e4b741f0c77b6039e67abb2885c97a78')}
+    fetch_data(files, folder,
+               description='Downloading t1 and b0 volumes from the same '
+                           'session (12MB)...')
+    return files, folder
 
 
-def read_syn_data():
+def read_syn_data(mmap=True):
     """ Load t1 and b0 volumes from the same session
 
     Returns
@@ -549,6 +632,6 @@ def read_syn_data():
     check_md5(t1_name, md5_dict['t1'])
     check_md5(b0_name, md5_dict['b0'])
 
-    t1 = nib.load(t1_name)
-    b0 = nib.load(b0_name)
+    t1 = _load_image(t1_name, mmap=mmap)
+    b0 = _load_image(b0_name, mmap=mmap)
     return t1, b0
\ No newline at end of file
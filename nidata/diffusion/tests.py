@@ -0,0 +1,196 @@
+import errno
+import hashlib
+import io
+import os
+import os.path as op
+import shutil
+import sys
+import tempfile
+import zipfile
+from unittest import TestCase
+
+import nibabel as nib
+import numpy as np
+from nose.tools import assert_equal, assert_raises, assert_true
+
+import nidata.diffusion
+from nidata.core._utils.testing import serve_directory
+from nidata.core.fetchers.cache import ImageCache
+from nidata.diffusion import (_read_dwi, _read_gradients, check_md5,
+                              fetch_data, FetcherError, GRADIENTS_SUFFIX)
+
+
+class FetchDataTest(TestCase):
+    def setUp(self):
+        self.src_dir = tempfile.mkdtemp()
+        self.folder = op.join(tempfile.mkdtemp(), 'dataset')
+        self.md5 = dict()
+        for name in ('dwi.nii.gz', 'dwi.bval', 'dwi.bvec'):
+            contents = ('contents of %s\n' % name).encode('utf-8')
+            with open(op.join(self.src_dir, name), 'wb') as fp:
+                fp.write(contents)
+            self.md5[name] = hashlib.md5(contents).hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.src_dir)
+        shutil.rmtree(op.dirname(self.folder))
+
+    def files(self, server):
+        return dict(('HARDI.' + name.split('.', 1)[1],
+                     (server.url + name, self.md5[name]))
+                    for name in self.md5)
+
+    def test_fetch_data(self):
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            fetch_data(files, self.folder)
+            for name, (url, md5) in files.items():
+                check_md5(op.join(self.folder, name), md5)
+                assert_equal(hashlib.md5(open(op.join(
+                    self.folder, name), 'rb').read()).hexdigest(), md5)
+
+            # Fetching again makes no request, and reads no file.
+            n_requests = server.n_requests
+            fetch_data(files, self.folder)
+            assert_equal(server.n_requests, n_requests)
+
+            # A file that changed is downloaded again.
+            with open(op.join(self.folder, 'HARDI.bval'), 'w') as fp:
+                fp.write('corrupted')
+            fetch_data(files, self.folder)
+            assert_equal(server.n_requests, n_requests + 1)
+
+    def test_unrecorded_files(self):
+        # Files downloaded by former versions are hashed once; those that
+        # do not match are downloaded again.
+        os.makedirs(self.folder)
+        for name in self.md5:
+            shutil.copy(op.join(self.src_dir, name), op.join(
+                self.folder, 'HARDI.' + name.split('.', 1)[1]))
+        with open(op.join(self.folder, 'HARDI.bvec'), 'w') as fp:
+            fp.write('corrupted')
+        with serve_directory(self.src_dir) as server:
+            fetch_data(self.files(server), self.folder)
+            assert_equal(server.n_requests, 1)
+        with open(op.join(self.folder, 'HARDI.bvec'), 'rb') as fp:
+            assert_equal(hashlib.md5(fp.read()).hexdigest(),
+                         self.md5['dwi.bvec'])
+
+    def test_checksum_mismatch(self):
+        with serve_directory(self.src_dir) as server:
+            files = self.files(server)
+            files['HARDI.bval'] = (files['HARDI.bval'][0], '0' * 32)
+            assert_raises(FetcherError, fetch_data, files, self.folder)
+
+    def test_check_md5_read_only(self):
+        # Digests cannot be cached in a read-only folder, but files are
+        # checked all the same.
+        os.makedirs(self.folder)
+        filename = op.join(self.folder, 'dwi.bval')
+        shutil.copy(op.join(self.src_dir, 'dwi.bval'), filename)
+        mkstemp = tempfile.mkstemp
+
+        def read_only(*args, **kwargs):
+            raise OSError(errno.EACCES, 'Permission denied')
+        stdout = sys.stdout
+        try:
+            tempfile.mkstemp = read_only
+            sys.stdout = io.StringIO()
+            check_md5(filename, self.md5['dwi.bval'])
+            assert_equal(sys.stdout.getvalue(), '')
+            check_md5(filename, '0' * 32)
+            assert_true(self.md5['dwi.bval'] in sys.stdout.getvalue())
+        finally:
+            tempfile.mkstemp = mkstemp
+            sys.stdout = stdout
+
+    def test_archive(self):
+        with zipfile.ZipFile(op.join(self.src_dir, 'data.zip'), 'w') as zf:
+            for name in self.md5:
+                zf.write(op.join(self.src_dir, name), 'data/' + name)
+        with serve_directory(self.src_dir) as server:
+            url = server.url + 'data.zip'
+            fetch_data({'data/dwi.nii.gz': (url, None)}, self.folder)
+            assert_equal(server.n_requests, 1)
+        # The whole archive is extracted.
+        for name in self.md5:
+            assert_true(op.exists(op.join(self.folder, 'data', name)))
+
+
+class ReadDwiTest(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.dipy_home = nidata.diffusion.dipy_home
+        nidata.diffusion.dipy_home = self.folder
+        self.bvals = np.array([0., 1000., 995., 2000., 2010., 0.])
+        self.bvecs = np.vstack([np.zeros(3)] + [np.eye(3)[i % 3] * 2
+                                                for i in range(5)])
+        self.fbval = op.join(self.folder, 'dwi.bval')
+        self.fbvec = op.join(self.folder, 'dwi.bvec')
+        np.savetxt(self.fbval, self.bvals[np.newaxis], fmt='%d')
+        np.savetxt(self.fbvec, self.bvecs.T, fmt='%.1f')
+        self.data = np.random.rand(4, 5, 3, 6).astype(np.float32)
+        self.fraw = op.join(self.folder, 'dwi.nii.gz')
+        nib.save(nib.Nifti1Image(self.data, np.eye(4)), self.fraw)
+
+    def tearDown(self):
+        nidata.diffusion.dipy_home = self.dipy_home
+        shutil.rmtree(self.folder)
+
+    def test_gradients_sidecar(self):
+        bvals, bvecs = _read_gradients(self.fbval, self.fbvec)
+        np.testing.assert_array_equal(bvals, self.bvals)
+        np.testing.assert_array_equal(bvecs, self.bvecs)
+        assert_true(op.exists(op.join(self.folder,
+                                      'dwi' + GRADIENTS_SUFFIX)))
+
+        # The sidecar is read as long as the text files do not change.
+        stat = os.stat(self.fbval)
+        with open(self.fbval, 'r+') as fp:
+            fp.write('1')
+        os.utime(self.fbval, (stat.st_atime, stat.st_mtime))
+        np.testing.assert_array_equal(
+            _read_gradients(self.fbval, self.fbvec)[0], self.bvals)
+        os.utime(self.fbval, (stat.st_atime, stat.st_mtime + 10))
+        assert_equal(_read_gradients(self.fbval, self.fbvec)[0][0], 1)
+
+    def test_read_dwi(self):
+        cache = ImageCache(op.join(self.folder, 'cache'))
+        img, bvals, bvecs = _read_dwi(self.fraw, self.fbval, self.fbvec,
+                                      cache=cache)
+        data = np.asanyarray(img.dataobj)
+        assert_true(isinstance(data, np.memmap))
+        assert_true(img.get_filename().startswith(
+            op.join(self.folder, 'cache')))
+        np.testing.assert_array_equal(data, self.data)
+        shutil.rmtree(op.join(self.folder, 'cache'))
+
+        # No image is cached unless a cache is configured.
+        environ = dict(os.environ)
+        try:
+            os.environ.pop('NIDATA_IMAGE_CACHE_DIR', None)
+            img, bvals, bvecs = _read_dwi(self.fraw, self.fbval, self.fbvec)
+            assert_equal(img.get_filename(), self.fraw)
+            np.testing.assert_array_equal(np.asanyarray(img.dataobj),
+                                          self.data)
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+        assert_true(not op.exists(op.join(self.folder, 'cache')))
+
+        for mmap in (True, False):
+            img, bvals, bvecs = _read_dwi(
+                self.fraw, self.fbval, self.fbvec, shells=[2000],
+                mmap=mmap, normalize_bvecs=True)
+            np.testing.assert_array_equal(np.asanyarray(img.dataobj),
+                                          self.data[..., 3:5])
+            np.testing.assert_array_equal(bvals, [2000, 2010])
+            np.testing.assert_array_equal(bvecs, self.bvecs[3:5] / 2)
+
+        img, bvals, bvecs = _read_dwi(self.fraw, self.fbval, self.fbvec,
+                                      shells=[0, 1000], shell_tolerance=1)
+        np.testing.assert_array_equal(bvals, [0, 1000, 0])
+        np.testing.assert_array_equal(np.asanyarray(img.dataobj),
+                                      self.data[..., [0, 1, 5]])
+        assert_raises(ValueError, _read_dwi, self.fraw, self.fbval,
+                      self.fbvec, shells=[3000])
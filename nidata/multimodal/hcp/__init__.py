@@ -6,6 +6,8 @@ import os
 
 from ...core.datasets import Dataset
 from ...core.fetchers import AmazonS3Fetcher, HttpFetcher
+from ...core.fetchers.manifest import DownloadManifest
+from .file_specs import expand_templates, select_templates
 
 
 class HcpHttpFetcher(HttpFetcher):
@@ -13,7 +15,8 @@ class HcpHttpFetcher(HttpFetcher):
 
     dependencies = ['requests'] + HttpFetcher.dependencies
 
-    def __init__(self, data_dir=None, username=None, passwd=None):
+    def __init__(self, data_dir=None, username=None, passwd=None,
+                 max_workers=1, max_per_host=None):
         username = username or os.environ.get("NIDATA_HCP_USERNAME")
         passwd = passwd or os.environ.get("NIDATA_HCP_PASSWD")
         if username is None or passwd is None:
@@ -23,10 +26,36 @@ class HcpHttpFetcher(HttpFetcher):
 
         super(HcpHttpFetcher, self).__init__(data_dir=data_dir,
                                              username=username,
-                                             passwd=passwd)
+                                             passwd=passwd,
+                                             max_workers=max_workers,
+                                             max_per_host=max_per_host)
         self.jsession_id = None
 
     def fetch(self, files, force=False, resume=True, check=False, verbose=1):
+        files = self.reformat_files(files)  # allows flexibility
+
+        # No need to log in if everything was already downloaded.
+        manifest = DownloadManifest(self.data_dir)
+        if not force and all(manifest.is_fetched(tgt, url=src, check=check)
+                             for tgt, src, opts in files):
+            return [os.path.join(self.data_dir, tgt)
+                    for tgt, src, opts in files]
+
+        self.login()
+        self.add_session(opts for tgt, src, opts in files)
+        return super(HcpHttpFetcher, self).fetch(files=files, force=force,
+                                                 resume=resume, check=check,
+                                                 verbose=verbose)
+
+    def get_sizes(self, urls, max_workers=8, verbose=1):
+        self.login()
+        urls = [(url, dict(opts)) for url, opts in urls]
+        self.add_session(opts for url, opts in urls)
+        return super(HcpHttpFetcher, self).get_sizes(
+            urls, max_workers=max_workers, verbose=verbose)
+
+    def login(self):
+        """Open a session on the HCP website, if not done yet."""
         if self.jsession_id is None:
             # Log in to the website.
             import requests
@@ -42,17 +71,12 @@ class HcpHttpFetcher(HttpFetcher):
                 raise Exception('Failed to create HCP session.')
             self.username = self.passwd = None  # use session
 
-        files = self.reformat_files(files)  # allows flexibility
-
-        # Add the session header
-        for tgt, src, opts in files:
+    def add_session(self, all_opts):
+        """Add the session cookie to the options of files."""
+        for opts in all_opts:
             opts['cookies'] = opts.get('cookies', dict())
             opts['cookies'].update({'JSESSIONID': self.jsession_id})
 
-        return super(HcpHttpFetcher, self).fetch(files=files, force=force,
-                                                 resume=resume, check=check,
-                                                 verbose=verbose)
-
 
 class HcpDataset(Dataset):
     """TODO: HcpDataset docstring"""
@@ -124,10 +148,15 @@ class HcpDataset(Dataset):
 
                 # Make sure it's a good file.
                 subject_ids = data.split('\n')
-                subject_ids = filter(lambda sid: sid != '',
-                                     [sid.strip() for sid in subject_ids])
-                if subject_ids < nsubj:
+                subject_ids = [sid.strip() for sid in subject_ids
+                               if sid.strip() != '']
+                if len(subject_ids) < nsubj:
                     os.remove(fil)  # corrupt
+                    # Forget it was fetched, so that it is fetched again.
+                    manifest = DownloadManifest(self.fetcher.data_dir)
+                    manifest.remove(os.path.relpath(
+                        fil, self.fetcher.data_dir))
+                    manifest.save()
                     raise ValueError("Removed corrupt file %s" % fil)
                 else:
                     break
@@ -140,7 +169,7 @@ class HcpDataset(Dataset):
         if fil is None:
             raise Exception("Failed to fetch subject list from any file. "
                             "Error details: %s" % errs)
-        if n_subjects > nsubj:
+        if n_subjects is not None and n_subjects > nsubj:
             raise IndexError("Subjects number requested is too high. Please "
                              "enter a number <= %d." % nsubj)
 
@@ -156,32 +185,8 @@ class HcpDataset(Dataset):
         subj_id : String
             the id of the subject the files are on
         """
-        files = []
-
-        if not process:
-            diff_path = '%s/unprocessed/3T/Diffusion' % subj_id
-
-            files += ['%s/%s_3T_BIAS_32CH.nii.gz' % (diff_path, subj_id)]
-            files += ['%s/%s_3T_BIAS_BC.nii.gz' % (diff_path, subj_id)]
-            files += ['%s/%s_3T_DWI_dir95_LR_SBRef.nii.gz' % (diff_path, subj_id)]
-            files += ['%s/%s_3T_DWI_dir95_LR.bval' % (diff_path, subj_id)]
-            files += ['%s/%s_3T_DWI_dir95_LR.bvec' % (diff_path, subj_id)]
-            files += ['%s/%s_3T_DWI_dir95_LR.nii.gz' % (diff_path, subj_id)]
-            files += ['%s/%s_3T_DWI_dir95_RL_SBRef.nii.gz' % (diff_path, subj_id)]
-            files += ['%s/%s_3T_DWI_dir95_RL.bval' % (diff_path, subj_id)]
-            files += ['%s/%s_3T_DWI_dir95_RL.bvec' % (diff_path, subj_id)]
-            files += ['%s/%s_3T_DWI_dir95_RL.nii.gz' % (diff_path, subj_id)]
-
-            files += ['%s/release-notes/Diffusion_unproc.txt' % subj_id]
-        else:
-            diff_path = '%s/T1w/Diffusion' % subj_id
-
-            files += ['%s/bvals' % diff_path]
-            files += ['%s/bvecs' % diff_path]
-            files += ['%s/data.nii.gz' % diff_path]
-
-            files += ['%s/release-notes/Diffusion_preproc.txt' % subj_id]
-        return files
+        return list(self.plan_files([subj_id], data_types=['diff'],
+                                    process=[process]))
 
     def get_anat_files(self, process, subj_id, atlas, mni, property):
         """
@@ -202,91 +207,10 @@ class HcpDataset(Dataset):
         subj_id : String
             the id of the subject the files are on
         """
-        files = []
-
-        if not process:
-            anat_path = '%s/unprocessed/3T' % subj_id
-
-            files += ['%s/T1w_MPR1/%s_3T_AFI.nii.gz' % (anat_path, subj_id)]
-            files += ['%s/T1w_MPR1/%s_3T_BIAS_32CH.nii.gz' % (anat_path, subj_id)]
-            files += ['%s/T1w_MPR1/%s_3T_BIAS_BC.nii.gz' % (anat_path, subj_id)]
-            files += ['%s/T1w_MPR1/%s_3T_FieldMap_Magnitude.nii.gz' % (anat_path, subj_id)]
-            files += ['%s/T1w_MPR1/%s_3T_FieldMap_Phase.nii.gz' % (anat_path, subj_id)]
-            files += ['%s/T1w_MPR1/%s_3T_T1w_MPR1.nii.gz' % (anat_path, subj_id)]
-
-            files += ['%s/release-notes/Structural_unproc.txt' % subj_id]
-        else:
-            if not mni:
-                if atlas == 'native':
-                    anat_path = '%s/T1w/Native' % subj_id
-                    if property == 'thickness':
-                        files += ['%s/%s.L.midthickness.native.surf.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.R.midthickness.native.surf.gii' % (anat_path, subj_id)]
-                elif atlas == 'fsaverage':
-                    anat_path = '%s/T1w/fsaverage_LR32k' % subj_id
-                    if property == 'thickness':
-                        files += ['%s/%s.L.midthickness.32k_fs_LR.surf.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.R.midthickness.32k_fs_LR.surf.gii' % (anat_path, subj_id)]
-            else:
-                if atlas == 'native':
-                    anat_path = '%s/MNINonLinear/Native' % subj_id
-                    if property == 'thickness':
-                        files += ['%s/%s.corrThickness.native.dscalar.nii' % (anat_path, subj_id)]
-                        files += ['%s/%s.L.corrThickness.native.shape.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.L.midthickness.native.surf.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.L.thickness.native.shape.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.R.corrThickness.native.shape.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.R.midthickness.native.surf.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.R.thickness.native.shape.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.thickness.native.dscalar.nii' % (anat_path, subj_id)]
-                    elif property == 'curvature':
-                        files += ['%s/%s.curvature.native.dscalar.nii' % (anat_path, subj_id)]
-                        files += ['%s/%s.L.curvature.native.shape.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.R.curvature.native.shape.gii' % (anat_path, subj_id)]
-                    elif property == 'myelinmap':
-                        files += ['%s/%s.L.MyelinMap.native.func.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.L.MyelinMap_BC.native.func.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.L.SmoothedMyelinMap.native.func.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.L.SmoothedMyelinMap_BC.native.func.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.MyelinMap.native.dscalar.nii' % (anat_path, subj_id)]
-                        files += ['%s/%s.MyelinMap_BC.native.dscalar.nii' % (anat_path, subj_id)]
-                        files += ['%s/%s.R.MyelinMap.native.func.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.R.MyelinMap_BC.native.func.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.R.SmoothedMyelinMap.native.func.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.R.SmoothedMyelinMap_BC.native.func.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.SmoothedMyelinMap.native.dscalar.nii' % (anat_path, subj_id)]
-                        files += ['%s/%s.SmoothedMyelinMap_BC.native.dscalar.nii' % (anat_path, subj_id)]
-                elif atlas == 'fsaverage':
-                    anat_path = '%s/MNINonLinear/fsaverage_LR32k' % subj_id
-                    if property == 'thickness':
-                        files += ['%s/%s.corrThickness.32k_fs_LR.dscalar.nii' % (anat_path, subj_id)]
-                        files += ['%s/%s.L.corrThickness.32k_fs_LR.shape.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.L.midthickness.32k_fs_LR.surf.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.L.thickness.32k_fs_LR.shape.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.R.corrThickness.32k_fs_LR.shape.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.R.midthickness.32k_fs_LR.surf.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.R.thickness.32k_fs_LR.shape.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.thickness.32k_fs_LR.dscalar.nii' % (anat_path, subj_id)]
-                    elif property == 'curvature':
-                        files += ['%s/%s.curvature.32k_fs_LR.dscalar.nii' % (anat_path, subj_id)]
-                        files += ['%s/%s.L.curvature.32k_fs_LR.shape.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.R.curvature.32k_fs_LR.shape.gii' % (anat_path, subj_id)]
-                    elif property == 'myelinmap':
-                        files += ['%s/%s.L.MyelinMap.32k_fs_LR.func.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.L.MyelinMap_BC.32k_fs_LR.func.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.L.SmoothedMyelinMap.32k_fs_LR.func.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.L.SmoothedMyelinMap_BC.32k_fs_LR.func.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.MyelinMap.32k_fs_LR.dscalar.nii' % (anat_path, subj_id)]
-                        files += ['%s/%s.MyelinMap_BC.32k_fs_LR.dscalar.nii' % (anat_path, subj_id)]
-                        files += ['%s/%s.R.MyelinMap.32k_fs_LR.func.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.R.MyelinMap_BC.32k_fs_LR.func.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.R.SmoothedMyelinMap.32k_fs_LR.func.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.R.SmoothedMyelinMap_BC.32k_fs_LR.func.gii' % (anat_path, subj_id)]
-                        files += ['%s/%s.SmoothedMyelinMap.32k_fs_LR.dscalar.nii' % (anat_path, subj_id)]
-                        files += ['%s/%s.SmoothedMyelinMap_BC.32k_fs_LR.dscalar.nii' % (anat_path, subj_id)]
-
-            files += ['%s/release-notes/Structural_preproc.txt' % subj_id]
-        return files
+        return list(self.plan_files([subj_id], data_types=['anat'],
+                                    atlases=[atlas], mnis=[mni],
+                                    properties=[property],
+                                    process=[process]))
 
     def get_rest_files(self, process, subj_id):
         """
@@ -298,38 +222,8 @@ class HcpDataset(Dataset):
         subj_id : String
             the id of the subject the files are on
         """
-        files = []
-
-        if not process:
-            rest_path = '%s/unprocessed/3T' % subj_id
-
-            files += ['%s/rfMRI_REST1_LR/%s_3T_BIAS_32CH.nii.gz' % (rest_path, subj_id)]
-            files += ['%s/rfMRI_REST1_LR/%s_3T_BIAS_BC.nii.gz' % (rest_path, subj_id)]
-            files += ['%s/rfMRI_REST1_LR/%s_3T_rfMRI_REST1_LR_SBRef.nii.gz' % (rest_path, subj_id)]
-            files += ['%s/rfMRI_REST1_LR/%s_3T_rfMRI_REST1_LR.nii.gz' % (rest_path, subj_id)]
-            files += ['%s/rfMRI_REST1_LR/%s_3T_SpinEchoFieldMap_LR.nii.gz' % (rest_path, subj_id)]
-            files += ['%s/rfMRI_REST1_LR/%s_3T_SpinEchoFieldMap_RL.nii.gz' % (rest_path, subj_id)]
-            files += ['%s/rfMRI_REST1_LR/LINKED_DATA/PHYSIO/%s_3T_rfMRI_REST1_LR_Physio_log.txt' % (rest_path, subj_id)]
-
-            files += ['%s/release-notes/rfMRI_REST1_unproc.txt' % subj_id]
-        else:
-            rest_path = '%s/MNINonLinear/Results' % subj_id
-            files += ['%s/rfMRI_REST1_LR/brainmask_fs.2.nii.gz' % rest_path]
-            files += ['%s/rfMRI_REST1_LR/Movement_Regressors_dt.txt' % rest_path]
-            files += ['%s/rfMRI_REST1_LR/Movement_Regressors.txt' % rest_path]
-            files += ['%s/rfMRI_REST1_LR/Movement_AbsoluteRMS.txt' % rest_path]
-            files += ['%s/rfMRI_REST1_LR/Movement_AbsoluteRMS_mean.txt' % rest_path]
-            files += ['%s/rfMRI_REST1_LR/Movement_RelativeRMS.txt' % rest_path]
-            files += ['%s/rfMRI_REST1_LR/Movement_RelativeRMS_mean.txt' % rest_path]
-            files += ['%s/rfMRI_REST1_LR/rfMRI_REST1_LR_Atlas.dtseries.nii' % rest_path]
-            files += ['%s/rfMRI_REST1_LR/rfMRI_REST1_LR_Jacobian.nii.gz' % rest_path]
-            files += ['%s/rfMRI_REST1_LR/rfMRI_REST1_LR_SBRef.nii.gz' % rest_path]
-            files += ['%s/rfMRI_REST1_LR/rfMRI_REST1_LR.nii.gz' % rest_path]
-            files += ['%s/rfMRI_REST1_LR/rfMRI_REST1_LR_Physio_log.txt' % rest_path]
-            files += ['%s/rfMRI_REST1_LR/RibbonVolumeToSurfaceMapping/goodvoxels.nii.gz' % rest_path]
-
-            files += ['%s/release-notes/rfMRI_REST1_preproc.txt' % subj_id]
-        return files
+        return list(self.plan_files([subj_id], data_types=['rest'],
+                                    process=[process]))
 
     def get_task_files(self, process, task, subj_id):
         """
@@ -345,60 +239,46 @@ class HcpDataset(Dataset):
         subj_id : String
             the id of the subject the files are on
         """
-        files = []
-        task = task.upper()
-
-        if not process:
-            func_path = '%s/unprocessed/3T' % subj_id
-            task_path = '%s/tfMRI/%s_LR' % (func_path, task)
-
-            files += ['%s/%s_3T_BIAS_32CH.nii.gz' % (task_path, subj_id)]
-            files += ['%s/%s_3T_BIAS_BC.nii.gz' % (task_path, subj_id)]
-            files += ['%s/%s_3T_SpinEchoFieldMap_LR.nii.gz' % (task_path, subj_id)]
-            files += ['%s/%s_3T_SpinEchoFieldMap_RL.nii.gz' % (task_path, subj_id)]
-            files += ['%s/%s_3T_tfMRI_%s_LR.nii.gz' % (task_path, subj_id, task)]
-            files += ['%s/%s_3T_tfMRI_%s_LR_SBRef.nii.gz' % (task_path, subj_id, task)]
-            files += ['%s/LINKED_DATA/EPRIME/%s_3T_%s_run2_TAB.txt' % (task_path, subj_id, task)]
-            files += ['%s/LINKED_DATA/EPRIME/EVs/%s_Stats.csv' % (task_path, task)]
-            files += ['%s/LINKED_DATA/EPRIME/EVs/fear.txt' % (func_path, task)]
-            files += ['%s/LINKED_DATA/EPRIME/EVs/neut.txt' % (task_path)]
-            files += ['%s/LINKED_DATA/EPRIME/EVs/Sync.txt' % (task_path)]
-            files += ['%s/release-notes/tfMRI_%s_unproc.txt' % (subj_id, task)]
+        return list(self.plan_files([subj_id], data_types=['task'],
+                                    tasks=[task], process=[process]))
 
-        else:
-            func_path = '%s/MNINonLinear/Results' % subj_id
-            task_path = '%s/tfMRI_%s_LR' % (func_path, task)
-
-            files += ['%s/brainmask_fs.2.nii.gz' % (task_path)]
-            files += ['%s/%s_run2_TAB.txt' % (task_path, task)]
-            files += ['%s/Movement_Regressors_dt.txt' % (task_path)]
-            files += ['%s/Movement_Regressors.txt' % (task_path)]
-            files += ['%s/Movement_AbsoluteRMS.txt' % (task_path)]
-            files += ['%s/Movement_AbsoluteRMS_mean.txt' % (task_path)]
-            files += ['%s/Movement_RelativeRMS.txt' % (task_path)]
-            files += ['%s/Movement_RelativeRMS_mean.txt' % (task_path)]
-            files += ['%s/tfMRI_%s_LR_Atlas.dtseries.nii' % (task_path, task)]
-            files += ['%s/tfMRI_%s_LR_Jacobian.nii.gz' % (task_path, task)]
-            files += ['%s/tfMRI_%s_LR_SBRef.nii.gz' % (task_path, task)]
-            files += ['%s/tfMRI_%s_LR.nii.gz' % (task_path, task)]
-            files += ['%s/tfMRI_%s_LR_Physio_log.txt' % (task_path, task)]
-            files += ['%s/tfMRI_%s_LR_hp200_s4_level1.fsf' % (task_path, task)]
-            files += ['%s/RibbonVolumeToSurfaceMapping/goodvoxels.nii.gz' % (task_path)]
-            files += ['%s/EVs/%s_Stats.csv' % (task_path, task)]
-            files += ['%s/tfMRI_%s/tfMRI_%s_hp200_s4_level2.fsf' % (func_path, task, task)]
-            files += ['%s/release-notes/tfMRI_%s_preproc.txt' % (subj_id, task)]
-
-            # Task-specific-files:
-            if task == 'emotion':
-                files += ['%s/EVs/fear.txt' % (task_path)]
-                files += ['%s/EVs/neut.txt' % (task_path)]
-                files += ['%s/EVs/Sync.txt' % (task_path)]
+    def plan_files(self, subj_ids, data_types=None, tasks=None, atlases=None,
+                   mnis=None, properties=None, process=None):
+        """
+        Parameters
+        ----------
+        subj_ids : list
+            the ids of the subjects to fetch files from
+        (others) : see fetch
 
-        return files
+        Returns
+        -------
+        OrderedDict of the files to fetch, without duplicates, mapped to
+        their approximate sizes (in bytes).
+        """
+        if data_types is None:
+            data_types = ['anat', 'diff', 'task', 'rest']
+        if tasks is None:
+            tasks = ['emotion', 'gambling', 'language', 'motor',
+                     'relational', 'social', 'wm']
+        if atlases is None:
+            atlases = ['native', 'fsaverage']
+        if mnis is None:
+            mnis = [True, False]
+        if properties is None:
+            properties = ['myelinmap', 'curvature', 'thickness']
+        if process is None:
+            process = [True]
+
+        # Variants are resolved once; only the subject varies after that.
+        templates = select_templates(data_types=data_types, process=process,
+                                     tasks=tasks, atlases=atlases, mnis=mnis,
+                                     properties=properties)
+        return expand_templates(templates, subj_ids)
 
     def fetch(self, n_subjects=1, data_types=None,
-              tasks=None, atlases=None, mnis=None, force=False, check=True, verbose=1,
-              properties=None, process=None):
+              tasks=None, atlases=None, mnis=None, force=False, check=True,
+              verbose=1, properties=None, process=None):
         """
         Parameters
         ----------
@@ -406,7 +286,7 @@ class HcpDataset(Dataset):
             the number of subjects to fetch files from
         data_types : list
             the type of data to fetch,
-            can choose from anat, diff, func, or rest
+            can choose from anat, diff, task, or rest
         tasks : list
             the type of activity for functional data,
             can choose from emotional, gambling, language, motor,
@@ -424,50 +304,41 @@ class HcpDataset(Dataset):
             whether or not the data is processed or not
             can choose from True or False
         """
-        if data_types is None:
-            data_types = ['anat', 'diff', 'task', 'rest']
-        if tasks is None:
-            tasks = ['emotion', 'gambling', 'language', 'motor',
-                     'relational', 'social', 'wm']
-        if atlases is None:
-            atlases = ['native', 'fsaverage']
-        if mnis is None:
-            mnis = [True, False]
-        if properties is None:
-            properties = ['myelinmap', 'curvature', 'thickness']
-        if process is None:
-            process = [True]
+        plan = self.plan(n_subjects=n_subjects, data_types=data_types,
+                         tasks=tasks, atlases=atlases, mnis=mnis,
+                         force=force, check=check, properties=properties,
+                         process=process, sizes=False, verbose=verbose)
+        return plan.execute(verbose=verbose)
+
+    def plan(self, n_subjects=1, data_types=None, tasks=None, atlases=None,
+             mnis=None, force=False, check=False, verbose=1, properties=None,
+             process=None, sizes=True, max_workers=8):
+        """
+        Plan the fetch of files, without downloading them.
+
+        Parameters
+        ----------
+        (most) : see fetch
+        sizes : boolean
+            whether to request the sizes of the files to download from
+            the server; otherwise, approximate sizes are used.
+        max_workers : int
+            number of concurrent size requests
 
+        Returns
+        -------
+        FetchPlan of the files; its execute method downloads them.
+        """
         subj_ids = self.get_subject_list(n_subjects=n_subjects)
 
-        # Build a list of files to fetch
-        src_files = []
-        for subj_id in subj_ids[:n_subjects]:
-            for data_type in data_types:
-                if data_type == 'diff':
-                    for pro in process:
-                        src_files += self.get_diff_files(process=pro,
-                                                         subj_id=subj_id)
-                if data_type == 'anat':
-                    for pro in process:
-                        for atlas in atlases:
-                            for mni in mnis:
-                                for prop in properties:
-                                    src_files += self.get_anat_files(process=pro,
-                                                                     subj_id=subj_id,
-                                                                     atlas=atlas,
-                                                                     mni=mni,
-                                                                     property=prop)
-                if data_type == 'rest':
-                    for pro in process:
-                        src_files += self.get_rest_files(process=pro,
-                                                         subj_id=subj_id)
-                if data_type == 'task':
-                    for pro in process:
-                        for task in tasks:
-                            src_files += self.get_task_files(process=pro,
-                                                             task=task,
-                                                             subj_id=subj_id)
+        # Build the list of files to fetch
+        planned = self.plan_files(subj_ids, data_types=data_types,
+                                  tasks=tasks, atlases=atlases, mnis=mnis,
+                                  properties=properties, process=process)
+
         # Massage paths, based on fetcher type.
-        out_files = self.fetcher.fetch(self.prepend(src_files))
-        return out_files
+        files = [(tgt, src, dict(estimated_size=planned[tgt]))
+                 for tgt, src in self.prepend(list(planned))]
+        return self.fetcher.plan(files, force=force, check=check,
+                                 sizes=sizes, max_workers=max_workers,
+                                 verbose=verbose)
@@ -0,0 +1,227 @@
+"""
+Files of the HCP 900 release, as a table of path templates.
+
+Each FileSpec gives the path of a file, relative to the subject directory
+root, with `{subj}` (subject id) and `{task}` (task name, in capitals)
+fields; the data type and processing level it belongs to; the variant
+(atlas, mni, property or task) it is specific to, if any; and its
+approximate size, used to estimate downloads.
+
+Requested files are obtained by selecting templates for the requested
+variants once, then expanding them for all subjects.
+"""
+
+import collections
+
+KB = 1024
+MB = 1024 * KB
+GB = 1024 * MB
+
+
+class FileSpec(collections.namedtuple(
+        'FileSpec', ['data_type', 'process', 'template', 'size',
+                     'conditions'])):
+    """A file of each subject; conditions maps variant names (atlas, mni,
+    property, task) to the value the file is specific to."""
+
+    def __new__(cls, data_type, process, template, size, **conditions):
+        return super(FileSpec, cls).__new__(cls, data_type, process,
+                                            template, size, conditions)
+
+
+def _specs(data_type, process, directory, files, **conditions):
+    """FileSpecs for (name, size) files, in directory."""
+    return [FileSpec(data_type, process, '%s/%s' % (directory, name), size,
+                     **conditions)
+            for name, size in files]
+
+
+def _release_notes(data_type, process, name):
+    return FileSpec(data_type, process, '{subj}/release-notes/%s.txt' % name,
+                    2 * KB)
+
+
+_BIAS = [('{subj}_3T_BIAS_32CH.nii.gz', 1 * MB),
+         ('{subj}_3T_BIAS_BC.nii.gz', 1 * MB)]
+_SPIN_ECHO = [('{subj}_3T_SpinEchoFieldMap_LR.nii.gz', 5 * MB),
+              ('{subj}_3T_SpinEchoFieldMap_RL.nii.gz', 5 * MB)]
+_MOVEMENT = [('Movement_Regressors_dt.txt', 100 * KB),
+             ('Movement_Regressors.txt', 100 * KB),
+             ('Movement_AbsoluteRMS.txt', 10 * KB),
+             ('Movement_AbsoluteRMS_mean.txt', 1 * KB),
+             ('Movement_RelativeRMS.txt', 10 * KB),
+             ('Movement_RelativeRMS_mean.txt', 1 * KB)]
+_EMOTION_EVS = [('fear.txt', 1 * KB), ('neut.txt', 1 * KB),
+                ('Sync.txt', 1 * KB)]
+
+# Surface files of processed structural data, by (property, mni); {space}
+# is the surface mesh.
+_SURFACES = {
+    ('thickness', False): [
+        ('{subj}.L.midthickness.{space}.surf.gii', 5 * MB),
+        ('{subj}.R.midthickness.{space}.surf.gii', 5 * MB)],
+    ('thickness', True): [
+        ('{subj}.corrThickness.{space}.dscalar.nii', 1 * MB),
+        ('{subj}.L.corrThickness.{space}.shape.gii', 500 * KB),
+        ('{subj}.L.midthickness.{space}.surf.gii', 5 * MB),
+        ('{subj}.L.thickness.{space}.shape.gii', 500 * KB),
+        ('{subj}.R.corrThickness.{space}.shape.gii', 500 * KB),
+        ('{subj}.R.midthickness.{space}.surf.gii', 5 * MB),
+        ('{subj}.R.thickness.{space}.shape.gii', 500 * KB),
+        ('{subj}.thickness.{space}.dscalar.nii', 1 * MB)],
+    ('curvature', True): [
+        ('{subj}.curvature.{space}.dscalar.nii', 1 * MB),
+        ('{subj}.L.curvature.{space}.shape.gii', 500 * KB),
+        ('{subj}.R.curvature.{space}.shape.gii', 500 * KB)],
+    ('myelinmap', True): [
+        ('{subj}.L.MyelinMap.{space}.func.gii', 500 * KB),
+        ('{subj}.L.MyelinMap_BC.{space}.func.gii', 500 * KB),
+        ('{subj}.L.SmoothedMyelinMap.{space}.func.gii', 500 * KB),
+        ('{subj}.L.SmoothedMyelinMap_BC.{space}.func.gii', 500 * KB),
+        ('{subj}.MyelinMap.{space}.dscalar.nii', 1 * MB),
+        ('{subj}.MyelinMap_BC.{space}.dscalar.nii', 1 * MB),
+        ('{subj}.R.MyelinMap.{space}.func.gii', 500 * KB),
+        ('{subj}.R.MyelinMap_BC.{space}.func.gii', 500 * KB),
+        ('{subj}.R.SmoothedMyelinMap.{space}.func.gii', 500 * KB),
+        ('{subj}.R.SmoothedMyelinMap_BC.{space}.func.gii', 500 * KB),
+        ('{subj}.SmoothedMyelinMap.{space}.dscalar.nii', 1 * MB),
+        ('{subj}.SmoothedMyelinMap_BC.{space}.dscalar.nii', 1 * MB)],
+}
+
+# Directory and mesh name of each atlas.
+_ATLAS_SPACES = {'native': ('Native', 'native'),
+                 'fsaverage': ('fsaverage_LR32k', '32k_fs_LR')}
+
+
+def _build_file_specs():
+    specs = []
+
+    # Diffusion
+    diff_path = '{subj}/unprocessed/3T/Diffusion'
+    dwi = []
+    for direction in ('LR', 'RL'):
+        dwi += [('{subj}_3T_DWI_dir95_%s_SBRef.nii.gz' % direction, 1 * MB),
+                ('{subj}_3T_DWI_dir95_%s.bval' % direction, 1 * KB),
+                ('{subj}_3T_DWI_dir95_%s.bvec' % direction, 3 * KB),
+                ('{subj}_3T_DWI_dir95_%s.nii.gz' % direction, 450 * MB)]
+    specs += _specs('diff', False, diff_path, _BIAS + dwi)
+    specs += [_release_notes('diff', False, 'Diffusion_unproc')]
+    specs += _specs('diff', True, '{subj}/T1w/Diffusion',
+                    [('bvals', 2 * KB), ('bvecs', 6 * KB),
+                     ('data.nii.gz', 1300 * MB)])
+    specs += [_release_notes('diff', True, 'Diffusion_preproc')]
+
+    # Structural
+    specs += _specs('anat', False, '{subj}/unprocessed/3T/T1w_MPR1',
+                    [('{subj}_3T_AFI.nii.gz', 2 * MB)] + _BIAS +
+                    [('{subj}_3T_FieldMap_Magnitude.nii.gz', 4 * MB),
+                     ('{subj}_3T_FieldMap_Phase.nii.gz', 2 * MB),
+                     ('{subj}_3T_T1w_MPR1.nii.gz', 30 * MB)])
+    specs += [_release_notes('anat', False, 'Structural_unproc')]
+    for mni in (False, True):
+        for atlas in ('native', 'fsaverage'):
+            atlas_dir, space = _ATLAS_SPACES[atlas]
+            directory = '{subj}/%s/%s' % (
+                'MNINonLinear' if mni else 'T1w', atlas_dir)
+            for prop in ('thickness', 'curvature', 'myelinmap'):
+                files = [(name.replace('{space}', space), size)
+                         for name, size in _SURFACES.get((prop, mni), [])]
+                specs += _specs('anat', True, directory, files, mni=mni,
+                                atlas=atlas, property=prop)
+    specs += [_release_notes('anat', True, 'Structural_preproc')]
+
+    # Resting state
+    rest_path = '{subj}/unprocessed/3T/rfMRI_REST1_LR'
+    specs += _specs('rest', False, rest_path, _BIAS + [
+        ('{subj}_3T_rfMRI_REST1_LR_SBRef.nii.gz', 1 * MB),
+        ('{subj}_3T_rfMRI_REST1_LR.nii.gz', 900 * MB)] + _SPIN_ECHO +
+        [('LINKED_DATA/PHYSIO/{subj}_3T_rfMRI_REST1_LR_Physio_log.txt',
+          10 * MB)])
+    specs += [_release_notes('rest', False, 'rfMRI_REST1_unproc')]
+    specs += _specs(
+        'rest', True, '{subj}/MNINonLinear/Results/rfMRI_REST1_LR',
+        [('brainmask_fs.2.nii.gz', 100 * KB)] + _MOVEMENT +
+        [('rfMRI_REST1_LR_Atlas.dtseries.nii', 400 * MB),
+         ('rfMRI_REST1_LR_Jacobian.nii.gz', 1 * MB),
+         ('rfMRI_REST1_LR_SBRef.nii.gz', 1 * MB),
+         ('rfMRI_REST1_LR.nii.gz', 1100 * MB),
+         ('rfMRI_REST1_LR_Physio_log.txt', 10 * MB),
+         ('RibbonVolumeToSurfaceMapping/goodvoxels.nii.gz', 100 * KB)])
+    specs += [_release_notes('rest', True, 'rfMRI_REST1_preproc')]
+
+    # Task
+    task_path = '{subj}/unprocessed/3T/tfMRI/{task}_LR'
+    specs += _specs('task', False, task_path, _BIAS + _SPIN_ECHO + [
+        ('{subj}_3T_tfMRI_{task}_LR.nii.gz', 250 * MB),
+        ('{subj}_3T_tfMRI_{task}_LR_SBRef.nii.gz', 1 * MB),
+        ('LINKED_DATA/EPRIME/{subj}_3T_{task}_run2_TAB.txt', 100 * KB),
+        ('LINKED_DATA/EPRIME/EVs/{task}_Stats.csv', 1 * KB)])
+    specs += _specs('task', False, task_path + '/LINKED_DATA/EPRIME/EVs',
+                    _EMOTION_EVS, task='EMOTION')
+    specs += [_release_notes('task', False, 'tfMRI_{task}_unproc')]
+    func_path = '{subj}/MNINonLinear/Results'
+    task_path = func_path + '/tfMRI_{task}_LR'
+    specs += _specs('task', True, task_path, [
+        ('brainmask_fs.2.nii.gz', 100 * KB),
+        ('{task}_run2_TAB.txt', 100 * KB)] + _MOVEMENT + [
+        ('tfMRI_{task}_LR_Atlas.dtseries.nii', 100 * MB),
+        ('tfMRI_{task}_LR_Jacobian.nii.gz', 1 * MB),
+        ('tfMRI_{task}_LR_SBRef.nii.gz', 1 * MB),
+        ('tfMRI_{task}_LR.nii.gz', 300 * MB),
+        ('tfMRI_{task}_LR_Physio_log.txt', 2 * MB),
+        ('tfMRI_{task}_LR_hp200_s4_level1.fsf', 50 * KB),
+        ('RibbonVolumeToSurfaceMapping/goodvoxels.nii.gz', 100 * KB),
+        ('EVs/{task}_Stats.csv', 1 * KB)])
+    specs += _specs('task', True, func_path + '/tfMRI_{task}',
+                    [('tfMRI_{task}_hp200_s4_level2.fsf', 50 * KB)])
+    specs += [_release_notes('task', True, 'tfMRI_{task}_preproc')]
+    specs += _specs('task', True, task_path + '/EVs', _EMOTION_EVS,
+                    task='EMOTION')
+    return specs
+
+
+FILE_SPECS = _build_file_specs()
+
+
+def select_templates(data_types, process, tasks=(), atlases=(), mnis=(),
+                     properties=()):
+    """Return the templates of the files to fetch for each subject.
+
+    Parameters are those of HcpDataset.fetch; templates specific to a
+    variant are kept if that variant is requested.
+
+    Returns
+    -------
+    templates: OrderedDict
+        Path templates (with a {subj} field) mapped to their approximate
+        sizes. Each template appears once, whatever the number of variants
+        that require it (e.g. release notes).
+    """
+    requested = dict(atlas=atlases, mni=mnis, property=properties,
+                     task=[task.upper() for task in tasks])
+    templates = collections.OrderedDict()
+    for data_type in data_types:
+        for spec in FILE_SPECS:
+            if spec.data_type != data_type or spec.process not in process:
+                continue
+            if any(value not in requested[name]
+                   for name, value in spec.conditions.items()):
+                continue
+            if '{task}' not in spec.template:
+                templates.setdefault(spec.template, spec.size)
+                continue
+            for task in requested['task']:
+                if spec.conditions.get('task', task) == task:
+                    templates.setdefault(
+                        spec.template.replace('{task}', task), spec.size)
+    return templates
+
+
+def expand_templates(templates, subject_ids):
+    """Return an OrderedDict of the files of templates for all subjects,
+    mapped to their approximate sizes."""
+    files = collections.OrderedDict()
+    for subj_id in collections.OrderedDict.fromkeys(subject_ids):
+        for template, size in templates.items():
+            files[template.replace('{subj}', subj_id)] = size
+    return files
@@ -5,6 +5,9 @@ from nose.tools import assert_raises
 from unittest import TestCase
 
 from nidata.multimodal import HcpDataset
+from nidata.multimodal.hcp.file_specs import (expand_templates,
+                                              select_templates)
+from nidata.core.fetchers.plan import format_size
 from nidata.core._utils.testing import (DownloadTestMixin, InstallTestMixin)
 
 
@@ -42,3 +45,47 @@ class HcpAwsDatasetWithDummyCredentials(HcpDataset):
 
 class HcpInstallBotoTest(InstallTestMixin, TestCase):
     dataset_class = HcpAwsDatasetWithDummyCredentials
+
+
+class HcpFileSpecsTest(TestCase):
+    def test_no_duplicates(self):
+        templates = select_templates(data_types=['anat'], process=[False],
+                                     atlases=['native', 'fsaverage'],
+                                     mnis=[True, False],
+                                     properties=['thickness', 'curvature'])
+        files = list(expand_templates(templates, ['100307', '100408']))
+        self.assertEqual(len(files), len(set(files)))
+        self.assertEqual(len(files), 2 * 7)
+        self.assertIn('100408/release-notes/Structural_unproc.txt', files)
+
+    def test_variants(self):
+        templates = select_templates(data_types=['anat'], process=[True],
+                                     atlases=['fsaverage'], mnis=[True],
+                                     properties=['curvature'])
+        files = list(expand_templates(templates, ['100307']))
+        self.assertEqual(files, [
+            '100307/MNINonLinear/fsaverage_LR32k/'
+            '100307.curvature.32k_fs_LR.dscalar.nii',
+            '100307/MNINonLinear/fsaverage_LR32k/'
+            '100307.L.curvature.32k_fs_LR.shape.gii',
+            '100307/MNINonLinear/fsaverage_LR32k/'
+            '100307.R.curvature.32k_fs_LR.shape.gii',
+            '100307/release-notes/Structural_preproc.txt'])
+
+    def test_task_specific_files(self):
+        for process in (True, False):
+            templates = select_templates(data_types=['task'],
+                                         process=[process],
+                                         tasks=['emotion', 'wm'])
+            evs = [tmpl for tmpl in templates if tmpl.endswith('fear.txt')]
+            self.assertEqual(len(evs), 1)
+            self.assertIn('EMOTION', evs[0])
+            self.assertTrue(all('{' not in tmpl.replace('{subj}', '')
+                                for tmpl in templates))
+
+    def test_sizes(self):
+        templates = select_templates(data_types=['diff'], process=[True])
+        files = expand_templates(templates, ['100307', '100408', '100307'])
+        self.assertEqual(len(files), 2 * len(templates))
+        self.assertEqual(sum(files.values()), 2 * sum(templates.values()))
+        self.assertEqual(format_size(sum(files.values())), '2.5 GB')
@@ -48,7 +48,8 @@ class MyConnectome2015Dataset(HttpDataset):
 
         # First, construct the relevant urls
         files = []
-        opts = {'uncompress': True}
+        # Multi-GB tarballs: download them as concurrent byte ranges.
+        opts = {'uncompress': True, 'segments': 4}
         base_url = 'https://s3.amazonaws.com/openfmri/tarballs/'
 
         if 'resting_state' in data_types:
@@ -72,9 +73,10 @@ class MyConnectome2015Dataset(HttpDataset):
                 'ds031_set07.tgz': range(85, 98),
                 'ds031_set08.tgz': range(98, 105), }
             for zip_file, sess_range in sess_to_file_map.items():
-                if set(session_ids).intersection(set(sess_range)):
-                    uncompressed_dir = 'ds031/sub00001/ses%03d' % sess_range[0]
-                    remote_url = base_url + zip_file
+                # Only the requested sessions are extracted from each set.
+                remote_url = base_url + zip_file
+                for sess_id in sorted(set(session_ids) & set(sess_range)):
+                    uncompressed_dir = 'ds031/sub00001/ses%03d' % sess_id
                     files += [(uncompressed_dir, remote_url, opts)]
 
         # Now, fetch the files.
@@ -1,5 +1,10 @@
-from .ABIDE_pcp import AbidePcpDataset
-from .adhd import AdhdRestDataset
-from .nyu import NyuRestDataset
+import os.path as _osp
+from ..core._utils import lazy_import_submodules as _lazy_import
 
 __all__ = ['AbidePcpDataset', 'AdhdRestDataset', 'NyuRestDataset']
+
+# Dataset modules are imported when their class is first accessed.
+_lazy_import(_osp.dirname(_osp.abspath(__file__)), globals(), names=dict(
+    AbidePcpDataset='ABIDE_pcp',
+    AdhdRestDataset='adhd',
+    NyuRestDataset='nyu'))
@@ -1,10 +1,15 @@
 """
 Task-based functional MRI datasets
 """
-from .haxby_etal_2001 import Haxby2001Dataset
-from .miyawaki_2008 import Miyawaki2008Dataset
-from .neurovault import NeuroVaultDataset
-from .poldrack_etal_2001 import PoldrackEtal2001Dataset
+import os.path as _osp
+from ..core._utils import lazy_import_submodules as _lazy_import
 
 __all__ = ['Haxby2001Dataset', 'Miyawaki2008Dataset',
            'PoldrackEtal2001Dataset', 'NeuroVaultDataset']
+
+# Dataset modules are imported when their class is first accessed.
+_lazy_import(_osp.dirname(_osp.abspath(__file__)), globals(), names=dict(
+    Haxby2001Dataset='haxby_etal_2001',
+    Miyawaki2008Dataset='miyawaki_2008',
+    NeuroVaultDataset='neurovault',
+    PoldrackEtal2001Dataset='poldrack_etal_2001'))
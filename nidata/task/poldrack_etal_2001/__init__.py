@@ -65,6 +65,7 @@ class OpenFMriDataset(HttpDataset):
         from nipy.modalities.fmri.glm import FMRILinearModel
         from nipy.modalities.fmri.experimental_paradigm import (
             EventRelatedParadigm)
+        from ...core._utils.niimg import load_niimg
 
         def get_beta_filepath(func_file, cond):
             return func_file.replace('_bold.nii.gz', '_beta-%s.nii.gz' % cond)
@@ -94,7 +95,7 @@ class OpenFMriDataset(HttpDataset):
             tr = cond_data['duration'].as_matrix().mean()
             onsets = cond_data['onset'].tolist()
 
-            img = nibabel.load(func_file)
+            img = load_niimg(func_file)
             n_scans = img.shape[3]
             frametimes = np.linspace(0, (n_scans - 1) * tr, n_scans)
 
@@ -147,7 +148,8 @@ class PoldrackEtal2001Dataset(OpenFMriDataset):
         # Prep the URLs
         if not op.exists(op.join(self.data_dir, 'ds052_BIDS')):
             url = 'http://openfmri.s3.amazonaws.com/tarballs/ds052_raw.tgz'
-            opts = {'uncompress': True}
+            # One large tarball; split its download in byte ranges.
+            opts = {'uncompress': True, 'segments': 4}
             files = [('ds052', url, opts)]
             files = self.fetcher.fetch(files, resume=resume, force=force,
                                        verbose=verbose)